@@ -12,6 +12,9 @@ import pdb
 import subprocess
 import signal
 import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from JKBio.utils import helper as h
 
 
@@ -37,146 +40,311 @@ def list_blobs_with_prefix(bucket_name, prefix, delimiter=None):
             /a/1.txt
 
     """
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    ret = []
-    blobs = bucket.list_blobs(prefix=prefix, delimiter=delimiter)
-    for blob in blobs:
-        ret.append(blob.name)
-    return(ret)
+    return [blob.name for blob in getClient().list_blobs(bucket_name, prefix=prefix, delimiter=delimiter)]
 
 
-def mvFiles(files, location, group=50, listen_to_errors=False):
+_client = None
+_clientlock = threading.Lock()
+
+
+def getClient():
     """
-    move a set of files in parallel (when the set is huge)
+    returns the google.cloud.storage client shared by all the functions of this module
+    """
+    global _client
+    with _clientlock:
+        if _client is None:
+            _client = storage.Client()
+    return _client
 
-    Args:
-    ----
-        files: gs paths
-        location: to move the files to
-        group: files to do in parallel
+
+def _splitPath(path):
+    """
+    splits a gs://bucket/object path into (bucket, object)
+    """
+    if not path.startswith('gs://'):
+        raise ValueError('not a gs path: ' + path)
+    bucket, _, name = path[5:].partition('/')
+    return bucket, name
+
+
+def _toRegex(pattern):
+    """
+    translates a gsutil wildcard (*, **, ?) into a regex on object names
     """
-    by = len(files) if len(files) < group else group
-    for sfiles in h.grouped(files, by):
-        a = ''
-        for val in sfiles:
-            a += val + ' '
-        code = os.system("gsutil -m mv " + a + location)
-        if code != 0 and listen_to_errors:
-            print('pressed ctrl+c or command failed')
-            break
+    return re.compile(''.join(['.*' if tok == '**' else '[^/]*' if tok == '*' else '[^/]' if tok == '?' else
+                               re.escape(tok) for tok in re.split(r'(\*\*|\*|\?)', pattern)]) + '$')
+
+
+def _listObjects(path, recursive=False):
+    """
+    lists the objects (and "folders" if not recursive) a gs path refers to, as gsutil ls would
+
+    Returns:
+    -------
+        (list[Blob], list[str]) the objects and the "folder" paths
+    """
+    client = getClient()
+    bucket, name = _splitPath(path)
+    if re.search(r'[*?]', name):
+        prefix = re.split(r'[*?]', name)[0]
+        regex = _toRegex(name)
+        blobs = [b for b in client.list_blobs(bucket, prefix=prefix) if regex.match(b.name)]
+        return blobs, []
+    if name and not name.endswith('/'):
+        blob = client.bucket(bucket).get_blob(name)
+        if blob is not None:
+            return [blob], []
+        name += '/'
+    it = client.list_blobs(bucket, prefix=name, delimiter=None if recursive else '/')
+    blobs = list(it)
+    return blobs, ['gs://' + bucket + '/' + p for p in getattr(it, 'prefixes', [])]
+
+
+def _formatBlob(blob, add=''):
+    """
+    formats an object as a line/block of gsutil ls -l/-a/-L (so extractSize, extractPath, extractHash still work)
+    """
+    path = 'gs://' + blob.bucket.name + '/' + blob.name
+    if 'a' in add:
+        path += '#' + str(blob.generation)
+    if 'L' in add:
+        return path + ':\n' + ''.join(['    {:<24}{}\n'.format(k + ':', v) for k, v in [
+            ('Creation time', blob.time_created), ('Update time', blob.updated),
+            ('Storage class', blob.storage_class), ('Content-Length', blob.size),
+            ('Content-Type', blob.content_type), ('Hash (crc32c)', blob.crc32c), ('Hash (md5)', blob.md5_hash),
+            ('Generation', blob.generation), ('Metageneration', blob.metageneration)]])
+    if 'l' in add:
+        line = '{:>10}  {}  {}'.format(blob.size, blob.updated.strftime('%Y-%m-%dT%H:%M:%SZ'), path)
+        return line + ('  metageneration=' + str(blob.metageneration) if 'a' in add else '')
+    return path
+
+
+def _flags(add):
+    """
+    the letters of gsutil like flags, e.g. 'lr' for '-l -r' or '-lr'
+    """
+    return ''.join(v[1:] for v in add.split() if v.startswith('-'))
 
 
 def lsFiles(files, add='', group=50):
     """
     list a set of files in parallel (when the set is huge)
 
+    accepts the gsutil wildcards (*, ** and ?)
+
     Args:
     ----
         files: gs paths
-        add: additional params to add
+        add: additional params to add (-r: recursive, -l: with size and date, -a: with generation,
+            -L: full metadata blocks)
         group: files to do in parallel
+
+    Returns:
+    -------
+        list[str] of the paths (or lines/blocks when -l/-a/-L is given)
     """
     print('listing files in gs')
-    by = len(files) if len(files) < group else group
+    flags = _flags(add)
+    recursive = 'r' in flags or 'R' in flags
+    flags = flags.replace('r', '').replace('R', '')
+    with ThreadPoolExecutor(max_workers=group) as pool:
+        listed = list(pool.map(lambda f: _listObjects(f, recursive), files))
     res = []
-    for sfiles in h.grouped(files, by):
-        a = ''
-        for val in sfiles:
-            a += val + ' '
-        data = subprocess.run("gsutil -m ls " + add + " " + a, capture_output=True, shell=True)
-        if data.returncode != 0:
-            if "One or more URLs matched no objects" not in str(data.stderr):
-                raise ValueError('issue with the command: ' + str(data.stderr))
-        if len(str(data.stdout)) < 4:
-            return 0
-        res += str(data.stdout)[2:-1].split('\\n')[:-1] if 'L' not in add else ['gs://' + i for i in str(data.stdout).split('\\ngs://')]
-        if "TOTAL:" in res[-1] and 'L' not in add:
-            res = res[:-1]
+    for blobs, folders in listed:
+        res += [_formatBlob(blob, flags) for blob in blobs] + folders
     return res
 
 
-def cpFiles(files, location, group=50):
+def _transfer(src, dest, move=False):
     """
-    copy a set of files in parallel (when the set is huge)
+    copies (server side rewrite, or upload/download for local paths) one file and deletes the source if move
+    """
+    client = getClient()
+    if not src.startswith('gs://'):
+        bucket, name = _splitPath(dest)
+        client.bucket(bucket).blob(name).upload_from_filename(src)
+        if move:
+            os.remove(src)
+        return
+    sbucket, sname = _splitPath(src)
+    source = client.bucket(sbucket).blob(sname)
+    if not dest.startswith('gs://'):
+        source.download_to_filename(dest)
+    else:
+        bucket, name = _splitPath(dest)
+        # rewrite handles large objects and changes of location/storage class in several calls
+        token, _, _ = client.bucket(bucket).blob(name).rewrite(source)
+        while token is not None:
+            token, _, _ = client.bucket(bucket).blob(name).rewrite(source, token=token)
+    if move:
+        source.delete()
+
+
+def _retry(func, retries, *args):
+    """
+    calls func(*args), retrying with exponential backoff on errors other than missing objects
+    """
+    for i in range(retries + 1):
+        try:
+            return func(*args)
+        except Exception as e:
+            if i == retries or type(e).__name__ == 'NotFound':
+                raise
+            time.sleep(2 ** i)
+
+
+def _isFolder(path):
+    """
+    whether a gs (or local) path is an existing folder, used as gsutil does to copy a file into it or to it
+    """
+    if not path.startswith('gs://'):
+        return os.path.isdir(path)
+    bucket, name = _splitPath(path)
+    return name == '' or len(list(getClient().list_blobs(bucket, prefix=name + '/', max_results=1))) > 0
+
+
+def _transferFiles(files, location, move, group, listen_to_errors, retries=0):
+    """
+    copies/moves files to a location with a thread pool (used by mvFiles and cpFiles)
+    """
+    if type(location) is list:
+        dests = location
+    elif len(files) == 1 and not location.endswith('/') and not _isFolder(location):
+        dests = [location]
+    else:
+        location = location if location.endswith('/') else location + '/'
+        dests = [location + f.split('/')[-1] for f in files]
+    errors = []
+    with ThreadPoolExecutor(max_workers=group) as pool:
+        futures = {pool.submit(_retry, _transfer, retries, src, dest, move): src for src, dest in zip(files, dests)}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print('could not ' + ('move ' if move else 'copy ') + futures[future] + ': ' +
+                      str(future.exception()))
+                errors.append((futures[future], future.exception()))
+                if listen_to_errors:
+                    for f in futures:
+                        f.cancel()
+                    break
+    return errors
+
+
+def mvFiles(files, location, group=50, listen_to_errors=False, retries=0):
+    """
+    move a set of files in parallel (when the set is huge)
 
     Args:
     ----
-        files: gs paths
-        location to copy
+        files: gs paths (or local paths to upload)
+        location: to move the files to (or a list of destination paths, one for each file)
         group: files to do in parallel
+        listen_to_errors: stop at the first error
+        retries: int times to retry a file on errors (other than a missing file)
+
+    Returns:
+    -------
+        list[(str, Exception)] the files that could not be moved
     """
-    by = len(files) if len(files) < group else group
-    for sfiles in h.grouped(files, by):
-        a = ''
-        for val in sfiles:
-            a += val + ' '
-        code = os.system("gsutil -m cp " + a + location)
-        if code != 0:
-            print('pressed ctrl+c or command failed')
-            break
+    return _transferFiles(files, location, True, group, listen_to_errors, retries)
 
 
-def catFiles(files, group=50, split=False, cut=False):
+def cpFiles(files, location, group=50, listen_to_errors=True, retries=0):
     """
     copy a set of files in parallel (when the set is huge)
 
+    Args:
+    ----
+        files: gs paths (or local paths to upload)
+        location to copy (a gs path or a local folder to download to, or a list of destination paths, one for each file)
+        group: files to do in parallel
+        listen_to_errors: stop at the first error
+        retries: int times to retry a file on errors (other than a missing file)
+
+    Returns:
+    -------
+        list[(str, Exception)] the files that could not be copied
+    """
+    return _transferFiles(files, location, False, group, listen_to_errors, retries)
+
+
+def _download(path):
+    """
+    downloads a gs file into memory
+    """
+    bucket, name = _splitPath(path)
+    return getClient().bucket(bucket).blob(name).download_as_bytes()
+
+
+def catFiles(files, group=50, split=False, cut=False, decode=True):
+    """
+    get the content of a set of files in parallel (when the set is huge)
+
     Args:
     ----
         files: gs paths
-        location to copy
         group: files to do in parallel
         cut: split all lines into chunks of size cut
         split: split lines by split e.g. \\n
+        decode: bool to get the content as text (else as bytes, e.g. for binary files)
+
+    Returns:
+    -------
+        list[str] the content of each file (list[bytes] if not decode, the text chunks/lines of all files if
+        cut or split)
     """
-    by = len(files) if len(files) < group else group
-    res = []
-    for i, sfiles in enumerate(h.grouped(files, by)):
-        print(i / (len(files) / by))
-        a = ''
-        for val in sfiles:
-            a += val + ' '
-        data = subprocess.run("gsutil -m cat " + a, capture_output=True, shell=True)
-        if data.returncode != 0:
-            if "One or more URLs matched no objects" not in str(data.stderr):
-                print(ValueError('issue with the command: ' + str(data.stderr)))
-                return res
-        if len(str(data.stdout)) < 4:
-            return 0
-        resa = str(data.stdout)[2:-1]
-        if cut:
-            res += [resa[i * cut:(i + 1) * cut] for i in range(int(len(resa) / cut))]
-        elif split:
-            res += resa.split(split)
-        else:
-            res += [resa]
-    return res
+    with ThreadPoolExecutor(max_workers=group) as pool:
+        res = list(pool.map(_download, files))
+    if not cut and not split:
+        return [val.decode() for val in res] if decode else res
+    res = ''.join([val.decode() for val in res])
+    if cut:
+        return [res[i * cut:(i + 1) * cut] for i in range(int(len(res) / cut))]
+    return res.split(split)
 
 
 def rmFiles(files, group=50, add='', dryrun=True):
     """
-    remove a set of files in parallel (when the set is huge)
+    remove a set of files in batches (when the set is huge)
 
     Args:
     ----
-        files: gs paths
-        group: number to do in parallel
-        add: additional gsutil cp params
-    """
-    by = len(files) if len(files) < group else group
-    for sfiles in h.grouped(files, by):
-        a = ''
-        for val in sfiles:
-            a += ' ' + val
-        if add:
-            add = ' ' + add
-        if dryrun:
-            print("gsutil -m rm" + add + a)
+        files: gs paths (accepts the gsutil wildcards)
+        group: number of deletes sent in each batch request (max 100)
+        add: additional gsutil rm params (-r to remove folders)
+        dryrun: only print the files that would be removed
+
+    Returns:
+    -------
+        list[str] the files that could not be removed
+    """
+    recursive = 'r' in _flags(add) or 'R' in _flags(add)
+    blobs = []
+    for f in files:
+        if recursive or re.search(r'[*?]', f):
+            blobs += _listObjects(f, recursive=True)[0]
         else:
-            code = os.system("gsutil -m rm" + add + a)
-            if code != 0:
-                print('pressed ctrl+c or command failed')
-                break
+            bucket, name = _splitPath(f)
+            blobs.append(getClient().bucket(bucket).blob(name))
+    if dryrun:
+        print("would remove: " + str(['gs://' + b.bucket.name + '/' + b.name for b in blobs]))
+        return []
+    errors = []
+    for sblobs in h.grouped(blobs, min(group, 100)):
+        try:
+            with getClient().batch():
+                for blob in sblobs:
+                    blob.delete()
+        except Exception:
+            # a batch fails as a whole, retry its files one by one to know which ones are the issue
+            for blob in sblobs:
+                try:
+                    blob.delete()
+                except Exception as e:
+                    if type(e).__name__ != 'NotFound':
+                        print('could not remove gs://' + blob.bucket.name + '/' + blob.name + ': ' + str(e))
+                        errors.append('gs://' + blob.bucket.name + '/' + blob.name)
+    return errors
 
 
 def recoverFiles(files):
@@ -238,7 +406,205 @@ def patternRN(rename_dict, location, wildcards, types=[], dryrun=True, check_dep
             h.parrun(cmd, cores=cores)
 
 
-def get_all_sizes(folder, suffix='*'):
+INVENTORY = os.path.expanduser('~/.gcp_inventory.db')
+
+
+def _openInventory(dbpath=INVENTORY):
+    """
+    opens (and creates if needed) the sqlite inventory of gs objects
+    """
+    db = sqlite3.connect(dbpath)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS objects (bucket TEXT, name TEXT, basename TEXT, rbasename TEXT, size INTEGER,
+            crc32c TEXT, md5 TEXT, generation INTEGER, updated TEXT, PRIMARY KEY (bucket, name));
+        CREATE INDEX IF NOT EXISTS objects_size ON objects (size, crc32c);
+        CREATE INDEX IF NOT EXISTS objects_basename ON objects (basename);
+        CREATE INDEX IF NOT EXISTS objects_rbasename ON objects (rbasename);
+        CREATE TABLE IF NOT EXISTS listings (bucket TEXT, prefix TEXT, listed REAL, PRIMARY KEY (bucket, prefix));
+    """)
+    return db
+
+
+def _globEscape(val):
+    """
+    escapes the sqlite GLOB wildcards of a string
+    """
+    return re.sub(r'([*?\[])', r'[\1]', val)
+
+
+def _folderPrefix(folder):
+    """
+    splits a gs folder (or bucket) path into (bucket, prefix), the prefix ending with / if not empty
+    """
+    bucket, prefix = _splitPath(folder)
+    return bucket, prefix if prefix == '' or prefix.endswith('/') else prefix + '/'
+
+
+def _listPrefix(bucket, prefix):
+    """
+    lists all the objects under a prefix, page by page (used by updateInventory)
+    """
+    rows = []
+    for blob in getClient().list_blobs(bucket, prefix=prefix, page_size=1000):
+        base = blob.name.split('/')[-1]
+        rows.append((bucket, blob.name, base, base[::-1], blob.size, blob.crc32c, blob.md5_hash, blob.generation,
+                     blob.updated.isoformat() if blob.updated is not None else None))
+    return rows
+
+
+def updateInventory(folders, dbpath=INVENTORY, maxage=0, cores=8):
+    """
+    lists gs folders into a local sqlite inventory (path, size, crc32c, md5, generation, update time)
+
+    only the given folders are listed again: the rows under each of their prefix are replaced by the new listing
+
+    Args:
+    ----
+        folders: list[str] gs folders (or buckets) to list
+        dbpath: str filepath to the sqlite inventory
+        maxage: float do not list again folders (or their parent folders) listed less than maxage seconds ago
+        cores: int folders listed in parallel
+
+    Returns:
+    -------
+        int number of objects listed
+    """
+    if type(folders) is str:
+        folders = [folders]
+    db = _openInventory(dbpath)
+    todo = []
+    for folder in folders:
+        bucket, prefix = _folderPrefix(folder)
+        if maxage > 0:
+            listed = db.execute("SELECT MAX(listed) FROM listings WHERE bucket = ? AND substr(?, 1, length(prefix)) = prefix",
+                                (bucket, prefix)).fetchone()[0]
+            if listed is not None and time.time() - listed < maxage:
+                continue
+        todo.append((bucket, prefix))
+    n = 0
+    with ThreadPoolExecutor(max_workers=cores) as pool:
+        for (bucket, prefix), rows in zip(todo, pool.map(lambda v: _listPrefix(*v), todo)):
+            with db:
+                db.execute("DELETE FROM objects WHERE bucket = ? AND name GLOB ?", (bucket, _globEscape(prefix) + '*'))
+                db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                db.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)", (bucket, prefix, time.time()))
+            n += len(rows)
+    db.close()
+    return n
+
+
+def queryInventory(folder=None, suffix=None, minsize=None, dbpath=INVENTORY, where='', params=()):
+    """
+    gets the objects of the local inventory under a gs folder (see updateInventory)
+
+    Args:
+    ----
+        folder: str gs folder (or bucket) to look into (default: all the inventory)
+        suffix: str only files ending with it (e.g. bam)
+        minsize: int only files of at least this many bytes
+        dbpath: str filepath to the sqlite inventory
+        where: str additional sql condition on the objects table
+        params: tuple parameters of the additional condition
+
+    Returns:
+    -------
+        pd.df with path, size, crc32c, md5, generation, updated columns
+    """
+    cond, args = [], []
+    if folder is not None:
+        bucket, prefix = _folderPrefix(folder)
+        cond.append("bucket = ? AND name GLOB ?")
+        args += [bucket, _globEscape(prefix) + '*']
+    if suffix is not None and suffix != '*':
+        cond.append("rbasename GLOB ?")
+        args.append(_globEscape(suffix[::-1]) + '*')
+    if minsize is not None:
+        cond.append("size >= ?")
+        args.append(minsize)
+    if where:
+        cond.append(where)
+        args += list(params)
+    db = _openInventory(dbpath)
+    res = pd.read_sql_query("SELECT 'gs://' || bucket || '/' || name AS path, size, crc32c, md5, generation, updated "
+                            "FROM objects" + (" WHERE " + " AND ".join(cond) if cond else ""), db, params=args)
+    db.close()
+    return res
+
+
+def heaviestFiles(folder=None, n=100, minsize=0, dbpath=INVENTORY):
+    """
+    ranks the biggest files of the local inventory (see updateInventory)
+
+    Args:
+    ----
+        folder: str gs folder (or bucket) to look into (default: all the inventory)
+        n: int number of files to return
+        minsize: int only files of at least this many bytes
+        dbpath: str filepath to the sqlite inventory
+
+    Returns:
+    -------
+        pd.df with path, size, crc32c, md5, generation, updated columns, sorted by decreasing size
+    """
+    return queryInventory(folder, minsize=minsize, dbpath=dbpath).sort_values('size', ascending=False).head(n)
+
+
+def sizeDuplicates(folder=None, suffix=None, dbpath=INVENTORY):
+    """
+    finds the files of the local inventory having the same size as another one (see updateInventory)
+
+    Args:
+    ----
+        folder: str gs folder (or bucket) to look into (default: all the inventory)
+        suffix: str only files ending with it (e.g. bai)
+        dbpath: str filepath to the sqlite inventory
+
+    Returns:
+    -------
+        dict(size: [paths]) for each size shared by more than one file
+    """
+    res = queryInventory(folder, suffix, dbpath=dbpath)
+    res = res[res['size'].duplicated(keep=False)]
+    return res.groupby('size')['path'].apply(list).to_dict()
+
+
+def searchInventory(names, lookup=['**', '*.', '.*'], folder=None, dbpath=INVENTORY):
+    """
+    finds files by name in the local inventory (see updateInventory)
+
+    Args:
+    ----
+        names: list[str] of filenames to find
+        lookup: list[str] a set of flags giving how to look
+            [** through all folders (else only at the root of buckets), *. can be preprended with anything,
+            .* can be appended with anything]
+        folder: str gs folder (or bucket) to look into (default: all the inventory)
+        dbpath: str filepath to the sqlite inventory
+
+    Returns:
+    -------
+        list[str] the gs paths found
+    """
+    if type(names) is str:
+        names = [names]
+    res = []
+    for name in names:
+        if '*.' in lookup and '.*' in lookup:
+            where, val = "basename GLOB ?", '*' + _globEscape(name) + '*'
+        elif '*.' in lookup:
+            # suffix search on the indexed reversed names
+            where, val = "rbasename GLOB ?", _globEscape(name[::-1]) + '*'
+        elif '.*' in lookup:
+            where, val = "basename GLOB ?", _globEscape(name) + '*'
+        else:
+            where, val = "basename = ?", name
+        if '**' not in lookup:
+            where += " AND name = basename"
+        res += queryInventory(folder, dbpath=dbpath, where=where, params=(val,))['path'].tolist()
+    return res
+
+
+def get_all_sizes(folder, suffix='*', dbpath=INVENTORY, maxage=0):
     """
 
     will sort and list all the files by their sizes. 
@@ -248,36 +614,132 @@ def get_all_sizes(folder, suffix='*'):
     Args:
     ----
             folder: gs folder path
-            suffix: of a specific file type
+            suffix: of a specific file type (the file extension, e.g. bam matches x.bam but not x_nobam, '*' for all)
+            dbpath: str filepath to the sqlite inventory the listing is stored in
+            maxage: float reuse the inventory if the folder was listed less than maxage seconds ago
 
     Returns:
     -------
             dict(sizes:[paths])
     """
-    samples = os.popen('gsutil -m ls -al ' + folder + '**.' + suffix).read().split('\n')
-    # compute size filepath
-    sizes = {'gs://' + val.split('gs://')[1].split('#')[0]: int(re.split("\d{4}-\d{2}-\d{2}", val)[0]) for val in samples[:-2]}
-    names = {}
-    for k, val in sizes.items():
-        if val in names:
-            names[val].append(k)
-        else:
-            names[val] = [k]
+    updateInventory([folder], dbpath, maxage)
+    res = queryInventory(folder, None if suffix == '*' else '.' + suffix, dbpath=dbpath)
+    names = res.groupby('size')['path'].apply(list).to_dict()
     if names == {}:
         # we didn't find any valid file paths
         print("We didn't find any valid file paths in folder: " + str(folder))
     return names
 
 
+def hashDuplicates(folders=None, suffix=None, minsize=1, dbpath=INVENTORY):
+    """
+    groups the objects of the local inventory having the same content, by (size, crc32c, md5) (see updateInventory)
+
+    objects without a md5 (composite uploads) are matched on (size, crc32c) unless their group has conflicting md5s
+
+    Args:
+    ----
+        folders: list[str] gs folders (or buckets) to look into (default: all the inventory)
+        suffix: str only files ending with it (e.g. bam)
+        minsize: int only files of at least this many bytes (default skips empty files)
+        dbpath: str filepath to the sqlite inventory
+
+    Returns:
+    -------
+        pd.df with path, size, crc32c, md5, generation, updated, cluster columns, one row per
+        duplicated object, sorted by cluster
+    """
+    if folders is None or type(folders) is str:
+        folders = [folders]
+    res = pd.concat([queryInventory(f, suffix, minsize, dbpath) for f in folders]).drop_duplicates('path')
+    res = res[res['crc32c'].notna()]
+    # only same size files can be duplicates, dropping the others first keeps the grouping small
+    res = res[res['size'].duplicated(keep=False)]
+    md5 = res['md5'].where(res.groupby(['size', 'crc32c'])['md5'].transform('nunique') > 1, '').fillna('')
+    res = res.assign(cluster=res.groupby([res['size'], res['crc32c'], md5]).ngroup())
+    res = res[res['cluster'].duplicated(keep=False)]
+    return res.sort_values(['cluster', 'path']).reset_index(drop=True)
+
+
+def planDedup(duplicates, protect=set(), prefer=[]):
+    """
+    plans the minimal set of deletions removing the duplicated objects found by hashDuplicates
+
+    each cluster keeps all its protected copies or, if it has none, one copy (the first one in a preferred
+    location, else the oldest one)
+
+    Args:
+    ----
+        duplicates: pd.df as returned by hashDuplicates
+        protect: set[str] paths that need to stay (e.g. the ones used in terra data tables)
+        prefer: list[str] gs folders where to keep copies in priority, by decreasing priority
+
+    Returns:
+    -------
+        pd.df of duplicates with an action column (keep|delete) and a kept column (a kept copy of
+        the same content)
+    """
+    plan = duplicates.copy()
+    rank = pd.Series(len(prefer), index=plan.index)
+    for i, loc in reversed(list(enumerate(prefer))):
+        rank[plan['path'].str.startswith(loc if loc.endswith('/') else loc + '/')] = i
+    plan['protected'] = plan['path'].isin(protect)
+    order = plan.assign(rank=rank).sort_values(['cluster', 'protected', 'rank', 'updated'],
+                                                ascending=[True, False, True, True])
+    keep = order['protected'] | ~order['cluster'].duplicated()
+    plan['action'] = np.where(keep.reindex(plan.index), 'keep', 'delete')
+    first = order[keep].drop_duplicates('cluster').set_index('cluster')['path']
+    plan['kept'] = plan['cluster'].map(first)
+    return plan.drop(columns='protected')
+
+
+def applyDedupPlan(plan, dryrun=True, group=50):
+    """
+    deletes the duplicates of a plan made by planDedup (see rmFiles)
+
+    Args:
+    ----
+        plan: pd.df as returned by planDedup
+        dryrun: only print the files that would be removed
+        group: number of deletes sent in each batch request (max 100)
+
+    Returns:
+    -------
+        list[str] the files that could not be removed
+    """
+    torm = plan[plan['action'] == 'delete']
+    print('removing ' + str(len(torm)) + ' duplicates, ' + str(torm['size'].sum() / 1000000000) + 'GB')
+    return rmFiles(torm['path'].tolist(), group=group, dryrun=dryrun)
+
+
+def getHashes(files, group=50):
+    """
+    gets the crc32c of a set of gs files in parallel (the missing ones are not returned)
+
+    Args:
+    ----
+        files: gs paths
+        group: files to do in parallel
+
+    Returns:
+    -------
+        dict(path: crc32c)
+    """
+    return {extractPath(val.split(':\n')[0]): extractHash(val) for val in lsFiles(files, '-L', group)}
+
+
 def exists(val):
     """
     tells if a gcp path exists
     """
     if type(val) is str:
-        return os.popen('gsutil ls ' + val).read().split('\n')[0] == val
+        bucket, name = _splitPath(val)
+        return getClient().bucket(bucket).get_blob(name) is not None
     elif type(val) is list:
-        rest = set(val) - set(lsFiles(val))
-        return len(rest)==0 , rest
+        with ThreadPoolExecutor(max_workers=50) as pool:
+            found = list(pool.map(exists, val))
+        rest = set([v for v, f in zip(val, found) if not f])
+        return len(rest) == 0, rest
 
 
 def extractSize(val):
@@ -306,4 +768,4 @@ def extractHash(val):
     extract the crc32 from the string returned by an ls -L command
     """
     if '    Hash (crc32c):' in val:
-        return val.split('    Hash (crc32c):          ')[-1].split('\\\\n')[0].split('\\n')[0]
+        return val.split('    Hash (crc32c):          ')[-1].split('\\\\n')[0].split('\\n')[0].split('\n')[0]
@@ -0,0 +1,95 @@
+from JKBio.google import gcp
+import pytest
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeBlob:
+    def __init__(self, client, bucket, name):
+        self.client = client
+        self.bucket = client.bucket(bucket)
+        self.name = name
+
+    def delete(self):
+        if self.client.batched is not None:
+            self.client.batched.append(self)
+            return
+        path = 'gs://' + self.bucket.name + '/' + self.name
+        if path in self.client.denied:
+            raise PermissionError('403 forbidden')
+        if path not in self.client.files:
+            raise NotFound(path)
+        self.client.files.remove(path)
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self.client, self.name, name)
+
+
+class FakeClient:
+    """
+    deletes inside a batch are sent when it exits, and the batch raises if any of them failed
+    """
+    def __init__(self, files, denied=()):
+        self.files = set(files)
+        self.denied = set(denied)
+        self.batched = None
+        self.batches = 0
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def batch(self):
+        client = self
+
+        class Batch:
+            def __enter__(self):
+                client.batched = []
+
+            def __exit__(self, *args):
+                blobs, client.batched = client.batched, None
+                client.batches += 1
+                errors = []
+                for blob in blobs:
+                    try:
+                        blob.delete()
+                    except Exception as e:
+                        errors.append(e)
+                if errors:
+                    raise errors[0]
+        return Batch()
+
+
+@pytest.fixture()
+def files():
+    return ['gs://b/f%d.bam' % i for i in range(7)]
+
+
+def test_rmfiles_batches(monkeypatch, files):
+    client = FakeClient(files)
+    monkeypatch.setattr(gcp, 'getClient', lambda: client)
+    assert gcp.rmFiles(files, group=3, dryrun=False) == []
+    assert client.files == set()
+    assert client.batches == 3
+
+
+def test_rmfiles_batch_fallback(monkeypatch, files):
+    # a failing batch is retried file by file: already removed files are fine, the others are returned
+    client = FakeClient(files, denied=[files[4]])
+    monkeypatch.setattr(gcp, 'getClient', lambda: client)
+    assert gcp.rmFiles(files + ['gs://b/missing.bam'], group=3, dryrun=False) == [files[4]]
+    assert client.files == {files[4]}
+
+
+def test_rmfiles_dryrun(monkeypatch, files):
+    client = FakeClient(files)
+    monkeypatch.setattr(gcp, 'getClient', lambda: client)
+    assert gcp.rmFiles(files, dryrun=True) == []
+    assert client.files == set(files)
@@ -8,21 +8,213 @@ import pandas as pd
 import numpy as np
 from JKBio.utils import helper as h
 import gzip
+import hashlib
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import re
+import pysam
+from scipy.sparse import coo_matrix
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import seaborn as sns
 
 from taigapy import TaigaClient
 tc = TaigaClient()
 
-def vcf_to_df(path, hasfilter=False, samples=['sample'], additional_cols=[]):
+VCF_COLS = ['chr', 'pos', 'id', 'ref', 'alt', 'qual']
+
+RESCUE_LIST = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'variantFilter',
+                           'snp_indels_rescue_list.txt')
+_rescuelists = {}
+
+
+def read_vcf_header(path):
+    """
+    reads the header of a vcf file
+
+    Args:
+    -----
+      path: str filepath to the vcf file (can be gzipped)
+
+    Returns:
+    --------
+      info: dict(ID: (Number, Type, Description)) of the INFO fields
+      formats: dict(ID: (Number, Type, Description)) of the FORMAT fields
+      samples: list[str] the sample names given in the #CHROM line
+    """
+    regex = re.compile(r'##(INFO|FORMAT)=<ID=([^,]+),Number=([^,]+),Type=([^,]+),Description="(.*)"')
+    info = {}
+    formats = {}
+    samples = []
+    with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as f:
+        for l in f:
+            if l.startswith('##'):
+                field = regex.match(l)
+                if field is not None:
+                    (info if field.group(1) == 'INFO' else formats)[field.group(2)] = field.group(3, 4, 5)
+            else:
+                if l.startswith('#CHROM'):
+                    samples = l.rstrip('\n').split('\t')[9:]
+                break
+    return info, formats, samples
+
+
+def _typeVCFfield(values, number, vtype):
+    """
+    casts a column of vcf values given its header Number and Type (used by vcf_chunks)
+    """
+    if number == '1' and vtype in ('Integer', 'Float'):
+        return pd.to_numeric(values, errors='coerce')
+    return values
+
+
+def _vcfFormatCol(sample, k, samples, infotypes):
+    """
+    colname of a FORMAT field of a sample, prefixed with the sample name if there is more than one sample or if an
+    INFO field has the same ID (used by vcf_chunks)
+    """
+    return sample + '_' + k if len(samples) > 1 or k in infotypes else k
+
+
+def _vcfValue(v):
+    """
+    writes a value read by pysam as in the vcf text (floats are stored as float32 in bcf records)
+    """
+    if type(v) is tuple:
+        return ','.join('.' if i is None else str(_vcfValue(i)) for i in v)
+    if type(v) is float:
+        return str(np.float32(v))
+    return v
+
+
+def vcf_chunks(path, chunksize=100000, info=None, formats=None, samples=None, hasfilter=True, region=None,
+               flags=[]):
+    """
+    reads a vcf file chunk by chunk, only parsing the requested INFO and FORMAT fields
+
+    if a region is given, the vcf needs to be bgzipped and tabix indexed and only this region is read (with pysam)
+
+    Args:
+    -----
+      path: str filepath to the vcf file
+      chunksize: int number of records in each chunk
+      info: list[str] the INFO fields to parse (defaults to all the ones in the header)
+      formats: list[str] the FORMAT fields to parse (defaults to all the ones in the header)
+      samples: list[str] colnames of the sample names (defaults to the ones in the header)
+      hasfilter: bool whether or not the vcf has a filter column (else it is named strand)
+      region: str a region to query e.g. 'chr1:10000-20000'
+      flags: list[str] INFO fields to parse as flags even if the header does not say so
+
+    Yields:
+    -------
+      a dataframe for each chunk of the vcf, with one column per INFO field and per sample x FORMAT field
+      (prefixed with the sample name if there is more than one sample or if an INFO field has the same ID)
+    """
+    infos, formatdescs, headsamples = read_vcf_header(path)
+    samples = headsamples if samples is None else samples
+    info = list(infos.keys()) if info is None else info
+    formats = list(formatdescs.keys()) if formats is None else formats
+    infotypes = {k: ('0', 'Flag') if k in flags else infos.get(k, ('.', 'String'))[:2] for k in info}
+    formattypes = {k: formatdescs.get(k, ('.', 'String'))[:2] for k in formats}
+    names = VCF_COLS + (['filter'] if hasfilter else ['strand'])
+    if region is not None:
+        for chunk in _vcf_region_chunks(path, region, chunksize, infotypes, formattypes, samples, names):
+            yield chunk
+        return
+    reader = pd.read_csv(path, sep='\t', comment='#', header=None, names=names + ['data', 'format'] + samples,
+                         dtype=str, index_col=False, chunksize=chunksize)
+    for a in reader:
+        a['pos'] = a['pos'].astype(np.int64)
+        a['qual'] = pd.to_numeric(a['qual'], errors='coerce')
+        res = [a[names]]
+        data = a['data'].fillna('')
+        fields = {}
+        for k, (number, vtype) in infotypes.items():
+            if vtype == 'Flag':
+                fields[k] = data.str.contains('(?:^|;)' + re.escape(k) + '(?:;|$)')
+            else:
+                fields[k] = _typeVCFfield(data.str.extract('(?:^|;)' + re.escape(k) + '=([^;]*)', expand=False),
+                                          number, vtype)
+        res.append(pd.DataFrame(fields, index=a.index))
+        for sample in samples:
+            fields = {}
+            # rows sharing the same FORMAT are split at once
+            for fmt, rows in a.groupby('format').groups.items():
+                keys = fmt.split(':')
+                values = a.loc[rows, sample].str.split(':', expand=True)
+                for k in formats:
+                    if k in keys and keys.index(k) < values.shape[1]:
+                        fields.setdefault(k, []).append(values[keys.index(k)])
+            fields = {_vcfFormatCol(sample, k, samples, infotypes):
+                      _typeVCFfield(pd.concat(v).reindex(a.index), *formattypes[k]) for k, v in fields.items()}
+            res.append(pd.DataFrame(fields, index=a.index))
+        yield pd.concat(res, axis=1)
+
+
+def _vcf_region_chunks(path, region, chunksize, infotypes, formattypes, samples, names):
+    """
+    reads a region of an indexed vcf with pysam (used by vcf_chunks)
+
+    as in the text mode, samples are the names given to the sample columns of the vcf, in order
+    """
+    vcf = pysam.VariantFile(path)
+    rows = []
+    for rec in vcf.fetch(region=region):
+        row = [rec.chrom, rec.pos, rec.id or '.', rec.ref, ','.join(rec.alts) if rec.alts else '.',
+               None if rec.qual is None else _vcfValue(rec.qual), ';'.join(rec.filter.keys()) or '.']
+        row += [k in rec.info if vtype == 'Flag' else _vcfValue(rec.info.get(k)) for k, (_, vtype) in infotypes.items()]
+        for i in range(len(samples)):
+            call = rec.samples[i]
+            for k in formattypes:
+                if k not in rec.format:
+                    row.append(None)
+                elif k == 'GT':
+                    gt = call.get(k)
+                    row.append(None if gt is None else ('|' if call.phased else '/').join(
+                        '.' if a is None else str(a) for a in gt))
+                else:
+                    row.append(_vcfValue(call.get(k)))
+        rows.append(row)
+        if len(rows) == chunksize:
+            yield _typeVCFchunk(rows, infotypes, formattypes, samples, names)
+            rows = []
+    if rows:
+        yield _typeVCFchunk(rows, infotypes, formattypes, samples, names)
+
+
+def _typeVCFchunk(rows, infotypes, formattypes, samples, names):
+    """
+    builds a typed dataframe from records read by pysam (used by vcf_chunks)
+    """
+    cols = names + list(infotypes.keys())
+    cols += [_vcfFormatCol(sample, k, samples, infotypes) for sample in samples for k in formattypes]
+    a = pd.DataFrame(rows, columns=cols)
+    a['qual'] = pd.to_numeric(a['qual'], errors='coerce')
+    for k, (number, vtype) in infotypes.items():
+        a[k] = _typeVCFfield(a[k], number, vtype)
+    for sample in samples:
+        for k, (number, vtype) in formattypes.items():
+            col = _vcfFormatCol(sample, k, samples, infotypes)
+            a[col] = _typeVCFfield(a[col], number, vtype)
+    return a
+
+
+def vcf_to_df(path, hasfilter=False, samples=['sample'], additional_cols=[], chunksize=100000, region=None):
     """
     transforms a vcf file into a dataframe file as best as it can
 
+    reads the vcf in chunks (see vcf_chunks)
+
     Args:
     -----
       path: str filepath to the vcf file
       hasfilter: bool whether or not the vcf has a filter column
       samples: list[str] colnames of the sample names.
       additional_cols: list[str] of additional colnames in the vcf already looks for 'DB', 'SOMATIC', 'GERMLINE', "OVERLAP", "IN_PON", "STR", "ReverseComplementedAlleles"
+      chunksize: int number of records parsed at once
+      region: str if the vcf is tabix indexed, only reads this region e.g. 'chr1:10000-20000'
 
     Returns:
     --------
@@ -31,88 +223,353 @@ def vcf_to_df(path, hasfilter=False, samples=['sample'], additional_cols=[]):
     """
     uniqueargs = ['DB', 'SOMATIC', 'GERMLINE', "OVERLAP", "IN_PON",
                   "STR", "ReverseComplementedAlleles"] + additional_cols
-
-    def read_comments(f):
-        fields = {}
-        description = {}
-        for l in f:
-            l = l.decode("utf-8") if type(l) is not str else l
-            if l.startswith('##'):
-                if 'FORMAT' in l[:20]:
-                    res = l.split('ID=')[1].split(',')[0]
-                    desc = l.split('Description=')[1][:-2]
-                    description.update({res: desc})
-                if 'INFO' in l[:20]:
-                    res = l.split('ID=')[1].split(',')[0]
-                    desc = l.split('Description=')[1][:-2]
-                    description.update({res: desc})
-                    fields.update({res: []})
-            else:
-                break
-        return fields, description
-    if path.endswith('.gz'):
-        with gzip.open(path, 'r') as f:
-            fields, description = read_comments(f)
-    else:
-        with open(path, 'r') as f:
-            fields, description = read_comments(f)
-    names = ['chr', 'pos', 'id', 'ref', 'alt', 'qual']
-    names += ['filter'] if hasfilter else ['strand']
-    names += ['data', 'format'] + samples
-    a = pd.read_csv(path, sep='\t', comment="#", header=None,
-                    names=names, index_col=False)
+    info, formats, _ = read_vcf_header(path)
+    description = {k: v[2] for k, v in formats.items()}
+    description.update({k: v[2] for k, v in info.items()})
     print(description)
-    try:
-        for j, val in enumerate(a.data.str.split(';').values.tolist()):
-            res = dict([(v, True) if v in uniqueargs else tuple(
-                v.split('=')) for v in val])
-            for k in fields.keys():
-                fields[k].append(res.get(k, None))
-    except ValueError:
-        print(val)
-        raise ValueError('unknown field')
-    a = pd.concat([a.drop(columns='data'), pd.DataFrame(
-        data=fields, index=a.index)], axis=1)
-    for sample in samples:
-        sorting = a.format[0].split(':')
-        res = a[sample].str.split(':').values.tolist()
-        maxcols = max([len(v) for v in res])
-        if maxcols - len(sorting) > 0:
-            for i in range(maxcols - len(sorting)):
-                sorting.append(sorting[-1] + '_' + str(i + 1))
-        if len(samples) > 1:
-            sorting = [sample + '_' + v for v in sorting]
-        a = pd.concat([a.drop(columns=sample), pd.DataFrame(
-            data=res, columns=sorting, index=a.index)], axis=1)
-    return a.drop(columns='format'), description
+    chunks = list(vcf_chunks(path, chunksize=chunksize, samples=samples, hasfilter=hasfilter, region=region,
+                             flags=uniqueargs))
+    return pd.concat(chunks) if len(chunks) > 0 else pd.DataFrame(), description
+
+
+def _factorize(values):
+  """
+  pd.factorize with the missing values as an additional last unique value, that their code (-1) points to
+  """
+  codes, uniques = pd.factorize(values)
+  return codes, np.append(np.asarray(uniques, dtype=object), np.nan)
+
+
+def _hashValues(values, clean):
+  """
+  hashes an array of strings, cleaning and hashing only its unique values (used by _variantHashes)
+  """
+  codes, uniques = _factorize(values)
+  uniques = clean(pd.Series(np.asarray(uniques, dtype=object)).fillna('').astype(str))
+  return pd.util.hash_array(np.asarray(uniques, dtype=object))[codes]
+
+
+def _strLengths(values):
+  """
+  length of each string of an array, computed on its unique values (used by _variantHashes)
+  """
+  codes, uniques = _factorize(values)
+  return np.array([len(v) if isinstance(v, str) else 0 for v in uniques], dtype=np.int64)[codes]
+
+
+def _variantHashes(chrom, pos, ref, alt, vcf=False):
+  """
+  hashes (chrom, pos, ref, alt) into one uint64 per variant (used by the rescue list filters)
+
+  chromosomes are compared without their 'chr' prefix and missing alleles as '-'. vcf indels
+  (written with their anchor base) are first converted to the maf representation.
+  """
+  pos = np.asarray(pos, dtype=np.int64).copy()
+  if vcf:
+    ref = np.asarray(ref, dtype=object).copy()
+    alt = np.asarray(alt, dtype=object).copy()
+    reflen, altlen = _strLengths(ref), _strLengths(alt)
+    anchored = np.where(reflen != altlen)[0]
+    anchored = anchored[[r[:1] == a[:1] for r, a in zip(ref[anchored], alt[anchored])]]
+    # deletions start after the anchor base, insertions stay on it
+    pos[anchored[reflen[anchored] > altlen[anchored]]] += 1
+    ref[anchored] = [r[1:] for r in ref[anchored]]
+    alt[anchored] = [a[1:] for a in alt[anchored]]
+  allele = lambda v: v.replace('', '-')
+  keys = _hashValues(chrom, lambda v: v.str.replace('^chr', '', regex=True))
+  for val in [pd.util.hash_array(pos), _hashValues(ref, allele), _hashValues(alt, allele)]:
+    keys = pd.util.hash_array(keys ^ val)
+  return keys
+
+
+def loadRescueList(filename=RESCUE_LIST, Chromosome='Chromosome', Start_position='Start_position',
+                   ref='ref_allele', alt='newbase'):
+  """
+  loads a rescue list of variants once into a sorted array of (chrom, pos, ref, alt) hashes
+
+  the result is cached so that filtering many mafs/vcf chunks reads the file only once
+
+  Args:
+  -----
+    filename: str filepath to a tab separated rescue list (defaults to data/variantFilter/snp_indels_rescue_list.txt)
+    Chromosome: str colname of the chromosomes
+    Start_position: str colname of the positions
+    ref: str colname of the reference alleles
+    alt: str colname of the alternate alleles
+
+  Returns:
+  --------
+    pd.Index of the unique uint64 hashes (hash table backed lookups)
+  """
+  if filename not in _rescuelists:
+    rescue = pd.read_csv(filename, sep='\t', dtype={Chromosome: str})
+    _rescuelists[filename] = pd.Index(np.unique(_variantHashes(rescue[Chromosome], rescue[Start_position],
+                                                                rescue[ref], rescue[alt])))
+  return _rescuelists[filename]
+
+
+def inRescueList(data, rescuelist=RESCUE_LIST, vcf=False, Chromosome='Chromosome', Start_position='Start_position',
+                 Reference_Allele='Reference_Allele', Tumor_Allele='Tumor_Seq_Allele2'):
+  """
+  finds which variants of a maf or vcf dataframe are in the rescue list (works with multiple sample file)
+
+  Args:
+  -----
+    data: dataframe of the maf file or a chunk from vcf_chunks/vcf_to_df
+    rescuelist: str filepath to the rescue list or pd.Index from loadRescueList
+    vcf: bool whether data comes from a vcf (uses the chr/pos/ref/alt columns, multiallelic sites
+      match if any of their alt does)
+    Chromosome: str colname of the chromosomes in the maf
+    Start_position: str colname of the positions in the maf
+    Reference_Allele: str colname of the reference alleles in the maf
+    Tumor_Allele: str colname of the alternate alleles in the maf
+
+  Returns:
+  --------
+    np.array[bool] True for the variants in the rescue list
+  """
+  hashes = loadRescueList(rescuelist) if isinstance(rescuelist, str) else rescuelist
+  if len(data) == 0 or len(hashes) == 0:
+    return np.zeros(len(data), dtype=bool)
+  if vcf:
+    # multiallelic sites are split on the unique alt values and then repeated for each of their rows
+    codes, uniques = _factorize(data['alt'])
+    alleles = [str(v).split(',') if isinstance(v, str) else [''] for v in uniques]
+    nalleles = np.array([len(v) for v in alleles])
+    offsets = np.concatenate([[0], np.cumsum(nalleles)[:-1]])
+    counts = nalleles[codes]
+    rows = np.repeat(np.arange(len(data)), counts)
+    which = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    alt = np.array([a for v in alleles for a in v], dtype=object)[offsets[codes[rows]] + which]
+    keys = _variantHashes(data['chr'].values[rows], data['pos'].values[rows], data['ref'].values[rows],
+                          alt, vcf=True)
+  else:
+    rows = np.arange(len(data))
+    keys = _variantHashes(data[Chromosome], data[Start_position], data[Reference_Allele], data[Tumor_Allele])
+  return np.bincount(rows[hashes.get_indexer(keys) >= 0], minlength=len(data)) > 0
 
 
+def filterRescueList(data, rescuelist=RESCUE_LIST, keep=True, vcf=False, **kwargs):
+  """
+  filters a maf, or a stream of vcf chunks, on the rescue list (works with multiple sample file)
+
+  Args:
+  -----
+    data: dataframe of the maf file / vcf or an iterable of dataframes (e.g. vcf_chunks(path))
+    rescuelist: str filepath to the rescue list or pd.Index from loadRescueList
+    keep: bool whether to keep only the rescued variants (True) or to remove them (False)
+    vcf: bool whether data comes from a vcf
+    **kwargs: colnames given to inRescueList
+
+  Returns:
+  --------
+    the filtered dataframe, or a generator of filtered dataframes if data was an iterable
+  """
+  hashes = loadRescueList(rescuelist) if isinstance(rescuelist, str) else rescuelist
+  if isinstance(data, pd.DataFrame):
+    return data[inRescueList(data, hashes, vcf, **kwargs) == keep]
+  return (chunk[inRescueList(chunk, hashes, vcf, **kwargs) == keep] for chunk in data)
+
 
-def mafToMat(maf, boolify=False, freqcol='tumor_f', samplesCol="DepMap_ID", mutNameCol="Hugo_Symbol"):
+def _mafPartitioning(Chromosome="Chromosome"):
+  """
+  the hive partitioning of a Parquet maf store: Chromosome=X/sample_batch=N/
+  """
+  return ds.partitioning(pa.schema([(Chromosome, pa.string()), ('sample_batch', pa.int32())]), flavor='hive')
+
+
+def mafToParquet(maf, path, samplesCol="DepMap_ID", Chromosome="Chromosome", batchsize=100,
+                 loc=['CGA_WES_AC'], sep=':', chunksize=500000, intcols=['Start_position', 'End_position']):
+  """
+  converts a maf file once into a Parquet store partitioned by chromosome and sample batch (works with multiple sample file)
+
+  the allelic count columns are parsed into LOC_alt/LOC_ref int columns so that coverage and
+  allelic fraction filters can be pushed down to the file scan by readMaf
+
+  Args:
+  -----
+    maf: dataframe of the maf file or str filepath to a tab separated maf file (read in chunks, after a first pass
+      finding the columns holding only numbers)
+    path: str folder where to write the store
+    samplesCol: str colname for samples
+    Chromosome: str colname of the chromosomes
+    batchsize: int number of samples per partition
+    loc: list[str] colnames with the alt:ref (if present in the maf)
+    sep: str separator between alt:ref
+    chunksize: int number of lines read at a time when maf is a filepath
+    intcols: list[str] colnames stored as int64 (other int columns are stored as float64 as they can contain NaNs)
+
+  Returns:
+  --------
+    dict(sample: batch) the partition of each sample
+
+  Raises:
+  -------
+    ValueError: if path is a non empty folder that is not a previous store (a previous store is replaced)
+  """
+  if os.path.isdir(path) and os.listdir(path):
+    if not os.path.isfile(os.path.join(path, '_samples.json')):
+      raise ValueError(path + " is not empty and is not a maf store")
+    shutil.rmtree(path)
+  if isinstance(maf, str):
+    # a first pass fixes the column types for the whole file: columns holding only numbers are read as float64
+    # (int64 for intcols), the others as str
+    numeric = None
+    for chunk in pd.read_csv(maf, sep='\t', comment='#', chunksize=chunksize, dtype=str):
+      numeric = {k: True for k in chunk.columns} if numeric is None else numeric
+      for k in [k for k, v in numeric.items() if v]:
+        values = chunk[k].dropna()
+        numeric[k] = bool(pd.to_numeric(values, errors='coerce').notna().all())
+    dtypes = {k: (np.int64 if k in intcols else np.float64) if v and k != Chromosome else str
+              for k, v in (numeric or {}).items()}
+    chunks = pd.read_csv(maf, sep='\t', comment='#', chunksize=chunksize, dtype=dtypes)
+  else:
+    chunks = [maf]
+  batches = {}
+
+  def prepare(chunk):
+    chunk = chunk.copy()
+    for val in loc:
+      if val in chunk.columns:
+        parseAllelicCounts(chunk, [val], sep, cache=True)
+    chunk[Chromosome] = chunk[Chromosome].astype(str)
+    for sample in chunk[samplesCol].unique():
+      if sample not in batches:
+        batches[sample] = len(batches) // batchsize
+    chunk['sample_batch'] = chunk[samplesCol].map(batches).astype(np.int32)
+    return chunk
+
+  chunks = iter(chunks)
+  first = next(chunks)
+  columns = list(first.columns)
+  first = prepare(first)
+  schema = pa.Schema.from_pandas(first, preserve_index=False)
+  for i, field in enumerate(schema):
+    if pa.types.is_null(field.type):
+      schema = schema.set(i, pa.field(field.name, pa.string()))
+    elif pa.types.is_integer(field.type) and field.name not in intcols + ['sample_batch'] \
+        and not field.name.endswith(('_alt', '_ref')):
+      schema = schema.set(i, pa.field(field.name, pa.float64()))
+
+  def tables():
+    yield from pa.Table.from_pandas(first[schema.names], schema=schema, preserve_index=False).to_batches()
+    for chunk in chunks:
+      yield from pa.Table.from_pandas(prepare(chunk)[schema.names], schema=schema, preserve_index=False).to_batches()
+
+  # one writer stays open per partition, so each partition ends up in a single file
+  ds.write_dataset(tables(), path, schema=schema, format='parquet', partitioning=_mafPartitioning(Chromosome))
+  h.dictToFile({'samplesCol': samplesCol, 'Chromosome': Chromosome, 'batches': batches, 'columns': columns},
+               os.path.join(path, '_samples.json'))
+  return batches
+
+
+def readMaf(path, genes=None, samples=None, region=None, frac=None, minalt=None, minref=None, mincov=None,
+            columns=None, loc=['CGA_WES_AC'], mutNameCol="Hugo_Symbol", Start_position="Start_position",
+            End_position="End_position"):
+  """
+  queries a Parquet maf store made by mafToParquet, filters are pushed down to the file scan (works with multiple sample file)
+
+  only the partitions of the requested chromosome and samples are opened and only the requested columns are read
+
+  Args:
+  -----
+    path: str folder of the store
+    genes: list[str] only keep mutations in these genes
+    samples: list[str] only keep mutations of these samples
+    region: str "chrom" or "chrom:start-end" only keep mutations overlapping this region
+    frac: float min allelic fraction
+    minalt: int min alt coverage
+    minref: int min ref coverage
+    mincov: int min total coverage
+    columns: list[str] colnames to read (default all the columns of the converted maf, in their order)
+    loc: list[str] the allelic count colnames to sum for the coverage/fraction filters
+    mutNameCol: str colname where gene names are stored
+    Start_position: str colname of the mutation starts
+    End_position: str colname of the mutation ends
+
+  Returns:
+  --------
+    dataframe of the maf file
+  """
+  meta = h.fileToDict(os.path.join(path, '_samples.json'))
+  samplesCol, Chromosome = meta['samplesCol'], meta['Chromosome']
+  dataset = ds.dataset(path, format='parquet', partitioning=_mafPartitioning(Chromosome), exclude_invalid_files=True)
+  filters = []
+  if genes is not None:
+    filters.append(ds.field(mutNameCol).isin(list(genes)))
+  if samples is not None:
+    samples = list(samples)
+    filters.append(ds.field('sample_batch').isin(list({meta['batches'][s] for s in samples if s in meta['batches']})))
+    filters.append(ds.field(samplesCol).isin(samples))
+  if region is not None:
+    chrom, _, span = str(region).partition(':')
+    filters.append(ds.field(Chromosome) == chrom)
+    if span:
+      start, end = [int(i.replace(',', '')) for i in span.split('-')]
+      filters.append(ds.field(Start_position) <= end)
+      filters.append(ds.field(End_position if End_position in dataset.schema.names else Start_position) >= start)
+  if any(v is not None for v in [frac, minalt, minref, mincov]):
+    alt = sum([ds.field(val + '_alt').cast(pa.int64()) for val in loc[1:]], ds.field(loc[0] + '_alt').cast(pa.int64()))
+    ref = sum([ds.field(val + '_ref').cast(pa.int64()) for val in loc[1:]], ds.field(loc[0] + '_ref').cast(pa.int64()))
+    if frac is not None:
+      filters.append(alt.cast(pa.float64()) >= (alt + ref).cast(pa.float64()) * frac)
+      filters.append((alt + ref) > 0)
+    if minalt is not None:
+      filters.append(alt >= minalt)
+    if minref is not None:
+      filters.append(ref >= minref)
+    if mincov is not None:
+      filters.append(alt + ref >= mincov)
+  expr = None
+  for f in filters:
+    expr = f if expr is None else expr & f
+  if columns is None:
+    # the parsed allelic counts and the partition keys are left out, and the chromosome column (read back from
+    # the partitions) goes back to its place
+    columns = meta.get('columns', [k for k in dataset.schema.names if k != 'sample_batch'])
+  maf = dataset.to_table(columns=list(columns), filter=expr).to_pandas()
+  return maf.reset_index(drop=True)
+
+
+def _loadMaf(maf, columns=None, **filters):
+  """
+  returns the maf dataframe, reading it from a Parquet store if maf is a path to one
+  """
+  if isinstance(maf, str):
+    return readMaf(maf, columns=columns, **filters)
+  return maf
+
+
+def mafToMat(maf, boolify=False, freqcol='tumor_f', samplesCol="DepMap_ID", mutNameCol="Hugo_Symbol",
+             sparse=False):
   """
   turns a maf file into a matrix of mutations x samples (works with multiple sample file)
 
+  the matrix is built in one pass from the factorized mutation and sample names
+
   Args:
   -----
-    maf: dataframe of the maf file
+    maf: dataframe of the maf file or str path to a Parquet store from mafToParquet
     sample_col: str colname for samples
     boolify: bool whether or not to convert the matrix into a boolean (mut/no mut)
     freqcol: str colname where ref/alt frequencies are stored
     mutNameCol: str colname where mutation names are stored
+    sparse: bool whether or not to return a sparse dataframe (much smaller for large cohorts)
 
   Returns:
   --------
     the dataframe matrix
   """
-  maf = maf.sort_values(by=mutNameCol)
-  samples = set(maf[samplesCol])
-  mut = pd.DataFrame(data=np.zeros((len(set(maf[mutNameCol])), 1)), columns=[
-                      'fake'], index=set(maf[mutNameCol])).astype(float)
-  for i, val in enumerate(samples):
-    h.showcount(i, len(samples))
-    mut = mut.join(maf[maf[samplesCol] == val].drop_duplicates(
-        mutNameCol).set_index(mutNameCol)[freqcol].rename(val))
-  return mut.fillna(0).astype(bool if boolify else float).drop(columns=['fake'])
+  maf = _loadMaf(maf, columns=[samplesCol, mutNameCol, freqcol]).drop_duplicates([samplesCol, mutNameCol])
+  rows, mutations = pd.factorize(maf[mutNameCol], sort=True)
+  cols, samples = pd.factorize(maf[samplesCol], sort=True)
+  values = maf[freqcol].fillna(0).values.astype(float)
+  if boolify:
+    values = values != 0
+  mut = coo_matrix((values, (rows, cols)), shape=(len(mutations), len(samples)))
+  if sparse:
+    return pd.DataFrame.sparse.from_spmatrix(mut, index=mutations, columns=samples)
+  return pd.DataFrame(data=mut.toarray(), index=mutations, columns=samples)
 
 
 def mergeAnnotations(firstmaf, additionalmaf, Genome_Change="Genome_Change",
@@ -121,10 +578,13 @@ useSecondForConflict=True, dry_run=False):
   """
   merges two maf files, taking carre of duplicate samples and duplicate (works with multiple sample file)
 
+  mutations are matched on integer codes of their (sample, chromosome, position) and genome change,
+  the input dataframes are not modified.
+
   Args:
   -----
-  firstmaf: dataframe the first maf file
-  additionalmaf: dataframe the second maf file (need to contain same colnames)
+  firstmaf: dataframe the first maf file or str path to a Parquet store from mafToParquet
+  additionalmaf: dataframe the second maf file (need to contain same colnames) or str path to a Parquet store
   Genome_Change: str colnames of the Genome_Change column
   Start_position: str colnames of the Start_position column
   Chromosome: str colnames of the Chromosome column
@@ -136,40 +596,111 @@ useSecondForConflict=True, dry_run=False):
   -------
     dataframe of the maf file if not dryrun, else an np array of the merge issues
   """
-  mutations = firstmaf.copy()
-  mutations['ind'] = mutations[samplename]+"_"+mutations[Genome_Change]
-  mutations['loci'] = mutations[samplename] + "_" + \
-      mutations[Chromosome] + "_" + mutations[Start_position].astype(str)
-  additionalmaf['ind'] = additionalmaf[samplename] + \
-      "_"+additionalmaf[Genome_Change]
-  additionalmaf['loci'] = additionalmaf[samplename] + "_" + \
-      additionalmaf[Chromosome] + "_" + \
-      additionalmaf[Start_position].astype(str)
-  inboth = set(additionalmaf['loci']) & set(mutations['loci'])
-  notineach = set(additionalmaf['ind']) ^ set(mutations['ind'])
-  submut = mutations[mutations.loci.isin(
-      inboth) & mutations.ind.isin(notineach)]
-  subother = additionalmaf[additionalmaf.loci.isin(
-      inboth) & additionalmaf.ind.isin(notineach)]
+  firstmaf = _loadMaf(firstmaf)
+  additionalmaf = _loadMaf(additionalmaf)
+  n = len(firstmaf)
+
+  def codes(col):
+    # missing values get their own code (the last one) instead of -1, which would collide with other keys
+    codes, uniques = _factorize(np.concatenate([firstmaf[col].values, additionalmaf[col].values]))
+    return np.where(codes == -1, len(uniques) - 1, codes), uniques
+
+  samples, _ = codes(samplename)
+  chroms, chromnames = codes(Chromosome)
+  pos, posnames = codes(Start_position)
+  changes, changenames = codes(Genome_Change)
+  loci, locinames = pd.factorize((samples.astype(np.int64) * len(chromnames) + chroms) * len(posnames) + pos)
+  ind = loci.astype(np.int64) * len(changenames) + changes
+  loci1, loci2 = loci[:n], loci[n:]
+  ind1, ind2 = ind[:n], ind[n:]
+  # same locus but a different genome change
+  conflict1 = np.isin(loci1, loci2) & ~np.isin(ind1, ind2)
+  conflict2 = np.isin(loci2, loci1) & ~np.isin(ind2, ind1)
   issues = None
-  if len(submut) > 0:
-    print("found " + str(len(submut)) + " nonmatching mutations")
-    issues = np.vstack([submut.sort_values(by='loci')[
-                        Genome_Change].values, subother.sort_values(by='loci')[Genome_Change].values]).T
+  if conflict1.any():
+    print("found " + str(conflict1.sum()) + " nonmatching mutations")
+    issues = pd.merge(pd.DataFrame({'loci': loci1[conflict1], 'first': firstmaf[Genome_Change].values[conflict1]}),
+                      pd.DataFrame({'loci': loci2[conflict2], 'second': additionalmaf[Genome_Change].values[conflict2]}),
+                      on='loci').sort_values(by='loci')[['first', 'second']].values
     if dry_run:
       print(issues)
-  if not dry_run:
-    if issues is not None:
-      if useSecondForConflict:
-        mutations = mutations[~mutations.ind.isin(set(submut.ind))]
-      else:
-        additionalmaf = additionalmaf[~additionalmaf.ind.isin(
-            set(subother.ind))]
-      mutations = mutations.append(additionalmaf[additionalmaf['ind'].isin(
-          set(additionalmaf['ind']) - set(mutations['ind']))])
-    return mutations.drop(columns=['loci', 'ind']).sort_values(by=[samplename, Chromosome, Start_position])
-  else:
+  if dry_run:
     return issues
+  keep1 = ~conflict1 if useSecondForConflict else np.ones(n, dtype=bool)
+  keep2 = ~np.isin(ind2, ind1[keep1])
+  if not useSecondForConflict:
+    keep2 &= ~conflict2
+  mutations = pd.concat([firstmaf[keep1], additionalmaf[keep2]])
+  return mutations.sort_values(by=[samplename, Chromosome, Start_position])
+
+
+def parseAllelicCounts(maf, loc=['CGA_WES_AC'], sep=':', cache=False):
+  """
+  parses the "alt:ref" allelic count columns of a MAF file (works with multiple sample file)
+
+  Missing values and 'NA' count as 0. With cache, the counts of each column are stored in the MAF as
+  LOC_alt and LOC_ref int32 columns, and the filters given this MAF reuse them instead of parsing them again.
+
+  Args:
+  -----
+    maf: dataframe of the maf file
+    loc: list[str] colnames with the alt:ref
+    sep: str separator between alt:ref
+    cache: bool whether or not to store the parsed columns in the maf (modifies it in place)
+
+  Returns:
+  -------
+    (np.array, np.array) the alt and ref counts summed over all loc columns
+  """
+  alt = np.zeros(len(maf), dtype=np.int32)
+  ref = np.zeros(len(maf), dtype=np.int32)
+  for val in loc:
+    if val + '_alt' in maf.columns and val + '_ref' in maf.columns:
+      counts = maf[[val + '_alt', val + '_ref']]
+    else:
+      counts = maf[val].astype(str).str.extract('^(\\d+)?' + re.escape(sep) + '(\\d+)?', expand=True)
+      counts = counts.fillna(0).astype(np.int32)
+      if cache:
+        maf[val + '_alt'] = counts[0].values
+        maf[val + '_ref'] = counts[1].values
+    alt += counts.values[:, 0].astype(np.int32)
+    ref += counts.values[:, 1].astype(np.int32)
+  return alt, ref
+
+
+def filterAllelicCounts(maf, loc=['CGA_WES_AC'], sep=':', frac=None, minalt=None, minref=None, mincov=None):
+  """
+  filters a MAF file on allelic fraction and coverage at once (works with multiple sample file)
+
+  Args:
+  -----
+    maf: dataframe of the maf file or str path to a Parquet store from mafToParquet
+      (the filters are then pushed down to the file scan)
+    loc: list[str] colnames with the alt:ref
+    sep: str separator between alt:ref
+    frac: float min allelic fraction
+    minalt: int min alt coverage
+    minref: int min ref coverage
+    mincov: int min total coverage
+
+  Returns:
+  -------
+    dataframe of the maf file
+  """
+  if isinstance(maf, str):
+    return readMaf(maf, loc=loc, frac=frac, minalt=minalt, minref=minref, mincov=mincov)
+  alt, ref = parseAllelicCounts(maf, loc, sep)
+  mask = np.ones(len(maf), dtype=bool)
+  if frac is not None:
+    with np.errstate(divide='ignore', invalid='ignore'):
+      mask &= alt / (alt + ref) >= frac
+  if minalt is not None:
+    mask &= alt >= minalt
+  if minref is not None:
+    mask &= ref >= minref
+  if mincov is not None:
+    mask &= alt + ref >= mincov
+  return maf[mask]
 
 
 def filterAllelicFraction(maf, loc=['CGA_WES_AC'], sep=':', frac=0.1):
@@ -178,21 +709,16 @@ def filterAllelicFraction(maf, loc=['CGA_WES_AC'], sep=':', frac=0.1):
 
   Args:
   -----
-    maf: dataframe of the maf file
-    loc: list[str] colnames with the ref:alt
-    sep: str separato between ref:alt
+    maf: dataframe of the maf file or str path to a Parquet store from mafToParquet
+    loc: list[str] colnames with the alt:ref
+    sep: str separato between alt:ref
     frac: float min fraction
 
   Returns:
   -------
     dataframe of the maf file
   """
-  muts = np.zeros((len(maf), 2))
-  for val in loc:
-    muts += np.array([[v[0], 0] if 'NA' in v else v for v in maf[val].fillna(
-        '0'+sep+'0').astype(str).str.split(sep).tolist()]).astype(int)
-  muts = muts[:, 0]/(muts[:, 0]+muts[:, 1])
-  return maf[muts >= frac]
+  return filterAllelicCounts(maf, loc, sep, frac=frac)
 
 
 def filterCoverage(maf, loc=['CGA_WES_AC'], sep=':', cov=4, altloc=0):
@@ -201,9 +727,9 @@ def filterCoverage(maf, loc=['CGA_WES_AC'], sep=':', cov=4, altloc=0):
 
   Args:
   -----
-    maf: dataframe of the maf file
-    loc: list[str] colnames with the ref:alt
-    sep: str separato between ref:alt
+    maf: dataframe of the maf file or str path to a Parquet store from mafToParquet
+    loc: list[str] colnames with the alt:ref
+    sep: str separato between alt:ref
     cov: min coverage
     altloc: 0 to filter on alt and 1 to filter on ref
 
@@ -211,18 +737,17 @@ def filterCoverage(maf, loc=['CGA_WES_AC'], sep=':', cov=4, altloc=0):
   -------
     dataframe of the maf file
   """
-  muts = np.zeros((len(maf), 2))
-  for val in loc:
-    muts += np.array([[v[0], 0] if 'NA' in v else v for v in maf[val].fillna(
-        '0'+sep+'0').astype(str).str.split(sep).tolist()]).astype(int)
-  return maf[muts[:, altloc] >= cov]
+  return filterAllelicCounts(maf, loc, sep, minalt=cov if altloc == 0 else None, minref=cov if altloc == 1 else None)
 
 
 
-def manageGapsInSegments(segtocp, Chromosome='Chromosome', End="End", Start="Start", cyto=None):
+def manageGapsInSegments(segtocp, Chromosome='Chromosome', End="End", Start="Start", cyto=None, samplecol="DepMap_ID"):
   """
   extends the ends of segments in a segment file from GATK so as to remove all gaps ove the genome (works with multiple sample file)
 
+  each gap between two consecutive segments of a same sample and chromosome is split in half between them,
+  the first segment is extended to 0 and the last one to the end of the chromosome.
+
   Args:
   ----
     segtocp: dataframe of segments from GATK CN pipeline
@@ -230,112 +755,329 @@ def manageGapsInSegments(segtocp, Chromosome='Chromosome', End="End", Start="Sta
     End: str the value for the End columns
     Start: str the value for the Start columns
     cyto: dataframe with chrom;end; columns giving the size of each chromosome (else puts last segment to 1000000000)
+    samplecol: str the value for the sample column (if any)
   """
-  prevchr = ''
-  prevend = 0
-  count = 0
-  l = []
   segments = segtocp.copy()
-  le = len(segments)
-  for k, val in segments.iterrows():
-    h.showcount(count, le)
-    count += 1
-    if val[Chromosome] != prevchr:  # we changed chromosome
-      # we extend the previous segment (last of the prev chrom) to.. way enough
-      if len(l) > 0:
-        l[-1][2] = 1000000000 if cyto is None else cyto[cyto['chrom']
-                                                        == prevchr]['end'].values[-1]
-      # we extend the first segment to 0
-      l.append([val[Chromosome], 0, val[End]])
-    else:
-      if val[Start] > prevend + 1:  # we have a gap in the same chrom
-        sizeofgap = val[Start] - prevend
-        # we add to the previous one half of the gap
-        l[-1][2] += int(sizeofgap /
-                        2) if sizeofgap % 2 == 0 else int(sizeofgap / 2) + 1
-        # the rest to the other
-        l.append([val[Chromosome], val[Start] - int(sizeofgap / 2), val[End]])
-      elif val[Start] < prevend:  # this should never happen
-        raise ValueError("start comes after end")
-      else:
-        l.append([val[Chromosome], val[Start], val[End]])
-    prevchr = val[Chromosome]
-    prevend = val[End]
-  # we extend the last one
-  l[-1][2] = 1000000000 if cyto is None else cyto[cyto['chrom']
-                                                  == prevchr]['end'].values[-1]
-  segments[[Chromosome, Start, End]] = l
+  start = segments[Start].values.astype(np.int64)
+  end = segments[End].values.astype(np.int64)
+  chrom = segments[Chromosome].values
+  # a new (sample, chromosome) starts here
+  new = np.ones(len(segments), dtype=bool)
+  new[1:] = chrom[1:] != chrom[:-1]
+  if samplecol in segments.columns:
+    sample = segments[samplecol].values
+    new[1:] |= sample[1:] != sample[:-1]
+  last = np.ones(len(segments), dtype=bool)
+  last[:-1] = new[1:]
+  gap = np.zeros(len(segments), dtype=np.int64)
+  gap[1:] = start[1:] - end[:-1]
+  gap[new] = 0
+  if (gap < 0).any():  # this should never happen
+    raise ValueError("start comes after end")
+  # gaps of 1 are not gaps
+  gap[gap <= 1] = 0
+  # the previous segment gets the bigger half of the gap, the segment the rest
+  newstart = np.where(new, 0, start - gap // 2)
+  newend = end.copy()
+  newend[:-1] += gap[1:] - gap[1:] // 2
+  if cyto is None:
+    newend[last] = 1000000000
+  else:
+    sizes = cyto.groupby('chrom')['end'].last().to_dict()
+    missing = set(chrom[last]) - set(sizes.keys())
+    if missing:
+      raise ValueError("chromosomes not in cyto: " + str(missing))
+    newend[last] = [sizes[c] for c in chrom[last]]
+  segments[Start] = newstart
+  segments[End] = newend
   return segments
 
 
-def toGeneMatrix(segments, gene_mapping, style='weighted', missingchrom=['Y']):
+def _geneCN(segs, genes, ngenes, style='weighted'):
+  """
+  computes the gene level copy number of one sample (used by toGeneMatrix)
+
+  Args:
+  ----
+    segs: dataframe of the segments of one sample with Chromosome, Start, End, Segment_Mean columns
+    genes: dict(chromosome: (gene positions, starts, ends)) the genes of each chromosome
+    ngenes: int the total number of genes
+    style: str one of "weighted","mean","closest"
+
+  Returns:
+  -------
+    np.array the copy number of each gene (NaN for genes on a chromosome without segments)
+  """
+  data = np.full(ngenes, np.nan)
+  for chrom, seg in segs.groupby('Chromosome'):
+    if chrom not in genes:
+      continue
+    pos, start, end = genes[chrom]
+    seg = seg.sort_values('Start')
+    s, e, m = seg['Start'].values, seg['End'].values, seg['Segment_Mean'].values.astype(float)
+    # segments are considered contiguous: each one starts where the previous one ends
+    prevend = np.concatenate([s[:1], e[:-1]])
+    # first segment ending after the gene start, first segment reaching the gene end
+    first = np.searchsorted(e, start, side='right')
+    covered = first < len(e)
+    pos, start, end, first = pos[covered], start[covered], end[covered], first[covered]
+    last = np.minimum(np.searchsorted(e, end, side='left'), len(e) - 1)
+    val = m[first]
+    multi = last > first
+    f, l, gs, ge = first[multi], last[multi], start[multi], end[multi]
+    if style == "weighted":
+      cov = np.cumsum(m * (e - prevend))
+      val[multi] = (m[f] * (e[f] - gs) + cov[l - 1] - cov[f] + m[l] * (ge - prevend[l])) / (ge - gs)
+    elif style == "mean":
+      cov = np.cumsum(m)
+      val[multi] = (cov[l] - cov[f] + m[f]) / (l - f + 1)
+    elif style == "closest" and multi.any():
+      # every (gene, segment) overlap, keeping the segment with the largest one
+      counts = l - f + 1
+      gene = np.repeat(np.arange(len(f)), counts)
+      idx = np.repeat(f, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+      cov = np.minimum(e[idx], ge[gene]) - np.maximum(prevend[idx], gs[gene])
+      order = np.lexsort((idx, -cov, gene))
+      best = order[np.concatenate([[0], np.cumsum(counts)[:-1]])]
+      val[multi] = m[idx[best]]
+    elif style != "closest":
+      raise ValueError('style needs to be one of weighted, mean, closest')
+    data[pos] = val
+  return data
+
+
+def toGeneMatrix(segments, gene_mapping, style='weighted', missingchrom=['Y'], cores=1, samplecol="DepMap_ID"):
   """
   makes a geneXsample matrix from segment level copy number (works with multiple sample file)
 
+  for each chromosome, the segments overlapping all genes are found at once with searchsorted.
+  Genes on a chromosome without segments in a sample are NaN.
+
   Args:
   ----
     style: str one of "weighted","mean","closest"
     segments: dataframe of segments containing: [Chromosome, Segment_Mean, Chromosome, start, end] columns
     gene_mapping: dataframe with symbol, ensembl_id columns for each gene
-    missingchrom: list[str] chromosomes not to look into
+    missingchrom: list[str] chromosomes not to look into (kept for compatibility, any chromosome without segments is NaN)
+    cores: int number of processes computing samples in parallel
+    samplecol: str colname of the sample names
 
   Returns:
   -------
     pd.dataframe: the matrix
   """
-  samples = list(set(segments.DepMap_ID))
-  data = np.zeros((len(samples), len(gene_mapping)))
-  for i, sample in enumerate(samples):
-    segs = segments[segments.DepMap_ID == sample][[
-        'Chromosome', 'Start', 'End', "Segment_Mean"]].values
-    hasmissing = set(missingchrom) - set(segs[:, 0])
-    j = 0
-    h.showcount(i, len(samples))
-    for k, gene in enumerate(gene_mapping[['Chromosome', 'start', 'end']].values):
-        if gene[0] in hasmissing:
-          data[i, k] = np.nan
-          continue
-        while gene[0] != segs[j][0] or gene[1] >= segs[j][2]:
-          #print("went beyong",gene, segs[j])
-          j += 1
-        # some genes are within other genes, we need to go back in the list of segment in that case
-        while gene[1] < segs[j][1]:
-          j -= 1
-          #print("decrease gene",gene)
-        # we are entirely within the segment
-        c = 1
-        if gene[2] <= segs[j][2]:
-          data[i, k] = segs[j][3]
-        else:
-          # how much of the gene is covered by the segment
-          coef = (segs[j][2] - gene[1]) / (gene[2] - gene[1])
-          # print('coef',coef)
-          val = segs[j][3] * coef if style == "weighted" else segs[j][3]
-          end = segs[j][2]
-          # until the end of a segments goes beyon the end of the gene (say if we have X segments within the gene)
-          while end < gene[2]:
-            # pdb.set_trace()
-            j += 1
-            c += 1
-            nextend = segs[j][2] if segs[j][2] < gene[2] else gene[2]
-            # here, end (of prevsegment) is the next segment's start
-            ncoef = (nextend - end) / (gene[2] - gene[1])
-            # print('multi',gene, ncoef)
-            if style == "closest":
-              if ncoef > coef:
-                val = segs[j][3]
-              else:
-                # we switch it back (see line 894)
-                ncoef = coef
-            else:
-              val += segs[j][3] * ncoef if style == "weighted" else segs[j][3]
-            end = segs[j][2]
-            coef = ncoef
-          data[i, k] = val if style == "weighted" else val / c
-  return pd.DataFrame(data=data, index=samples, columns=[i['symbol'] + ' (' + str(i['ensembl_id']) + ')' for _, i in gene_mapping.iterrows()])
+  segments = segments[[samplecol, 'Chromosome', 'Start', 'End', 'Segment_Mean']]
+  samples = list(set(segments[samplecol]))
+  data = _samplesGeneCN(segments, samples, gene_mapping, style, cores, samplecol)
+  return pd.DataFrame(data=data, index=samples,
+                      columns=(gene_mapping['symbol'] + ' (' + gene_mapping['ensembl_id'].astype(str) + ')').tolist())
 
 
-def checkAmountOfSegments(segmentcn, thresh=850, samplecol="DepMap_ID"):
+def _samplesGeneCN(segments, samples, gene_mapping, style='weighted', cores=1, samplecol="DepMap_ID"):
+  """
+  computes the gene level copy number of a list of samples (used by toGeneMatrix and updateGeneCNStore)
+
+  Returns:
+  -------
+    np.array: the samples x genes matrix
+  """
+  genes = {}
+  for chrom, pos in gene_mapping.reset_index(drop=True).groupby('Chromosome').groups.items():
+    pos = np.asarray(pos)
+    genes[chrom] = (pos, gene_mapping['start'].values[pos], gene_mapping['end'].values[pos])
+  groups = segments.groupby(samplecol)
+  if cores > 1:
+    with ProcessPoolExecutor(max_workers=cores) as pool:
+      data = list(pool.map(_geneCN, [groups.get_group(s) for s in samples], [genes] * len(samples),
+                           [len(gene_mapping)] * len(samples), [style] * len(samples), chunksize=8))
+  else:
+    data = []
+    for i, sample in enumerate(samples):
+      h.showcount(i, len(samples))
+      data.append(_geneCN(groups.get_group(sample), genes, len(gene_mapping), style))
+  return np.array(data).reshape(len(samples), len(gene_mapping))
+
+
+def _segmentHashes(segments, samplecol="DepMap_ID"):
+  """
+  md5 of the segments of each sample, independent of the row order (used by updateGeneCNStore)
+  """
+  segments = segments[[samplecol, 'Chromosome', 'Start', 'End', 'Segment_Mean']].sort_values(
+      by=[samplecol, 'Chromosome', 'Start', 'End'])
+  rows = pd.util.hash_pandas_object(segments.drop(columns=samplecol), index=False).values
+  bounds = np.flatnonzero(np.concatenate([[True], segments[samplecol].values[1:] != segments[samplecol].values[:-1],
+                                          [True]]))
+  return {segments[samplecol].values[s]: hashlib.md5(rows[s:e].tobytes()).hexdigest()
+          for s, e in zip(bounds[:-1], bounds[1:])}
+
+
+def _openGeneCNStore(path, meta, mode='r'):
+  """
+  opens the memmapped samples x genes matrix of a gene CN store
+  """
+  return np.memmap(os.path.join(path, 'genecn.dat'), dtype=np.float64, mode=mode,
+                   shape=(meta['capacity'], len(meta['genes'])))
+
+
+def updateGeneCNStore(path, segments, gene_mapping, style='weighted', cores=1, samplecol="DepMap_ID",
+                      growth=1.5):
+  """
+  adds or updates samples in an on disk gene level CN store, computing only new or changed samples (works with multiple sample file)
+
+  the store is a memmapped samples x genes float64 matrix (genecn.dat) with a json index of its genes, samples
+  and the hash of each sample's segments. Samples whose segments did not change are not recomputed, the other
+  ones are written in place. Changing the gene_mapping or the style rebuilds the store.
+
+  Args:
+  ----
+    path: str folder of the store (created if needed)
+    segments: dataframe of segments containing: [samplecol, Chromosome, Segment_Mean, Start, End] columns
+      (only the samples to add/update need to be there)
+    gene_mapping: dataframe with symbol, ensembl_id, Chromosome, start, end columns for each gene
+    style: str one of "weighted","mean","closest"
+    cores: int number of processes computing samples in parallel
+    samplecol: str colname of the sample names
+    growth: float by how much to grow the matrix when it is full, to not resize it at each new sample
+
+  Returns:
+  -------
+    list[str] the samples that were (re)computed
+  """
+  index = os.path.join(path, 'index.json')
+  genehash = hashlib.md5(pd.util.hash_pandas_object(gene_mapping[['symbol', 'ensembl_id', 'Chromosome', 'start', 'end']],
+                                                    index=False).values.tobytes()).hexdigest()
+  meta = h.fileToDict(index) if os.path.exists(index) else None
+  if meta is None or meta['genehash'] != genehash or meta['style'] != style:
+    h.createFoldersFor(index)
+    meta = {'genehash': genehash, 'style': style, 'capacity': 0, 'samples': [], 'hashes': {},
+            'genes': (gene_mapping['symbol'] + ' (' + gene_mapping['ensembl_id'].astype(str) + ')').tolist()}
+    open(os.path.join(path, 'genecn.dat'), 'wb').close()
+  hashes = _segmentHashes(segments, samplecol)
+  todo = [s for s, v in hashes.items() if meta['hashes'].get(s) != v]
+  if len(todo) == 0:
+    return []
+  positions = {s: i for i, s in enumerate(meta['samples'])}
+  for s in todo:
+    if s not in positions:
+      positions[s] = len(meta['samples'])
+      meta['samples'].append(s)
+  if len(meta['samples']) > meta['capacity']:
+    # the file is extended with zeros, existing rows stay in place
+    meta['capacity'] = max(len(meta['samples']), int(meta['capacity'] * growth))
+    with open(os.path.join(path, 'genecn.dat'), 'r+b') as f:
+      f.truncate(meta['capacity'] * len(meta['genes']) * 8)
+  mat = _openGeneCNStore(path, meta, 'r+')
+  data = _samplesGeneCN(segments[segments[samplecol].isin(todo)], todo, gene_mapping, style, cores, samplecol)
+  mat[[positions[s] for s in todo]] = data
+  mat.flush()
+  del mat
+  meta['hashes'].update({s: hashes[s] for s in todo})
+  # the index is replaced at once so that readers never see a partially written one
+  h.dictToFile(meta, index + '.tmp')
+  os.replace(index + '.tmp', index)
+  return todo
+
+
+def readGeneCNStore(path, samples=None, genes=None):
+  """
+  reads a slice of an on disk gene level CN store made by updateGeneCNStore (works with multiple sample file)
+
+  only the requested samples/genes are read from the memmapped matrix
+
+  Args:
+  ----
+    path: str folder of the store
+    samples: list[str] samples to read (default all)
+    genes: list[str] genes to read, either as "symbol (ensembl_id)" or as symbols (default all)
+
+  Returns:
+  -------
+    pd.dataframe: the samples x genes matrix
+  """
+  meta = h.fileToDict(os.path.join(path, 'index.json'))
+  allsamples = pd.Index(meta['samples'])
+  allgenes = pd.Index(meta['genes'])
+  rows = np.arange(len(allsamples)) if samples is None else allsamples.get_indexer(samples)
+  if genes is None:
+    cols = np.arange(len(allgenes))
+  else:
+    cols = allgenes.get_indexer(genes)
+    if (cols == -1).any():
+      symbols = pd.Series(np.arange(len(allgenes)), index=allgenes.str.partition(' (').get_level_values(0))
+      symbols = symbols[~symbols.index.duplicated()]
+      cols = np.where(cols == -1, symbols.reindex(genes).fillna(-1).values.astype(int), cols)
+  if (rows == -1).any() or (cols == -1).any():
+    raise ValueError('samples or genes not in the store: ' + str(
+        [str(s) for s, r in zip([] if samples is None else samples, rows) if r == -1] +
+        [str(g) for g, c in zip([] if genes is None else genes, cols) if c == -1]))
+  mat = _openGeneCNStore(path, meta)
+  return pd.DataFrame(data=np.asarray(mat[np.ix_(rows, cols)]), index=allsamples[rows], columns=allgenes[cols])
+
+
+def segmentQC(segments, samplecol="DepMap_ID", Chromosome='Chromosome', Start='Start', End='End',
+              Segment_Mean='Segment_Mean', neutral=1, alteredthresh=0.3, thresh=850, bins=2000):
+  """
+  computes QC metrics for each sample of a segment file in one pass (works with multiple sample file)
+
+  segments can also be an iterable of dataframes (e.g. pd.read_csv(..., chunksize=X)),
+  so that large segment files are never fully loaded in memory. The median segment length is then
+  approximated from a histogram of the lengths (exact for a dataframe).
+
+  Args:
+  ----
+    segments: segment dataframe or iterable of segment dataframes
+    samplecol: str colname of the sample names
+    Chromosome: str colname of the chromosomes
+    Start: str colname of the segment starts
+    End: str colname of the segment ends
+    Segment_Mean: str colname of the segment copy number
+    neutral: float the copy number of an unaltered segment
+    alteredthresh: float a segment is altered if its copy number is further away than that from neutral
+    thresh: int max ok amount of segments
+    bins: int number of log spaced bins used to approximate the median segment length of an iterable
+      (the median is rounded to an edge of the bin holding it, 2000 is ~1% precision)
+
+  Returns:
+  -------
+    pd.df for each sample: segments, median_length, genome_length, altered_fraction, breakpoints_per_mb, failed
+  """
+  exact = isinstance(segments, pd.DataFrame)
+  if exact:
+    segments = [segments]
+  edges = np.logspace(0, 10, bins + 1)
+  sums = None
+  hist = None
+  chroms = set()
+  for chunk in segments:
+    length = (chunk[End] - chunk[Start]).clip(lower=1)
+    altered = (chunk[Segment_Mean] - neutral).abs() > alteredthresh
+    sample = chunk[samplecol]
+    part = pd.DataFrame({'segments': 1, 'genome_length': length, 'altered_length': length * altered}).groupby(sample.values).sum()
+    sums = part if sums is None else sums.add(part, fill_value=0)
+    part = pd.Series(1, index=pd.MultiIndex.from_arrays([sample.values, np.searchsorted(edges, length.values)])).groupby(level=[0, 1]).sum()
+    hist = part if hist is None else hist.add(part, fill_value=0)
+    chroms.update(zip(sample.values, chunk[Chromosome].values))
+  if exact:
+    median = length.groupby(sample.values).median()
+  else:
+    # median from the cumulative histogram of each sample
+    hist = hist.sort_index()
+    cum = hist.groupby(level=0).cumsum()
+    half = sums['segments'].reindex(cum.index.get_level_values(0)).values / 2
+    median = cum[cum.values >= half].reset_index(level=1).groupby(level=0).first().iloc[:, 0]
+    median = pd.Series(edges[np.minimum(median.values.astype(int), bins)], index=median.index)
+  nchroms = pd.Series([s for s, _ in chroms]).value_counts()
+  res = pd.DataFrame(index=sums.index)
+  res['segments'] = sums['segments'].astype(int)
+  res['median_length'] = median.reindex(res.index).values
+  res['genome_length'] = sums['genome_length']
+  res['altered_fraction'] = sums['altered_length'] / sums['genome_length']
+  res['breakpoints_per_mb'] = (res['segments'] - nchroms.reindex(res.index)) / (sums['genome_length'] / 1e6)
+  res['failed'] = res['segments'] > thresh
+  return res
+
+
+def checkAmountOfSegments(segmentcn, thresh=850, samplecol="DepMap_ID", plot=True):
   """
   if there is too many segments, something might be wrong (works with multiple sample file)
 
@@ -345,18 +1087,37 @@ def checkAmountOfSegments(segmentcn, thresh=850, samplecol="DepMap_ID"):
   ----
     segmentcn: segment dataframe
     thresh: max ok amount
+    samplecol: str colname of the sample names
+    plot: bool whether or not to plot the distribution of the amounts
+
+  Returns:
+  -------
+    list of the samples with more than thresh segments
+  """
+  amounts = segmentcn[samplecol].value_counts()
+  failed = amounts[amounts > thresh]
+  for cellline, val in failed.items():
+    print(cellline, val)
+  if plot:
+    sns.kdeplot(amounts.values)
+  return failed.index.tolist()
+
+
+def geneCNQC(genecn, thresh=0.2):
+  """
+  computes for each gene how much its CN changes accross samples (works with multiple sample file)
+
+  Args:
+  -----
+    genecn: gene cn data frame (samples x genes)
+    thresh: threshold in logfold change accross all of them
+
+  Returns:
+  -------
+    pd.df for each gene: its variance and whether it is below thresh
   """
-  failed = []
-  celllines = set(segmentcn[samplecol].tolist())
-  amounts = []
-  for cellline in celllines:
-    val = segmentcn[segmentcn[samplecol] == cellline].shape[0]
-    amounts.append(val)
-    if val > thresh:
-      failed.append(cellline)
-      print(cellline, val)
-  sns.kdeplot(amounts)
-  return failed
+  var = genecn.var()
+  return pd.DataFrame({'variance': var, 'lowvariance': var < thresh})
 
 
 def checkGeneChangeAccrossAll(genecn, thresh=0.2):
@@ -371,4 +1132,5 @@ def checkGeneChangeAccrossAll(genecn, thresh=0.2):
     genecn: gene cn data frame
     thresh: threshold in logfold change accross all of them
   """
-  return genecn.columns[genecn.var()<thresh].tolist()
+  qc = geneCNQC(genecn, thresh)
+  return qc.index[qc.lowvariance].tolist()
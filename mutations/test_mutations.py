@@ -0,0 +1,28 @@
+from JKBio import mutations
+import numpy as np
+import pandas as pd
+
+
+def rescue_list(tmp_path):
+  path = str(tmp_path / 'rescue.txt')
+  pd.DataFrame({'Chromosome': ['1', '11'], 'Start_position': [6257785, 65819899], 'ref_allele': ['T', '-'],
+                'newbase': ['-', 'GCC']}).to_csv(path, sep='\t', index=False)
+  return path
+
+
+def test_rescue_list_maf(tmp_path):
+  maf = pd.DataFrame({'Chromosome': ['1', 'chr11', '1', '2', '1'],
+                      'Start_position': [6257785, 65819899, 6257785, 5, 6257785],
+                      'Reference_Allele': ['T', '-', 'A', 'C', 'T'],
+                      'Tumor_Seq_Allele2': ['-', 'GCC', '-', 'G', np.nan]})
+  # missing alleles count as '-'
+  assert list(mutations.inRescueList(maf, rescue_list(tmp_path))) == [True, True, False, False, True]
+
+
+def test_rescue_list_vcf(tmp_path):
+  # vcf indels keep their anchor base, multiallelic sites match if any of their alt does, missing alleles count as '-'
+  vcf = pd.DataFrame({'chr': ['chr1', '11', '11', '1', '1'], 'pos': [6257784, 65819899, 65819899, 6257785, 6257785],
+                      'ref': ['AT', 'A', 'A', 'T', 'T'], 'alt': ['A', 'C,AGCC', 'C', 'G', np.nan]})
+  rescue = mutations.loadRescueList(rescue_list(tmp_path))
+  assert list(mutations.inRescueList(vcf, rescue, vcf=True)) == [True, True, False, False, True]
+  assert list(mutations.filterRescueList(vcf, rescue, vcf=True).index) == [0, 1, 4]
@@ -7,6 +7,8 @@ import warnings
 from matplotlib import pyplot as plt
 from bokeh.palettes import *
 from bokeh.plotting import *
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from JKBio.rna import pyDESeq2
 from JKBio.utils import helper as h
 import pdb
@@ -15,7 +17,13 @@ import seaborn as sns
 import gseapy
 import pandas as pd
 import numpy as np
+import pysam
 import subprocess
+import tempfile
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from scipy import sparse, stats
 
 from taigapy import TaigaClient
 tc = TaigaClient()
@@ -97,6 +105,70 @@ def convertGenes(listofgenes, from_idtype="ensembl_gene_id", to_idtype="symbol")
     return(renamed, not_parsed)
 
 
+def _spikeInSample(file, refgenome, fastQfolder, results, pairedEnd=False, threads=1, totrim=True, tomap=True,
+                   tofilter=True, toremove=False, pathtosam='samtools', pathtotrim_galore='trim_galore', pathtobwa='bwa'):
+    """
+    runs trim -> map -> index/flagstat/idxstats -> count for one sample (used by getSpikeInControlScales)
+
+    each finished stage leaves a NAME.STAGE.done file in results, so that reruns skip it
+
+    Returns:
+    --------
+      (str, int) the sample name and its number of mapped reads
+    """
+    name = (file[0] if pairedEnd and type(file) is not str else file).split('.')[0]
+
+    def run(stage, cmd):
+        done = results + name + '.' + stage + '.done'
+        if os.path.exists(done):
+            print(name + ": " + stage + " already done")
+            return
+        res = subprocess.run(cmd, capture_output=True, shell=True)
+        if res.returncode != 0:
+            raise ValueError('issue with the command: ' + str(res.stderr))
+        open(done, 'w').close()
+
+    folder = fastQfolder
+    if totrim and tomap:
+        if pairedEnd:
+            cmd = pathtotrim_galore + ' --paired --fastqc --gzip ' + fastQfolder + \
+                file[0] + ' ' + fastQfolder + file[1] + " -o " + results
+            if toremove:
+                cmd += ' && rm ' + fastQfolder + file[0] + ' ' + fastQfolder + file[1]
+            file = [file[0].split('.')[0] + '_val_1.fq.gz', file[1].split('.')[0] + '_val_2.fq.gz']
+        else:
+            cmd = pathtotrim_galore + ' --fastqc --gzip ' + fastQfolder + file + " -o " + results
+            if toremove:
+                cmd += ' && rm ' + fastQfolder + file
+            file = file.split('.')[0] + '_trimmed.fq.gz'
+        run('trimmed', cmd)
+        folder = results
+    if tomap:
+        reads = folder + file[0] + ' ' + folder + file[1] if pairedEnd else folder + file
+        file = (file[0] if pairedEnd else file).split('.')[0] + '.sorted.bam'
+        cmd = pathtobwa + ' mem -t ' + str(threads) + ' ' + refgenome + ' ' + reads + ' | ' + pathtosam + \
+            ' sort -@ ' + str(threads) + ' - -o ' + results + file
+        if toremove and folder == results:
+            cmd += ' && rm ' + reads
+        run('mapped', cmd)
+    if tofilter:
+        file = file.split('.')[0] + '.sorted.bam'
+        bam = results + file
+        run('filtered', pathtosam + ' index ' + bam + ' && ' + pathtosam + ' flagstat ' + bam + ' > ' + bam +
+            '.flagstat && ' + pathtosam + ' idxstats ' + bam + ' > ' + bam + '.idxstat')
+    countfile = results + file + '.count'
+    if os.path.exists(countfile):
+        mapped = int(h.fileToList(countfile)[0])
+    else:
+        # mapped, not duplicates, mapq >= 1 (and paired with a mapped mate for paired end samples)
+        flags = ['-F', '0x004', '-F', '0x0400', '-q', '1']
+        if pairedEnd:
+            flags += ['-f', '0x001', '-F', '0x0008']
+        mapped = int(pysam.view('-c', *flags, '-@', str(threads), results + file).split('\n')[0])
+        h.listToFile([mapped], countfile)
+    return file.split('.')[0], mapped
+
+
 def getSpikeInControlScales(refgenome, fastq=None, fastQfolder='', mapper='bwa', pairedEnd=False, cores=1,
                             pathtosam='samtools', pathtotrim_galore='trim_galore', pathtobwa='bwa',
                             totrim=True, tomap=True, tofilter=True, results='res/', toremove=False):
@@ -107,6 +179,9 @@ def getSpikeInControlScales(refgenome, fastq=None, fastQfolder='', mapper='bwa',
     To figure out what was the actual sample concentration, we use Spike In control
     You should have FastQfolder/[NAME].fastq & BigWigFolder/[NAME].bw with NAME being the same for the same samples
 
+    Each sample goes through trim -> map -> index/flagstat/idxstats -> count on its own, as many samples
+    running at once as the cores allow. Finished stages are checkpointed in the results folder
+    so that a rerun only does what is left.
 
     Args:
     -----
@@ -115,6 +190,7 @@ def getSpikeInControlScales(refgenome, fastq=None, fastQfolder='', mapper='bwa',
       BigWigFolder: str the folder path where the bigwig files are stored (should be named the same as files in FastQfolder)
       mapper: str flag to 'bwa', ...
       pairedEnd: Bool flat to true for paired end sequences. if true, You should have FastQfolder/[NAME]_1|2.fastq
+      cores: int total number of cores to use, split between the samples running at once
 
     Returns:
     --------
@@ -131,7 +207,7 @@ def getSpikeInControlScales(refgenome, fastq=None, fastQfolder='', mapper='bwa',
             print("need to be name_*1, name_*2")
             fastqs = [i for i in h.grouped(fastqs, 2)]
     elif fastq is None:
-        raise Error('you need input files')
+        raise ValueError('you need input files')
     else:
         if type(fastq) is list:
             print('your files need to be all in the same folder')
@@ -148,61 +224,20 @@ def getSpikeInControlScales(refgenome, fastq=None, fastQfolder='', mapper='bwa',
     print(fastqs)
     if not totrim:
         print("you need to have your files in the " + results + " folder")
-    if totrim and tomap:
-        print("\n\ntrimming\n\n")
-        if pairedEnd:
-            cmds = []
-            rm = []
-            for file in fastqs:
-                cmd = pathtotrim_galore + ' --paired --fastqc --gzip ' + fastQfolder + \
-                    file[0] + ' ' + fastQfolder + file[1] + " -o " + results
-                if toremove:
-                    rm.append('rm ' + fastQfolder +
-                              file[0] + ' ' + fastQfolder + file[1])
-                cmds.append(cmd)
-            print(cmds)
-            h.parrun(cmds, cores, add=rm)
-            fastqs = [[file[0].split('.')[
-                0] + '_val_1.fq.gz', file[1].split('.')[0] + '_val_2.fq.gz'] for file in fastqs]
-    if tomap:
-        print("\n\nmapping\n\n")
-        if pairedEnd:
-            cmds = []
-            rm = []
-            for file in fastqs:
-                cmd = pathtobwa + ' mem ' + refgenome + ' ' + results + file[0] + ' ' + results +\
-                    file[1] + ' | ' + pathtosam + ' sort - -o ' + \
-                    results + file[0].split('.')[0] + '.sorted.bam'
-                if toremove:
-                    rm.append('rm ' + results +
-                              file[0] + ' ' + results + file[1])
-                cmds.append(cmd)
-            h.parrun(cmds, cores, add=rm)
-            fastqs = [file[0].split('.')[0] + '.sorted.bam' for file in fastqs]
-
-    if tofilter:
-        print("\n\nfiltering\n\n")
-        cmds = []
-        rm = []
-        h.parrun([pathtosam + ' index ' + results + file.split('.')
-                [0] + '.sorted.bam' for file in fastqs], cores)
-        h.parrun([pathtosam + ' flagstat ' + results + file.split('.')[0] + '.sorted.bam > ' +
-                results + file.split('.')[0] + '.sorted.bam.flagstat' for file in fastqs], cores)
-        h.parrun([pathtosam + ' idxstats ' + results + file.split('.')[0] + '.sorted.bam > ' +
-                results + file.split('.')[0] + '.sorted.bam.idxstat' for file in fastqs], cores)
-        fastqs = [file.split('.')[0] + '.sorted.bam' for file in fastqs]
-    else:
+    if not tofilter and not tomap:
         print("files need to be named: NAME.sorted.bam")
         fastqs = [file for file in fastqs if '.sorted.bam' == file[-11:]]
+    h.createFoldersFor(results)
+    jobs = max(1, min(len(fastqs), cores))
+    threads = max(1, cores // jobs)
     mapped = {}
     norm = {}
-    unique_mapped = {}
-    print("\n\ncounting\n\n")
-    for file in fastqs:
-        mapped[file.split('.')[0]] = int(os.popen(pathtosam + ' view -c -F 0x004 -F 0x0008 -f 0x001 -F 0x0400 -q 1 ' + results +
-                                                  file + ' -@ ' + str(cores)).read().split('\n')[0])
-       # unique_mapped[file.split('.')[0]] = int(re.findall("Mapped reads: (\d+)", os.popen('bamtools stats -in '+results +
-        #                                             file + '.sorted.bam').read())[0])
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = [pool.submit(_spikeInSample, file, refgenome, fastQfolder, results, pairedEnd, threads, totrim,
+                               tomap, tofilter, toremove, pathtosam, pathtotrim_galore, pathtobwa) for file in fastqs]
+        for job in running:
+            name, count = job.result()
+            mapped[name] = count
     nbmapped = np.array([i for i in mapped.values()])
     nbmapped = np.sort(nbmapped)[0] / nbmapped.astype(float)
     for i, val in enumerate(mapped.keys()):
@@ -210,214 +245,282 @@ def getSpikeInControlScales(refgenome, fastq=None, fastQfolder='', mapper='bwa',
     return norm, mapped,  # unique_mapped
 
 
-def GSEAonExperiments(data, experiments, res={}, savename='', scaling=[], geneset='GO_Biological_Process_2015',
-                      cores=8, cleanfunc=lambda i: i.split('(GO')[0]):
+_genesets = {}
+
+
+def readGMT(filename):
+    """
+    reads a gene set file in the GMT format (name\\tdescription\\tgene1\\tgene2...)
+
+    Args:
+    -----
+      filename: str the filepath to the .gmt file
+
+    Returns:
+    --------
+      dict(str: list[str]) the genes of each gene set
+    """
+    genesets = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n').split('\t')
+            if len(line) > 2:
+                genesets[line[0]] = [g for g in line[2:] if g]
+    return genesets
+
+
+def loadGeneSets(geneset):
+    """
+    loads a gene set library once and keeps it in memory for the next calls
+
+    Args:
+    -----
+      geneset: str a filepath to a .gmt file or the name of an Enrichr library (e.g. GO_Biological_Process_2015)
+
+    Returns:
+    --------
+      dict(str: list[str]) the genes of each gene set
+    """
+    if geneset not in _genesets:
+        if os.path.isfile(geneset):
+            _genesets[geneset] = readGMT(geneset)
+        elif hasattr(gseapy, 'get_library'):
+            _genesets[geneset] = gseapy.get_library(geneset)
+        else:
+            _genesets[geneset] = gseapy.parser.gsea_gmt_parser(geneset)
+    return _genesets[geneset]
+
+
+def _runGSEA(totest, cls, genesets, cores):
+    """
+    runs gseapy on one experiment and returns its result table (used by GSEAonExperiments)
+    """
+    res = gseapy.gsea(data=totest, gene_sets=genesets, cls=cls, no_plot=True, processes=cores).res2d
+    if 'Term' not in res.columns:
+        res['Term'] = res.index
+    return res.rename(columns={'ES': 'es'})
+
+
+def GSEAonExperiments(data, experiments, res=None, savename='', scaling=[], geneset='GO_Biological_Process_2015',
+                      cores=8, cleanfunc=lambda i: i.split('(GO')[0], cachedir=None):
     """
 
     Will run GSEA on a set of experiment
 
+    the gene set library is loaded once and experiments are run in parallel,
+    the cores being split between the experiments and gseapy.
+
     Args:
     -----
       data: a pandas.df rows: gene counts; columns: [experimentA_X,..., experimentD_X..., control_X] where X is the replicate number
       experiments: a list of experiment names (here experimentA,.. experimentD)
       scaling: a dict(experiment:(mean,std)) of scaling factors and their associated standard error for each experiments
-      res: you can provide a dict containing results from
+      res: you can provide a dict containing results from a previous run (experiments in it won't be recomputed),
+        either the dataframes it returned or the gseapy result objects of older versions (their res2d is used)
       savename: if you want to save the plots as pdfs, provides a location/name
       geneset: the geneset to run it on. (can be a filepath to your own geneset)
       cores: to run GSEA on
       cleanfunc: a func applied to the names of the gene sets to change it in some way (often to make it more readable)
+      cachedir: str if provided, a folder where each experiment's result is saved, keyed by a hash of its data
+        and geneset, so that reruns on the same inputs are read back instead of recomputed
     Returns
     -------
       plots the results
       1: returns a matrix with the enrichment for each term for each experiment
       2: returns a dict(experiment:pd.df) with dataframe being the output of GSEA (with pvalues etc..) for each experiments
+        (a new dict: the res given is not modified)
     """
-    for i, val in enumerate(experiments):
-        print(val)
+    res = {} if res is None else dict(res)
+    for k, v in res.items():
+        if hasattr(v, 'res2d'):
+            v = v.res2d
+            v = v if 'Term' in v.columns else v.assign(Term=[cleanfunc(i) for i in v.index])
+            res[k] = v.reset_index(drop=True)
+    genesets = loadGeneSets(geneset)
+    gshash = hashlib.md5(json.dumps(genesets, sort_keys=True).encode()).hexdigest()
+    if cachedir:
+        h.createFoldersFor(os.path.join(cachedir, ''))
+    todo = {}
+    for val in experiments:
+        if val in res:
+            print(val + " is already in set")
+            continue
         totest = data[[v for v in data.columns[:-1]
                        if val + '-' in v or 'AAVS1' in v]]
         cls = ['Condition' if val + '-' in v else 'DMSO' for v in totest.columns]
         if scaling:
             if abs(scaling[val.split('_')[1]][0]) > scaling[val.split('_')[1]][1]:
-                print("rescaling this one")
+                print("rescaling " + val)
+                totest = totest.copy()
                 cols = [i for i in totest.columns if val + '-' in i]
                 totest[cols] = totest[cols] * \
                     (2**scaling[val.split('_')[1]][0])
-        if val in res:
-            print(val + " is already in set")
-            continue
-        res[val] = gseapy.gsea(data=totest, gene_sets=geneset,
-                               cls=cls, no_plot=False, processes=cores)
-        res[val].res2d['Term'] = [i for i in res[val].res2d.index]
-        for i, v in res.items():
-            res[i].res2d['Term'] = [cleanfunc(i) for i in v.res2d['Term']]
+        if cachedir:
+            key = hashlib.md5(pd.util.hash_pandas_object(totest).values.tobytes() +
+                              str(list(totest.columns) + cls).encode() + gshash.encode()).hexdigest()
+            cached = os.path.join(cachedir, key + '.pkl')
+            if os.path.exists(cached):
+                print(val + " found in cache")
+                res[val] = pd.read_pickle(cached)
+                continue
+        else:
+            cached = None
+        todo[val] = (totest, cls, cached)
+    if todo:
+        jobs = min(len(todo), cores)
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            running = {pool.submit(_runGSEA, totest, cls, genesets, max(1, cores // jobs)): val
+                       for val, (totest, cls, _) in todo.items()}
+            for job in as_completed(running):
+                val = running[job]
+                print(val + " done")
+                r = job.result()
+                r['Term'] = [cleanfunc(i) for i in r['Term']]
+                if todo[val][2]:
+                    r.to_pickle(todo[val][2])
+                res[val] = r
+    for i, val in enumerate(experiments):
         plt.figure(i)
-        sns.barplot(data=res[val].res2d.iloc[:25], x="es", y="Term",
-                    hue_order="geneset_size").set_title(val)
-    a = set()
-    for k, val in res.items():
-        a.update(set(val.res2d.Term))
-    a = {i: [0] * len(res) for i in a}
-    for n, (k, val) in enumerate(res.items()):
-        for i, v in val.res2d.iterrows():
-            a[v.Term][n] = v.es
-    pres = pd.DataFrame(a, index=res.keys())
-    a = sns.clustermap(figsize=(25, 20), data=res, vmin=-1,
-                       vmax=1, yticklabels=res.index, cmap=plt.cm.RdYlBu)
-    b = sns.clustermap(-res.T.corr(), cmap=plt.cm.RdYlBu, vmin=-1, vmax=1)
+        sns.barplot(data=res[val].iloc[:25], x="es", y="Term").set_title(val)
+    pres = pd.concat([v[['Term', 'es']].assign(experiment=k) for k, v in res.items()])
+    pres = pres.pivot_table(index='experiment', columns='Term', values='es', aggfunc='first').fillna(0)
+    pres = pres.loc[list(res.keys())].astype(float)
+    a = sns.clustermap(figsize=(25, 20), data=pres, vmin=-1,
+                       vmax=1, yticklabels=pres.index, cmap=plt.cm.RdYlBu)
+    b = sns.clustermap(-pres.T.corr(), cmap=plt.cm.RdYlBu, vmin=-1, vmax=1)
     if savename:
-        res.to_csv(savename + ".csv")
+        pres.to_csv(savename + ".csv")
         a.savefig(savename + "_genesets.pdf")
         b.savefig(savename + "_correlation.pdf")
     return pres, res
 
 
-def runERCC(ERCC, experiments, featurename="Feature", issingle=False, dilution=1 / 100,
-            name="RNPv2", spikevol=1, control="AAVS1", fdr=0.1, totalrnamass=0.5):
+# Mix 1 / Mix 2 ratio of the 4 subpools of the Ambion ERCC ExFold RNA spike-in mixes (92 ERCCs)
+ERCC_SUBPOOLS = {
+    4.: """
+    00130 00004 00136 00108 00116 00092 00095 00131
+    00062 00019 00144 00170 00154 00085 00028 00033
+    00134 00147 00097 00156 00123 00017 00083
+    """,
+    1.: """
+    00096 00171 00009 00042 00060 00035 00025 00051
+    00053 00148 00126 00034 00150 00067 00031 00109
+    00073 00158 00104 00142 00138 00117 00075
+    """,
+    2 / 3: """
+    00074 00113 00145 00111 00076 00044 00162 00071
+    00084 00099 00054 00157 00143 00039 00058 00120
+    00040 00164 00024 00016 00012 00098 00057
+    """,
+    0.5: """
+    00002 00046 00003 00043 00022 00112 00165 00079
+    00078 00163 00059 00160 00014 00077 00069 00137
+    00013 00168 00041 00081 00086 00061 00048
+    """,
+}
+ERCC_MIX_RATIOS = {'ERCC-' + ercc: ratio for ratio, erccs in ERCC_SUBPOOLS.items() for ercc in erccs.split()}
+
+
+def runERCC(ERCC, experiments, featurename="Feature", issingle=False, control="AAVS1", fdr=0.1,
+            ratios=ERCC_MIX_RATIOS, spikecontrolscontain="ERCC-", mincount=1):
     """
-    Runs the ERCC dashboard Rpackage on your notebook
+    Estimates the mRNA fraction ratio (r_m) of each experiment against the control from its ERCC spike ins
+
+    as ERCCdashboard's est_r_m does: after normalizing by library size, the expected (mixture) log ratio of
+    each ERCC minus its log ratio between the experiment and the control is an estimate of log r_m.
+    Those are averaged over the ERCCs detected in all replicates, for all experiments at once.
 
-    you will need to run this function from ipython and to have the R package erccdashboard installed
+    erccdashboard's dilution, spikevol, totalrnamass and name parameters were removed: they only change the
+    ERCC amounts and the plots, not r_m.
 
     Args:
     ----
-      ERCC: a pandas.df rows: ERCC counts columns: [experimentA_X,..., experimentD_X..., control_X] where X is the replicate number
+      ERCC: a pandas.df rows: ERCC (and gene) counts columns: [experimentA_X,..., experimentD_X..., control_X] where X is the replicate number
       experiments: a list of experiment names (here experimentA,.. experimentD)
-      featurename: columns where the ERCC pseudo gene names are stored
+      featurename: columns where the ERCC pseudo gene names are stored (else uses the index)
       issingle: ERCC parameters to choose between Single and RatioPair
-      dilution: ERCC dilution parameter
-      name: the name of the experiment set
-      spikevol: ERCC spikevol parameter
       control: the control name (here control)
-      fdr: ERCC fdr parameter
-      totalrnamass: ERCC totalrnamass parameter
+      fdr: false discovery rate under which an experiment's r_m is reported as different from 1
+      ratios: dict(ERCC name: float) the expected experiment/control ratio of each ERCC for RatioPair
+        (defaults to the Mix 1 / Mix 2 ratios of the ERCC ExFold subpools, experiments having Mix 1)
+      spikecontrolscontain: str the rows whose names contain this are ERCCs, the others are only used for the library size
+      mincount: int min count in every replicate for an ERCC to be used
 
     Returns:
     -------
-      a dict(experimentName:(val, ste)) a dict containing the scaling factor and its standard error for each experiment
-
-    Raises:
-    ------
-      RuntimeError: if you are not on ipython
-    """
-    try:
-        ipython = get_ipython()
-    except:
-        raise RuntimeError('you need to be on ipython')
-    print('you need to have R installed with the erccdashboard library installed')
-    ipython.magic("load_ext rpy2.ipython")
-    ipython.magic("R library('erccdashboard')")
-    # "count" for RNA-Seq data, "array" for microarray data
-    ipython.magic("R datType = 'count'")
-    # flag to indicate if input expression measures are already normalized, default is FALSE
-    ipython.magic("R isNorm = F")
-    # user defined filename prefix for results files
-    ipython.magic("R -i name filenameRoot = name")
-    # name for sample 2 in the experiment
-    ipython.magic("R -i control sample2Name = control")
-    # name of ERCC mixture design, "RatioPair" is default
-    ipython.magic(
-        "R -i issingle erccmix <- if(issingle) 'Single' else 'RatioPair'")
-    # dilution factor used for Ambion spike-in mixtures
-    ipython.magic("R -i dilution erccdilution = dilution")
-    # volume (in microliters) of diluted spike-in mixture added to total RNA mass
-    ipython.magic("R -i spikevol spikeVol = spikevol")
-    # user defined false discovery rate (FDR), default is 0.05
-    ipython.magic("R -i fdr choseFDR = fdr")
-    ipython.magic("R exDat = ''")
-    ipython.magic("R -i totalrnamass totalRNAmass <- totalrnamass")
-
-    cols = list(ERCC.columns)
-    cols.sort()
+      a dict(experimentName:(val, ste)) a dict containing the log2 scaling factor and its standard error for each experiment
+    """
+    names = ERCC[featurename] if featurename in ERCC.columns else ERCC.index.to_series()
+    names = names.astype(str)
+    counts = ERCC.drop(columns=[featurename]) if featurename in ERCC.columns else ERCC
+    if issingle:
+        expected = np.zeros(len(counts))
+    else:
+        expected = np.log2(names.map(ratios).astype(float).values)
+    isercc = names.str.contains(spikecontrolscontain, regex=False).values & ~np.isnan(expected)
+    libsize = counts.values.sum(0).astype(float)
+    spikes = counts.values[isercc].astype(float)
+    expected = expected[isercc]
+    with np.errstate(divide='ignore'):
+        lognorm = np.log2(spikes / libsize)
+    detected = spikes >= mincount
+
+    cols = counts.columns.astype(str)
+    iscontrol = cols.str.contains(control + "-", regex=False)
+    if not iscontrol.any():
+        raise ValueError('no ' + control + ' replicate')
+    # columns x experiments matrix averaging each experiment's replicates
+    design = np.array([cols.str.contains(val + '-', regex=False) for val in experiments], dtype=float).T
+    found = design.sum(0) > 0
+    if not found.all():
+        print("no replicates for " + str(np.array(experiments)[~found]))
+    design, kept = design[:, found], np.array(experiments)[found]
+    lognorm[~detected] = 0
+    # the ERCCs' normalized ratio is their expected ratio / r_m
+    diff = expected[:, None] - lognorm.dot(design / design.sum(0)) + lognorm[:, iscontrol].mean(1)[:, None]
+    valid = (detected.astype(float).dot(design) == design.sum(0)) & detected[:, iscontrol].all(1)[:, None]
+    n = valid.sum(0)
+    diff[~valid] = 0
+    mean = diff.sum(0) / np.maximum(n, 1)
+    var = ((diff - mean)**2 * valid).sum(0) / np.maximum(n - 1, 1)
+    se = np.sqrt(var / np.maximum(n, 1))
     res = {}
-    for val in experiments:
-        d = {}
-        e = 0
-        c = 0
-        d.update({
-            featurename: 'Feature'
-        })
-        for i in cols:
-            if val + '-' in i:
-                e += 1
-                d.update({i: val.split('_')[-1] + '_' + str(e)})
-            if control + "-" in i:
-                c += 1
-                d.update({i: control + "_" + str(c)})
-        a = ERCC[list(d.keys())].rename(columns=d)
-        a.to_csv('/tmp/ERCC_estimation.csv', index=None)
-        val = val.split('_')[-1]
-
-        ipython.magic("R -i val print(val)")
-
-        ipython.magic("R print(sample2Name)")
-        ipython.magic("R a <- read.csv('/tmp/ERCC_estimation.csv')")
-        ipython.magic("R print(head(a))")
-
-        try:
-
-            ipython.magic("R -i val exDat = initDat(datType=datType, isNorm=isNorm, exTable=a,\
-                                 filenameRoot=filenameRoot, sample1Name=val,\
-                                 sample2Name=sample2Name, erccmix=erccmix,\
-                                 erccdilution=erccdilution, spikeVol=spikeVol,\
-                                 totalRNAmass=totalRNAmass, choseFDR=choseFDR)")
-            ipython.magic("R exDat = est_r_m(exDat)")
-            ipython.magic("R exDat = dynRangePlot(exDat)")
-
-        except Warning:
-            print("failed for " + val)
+    pvals = {}
+    for val, m, s, c in zip(kept, mean, se, n):
+        if c < 2:
+            print("not enough ERCCs detected for " + val)
             continue
-        except:
-            print('worked for ' + val)
-
-        ipython.magic("R print(summary(exDat))")
-        ipython.magic("R grid.arrange(exDat$Figures$dynRangePlot)")
-        ipython.magic("R grid.arrange(exDat$Figures$r_mPlot)")
-        ipython.magic("R grid.arrange(exDat$Figures$rangeResidPlot)")
-
-        ipython.magic("R -o rm rm <- exDat$Results$r_m.res$r_m.mn")
-        ipython.magic("R -o se se <- exDat$Results$r_m.res$r_m.mnse")
-        ipython.magic("R write.csv(c(rm,se), file = '/tmp/JKBIO_ercc.csv')")
-        ipython.magic("R print(se,rm)")
-        l = h.fileToList("/tmp/JKBIO_ercc.csv")
-        res[val] = (float(l[1][4:]), float(l[2][4:]))
-    for i, v in res.items():
-        if abs(v[0]) > v[1]:
-            print(i, v[0])
+        res[val.split('_')[-1]] = (m, s)
+        pvals[val.split('_')[-1]] = 2 * stats.t.sf(abs(m) / s, c - 1) if s > 0 else float(m == 0)
+    # Benjamini-Hochberg over the experiments
+    order = sorted(pvals, key=pvals.get)
+    qvals = np.minimum.accumulate([pvals[i] * len(order) / (k + 1) for k, i in enumerate(order)][::-1])[::-1]
+    for i, q in zip(order, qvals):
+        if q < fdr:
+            print(i, res[i][0])
     return res
 
 
 def mergeSplicingVariants(df, defined='.'):
-    df = df.sort_index()
-    foundpoint = False
-    # pdb.set_trace()
-    torename = {}
-    todrop = []
-    for i, v in enumerate(df.index.tolist()):
-        h.showcount(i, len(df))
-        if foundpoint:
-            if foundpoint in v:
-                tomerge.append(v)
-            else:
-                if foundpoint not in df.index:
-                    if len(tomerge) > 1:
-                        #print("merging "+str(len(tomerge)))
-                        df.loc[foundpoint] = df.loc[tomerge].sum()
-                        todrop.extend(tomerge)
-                    else:
-                        torename.update({tomerge[0]: foundpoint})
-                else:
-                    todrop.extend(tomerge)
-                    tomerge.append(foundpoint)
-                    df.loc[foundpoint] = df.loc[tomerge].sum()
-                foundpoint = False
-        elif defined in v:
-            foundpoint = v.split(defined)[0]
-            tomerge = [v]
-    if len(torename) > 0:
-        df = df.rename(index=torename)
-    df = df.drop(index=todrop)
-    return df
+    """
+    merges the splicing variants of a gene (e.g. GENE.1, GENE.2) into a single GENE row by summing them
+
+    if GENE already exists as a row, the variants are added to it. A gene with only one
+    variant gets renamed to GENE.
+
+    Args:
+    -----
+      df: pd.df rows: transcripts/genes, columns: samples
+      defined: str the separator between the gene name and the variant id
+
+    Returns:
+    --------
+      the dataframe with one row per gene, sorted by index
+    """
+    df = df.copy()
+    df.index = df.index.astype(str).str.partition(defined).get_level_values(0)
+    # min_count keeps rows that were NaN-only and not merged as NaN
+    return df.groupby(level=0, sort=True).sum(min_count=1)
 
 def readFromSlamdunk(loc='res/count/', flag_var=100, convertTo='symbol',
                      minvar_toremove=0, mincount_toremove=5):
@@ -551,126 +654,236 @@ def DESeqSamples(data, experiments, scaling=None, keep=True, rescaling=None, res
     return results
 
 
-def gsva(data, geneset_file, pathtoJKBio, method='ssgsea'):
+def ssGSEA(data, genesets, alpha=0.25, normalize=True, minsize=1, maxsize=np.inf, chunksize=1000, cores=1):
+    """
+    single sample GSEA (Barbie et al. 2009), computed the same way as GSVA's method='ssgsea'
+
+    for each sample, genes are ranked by expression and the running sum enrichment of each gene set
+    is computed. The sum of the running sum only depends on the position of each gene in the ranking,
+    so all gene sets of a chunk of samples are scored at once with a few sparse matrix products.
+
+    Args:
+    -----
+      data: pd.df rows: genes, columns: samples (no missing values)
+      genesets: dict(str: list[str]) of gene sets or a filepath to a .gmt file / name of an Enrichr library
+      alpha: float the weight given to the ranks in the running sum (tau in GSVA)
+      normalize: bool whether to divide the scores by their range over all samples and gene sets (as GSVA does)
+      minsize: int minimum size of a gene set (once restricted to the genes in data)
+      maxsize: int maximum size of a gene set (once restricted to the genes in data)
+      chunksize: int number of samples scored at once (bounds the memory used)
+      cores: int number of chunks scored in parallel
+
+    Returns:
+    --------
+      pd.df rows: gene sets, columns: samples the enrichment scores
+    """
+    if type(genesets) is str:
+        genesets = loadGeneSets(genesets)
+    if data.index.duplicated().any():
+        raise ValueError('gene names need to be unique')
+    if data.isnull().values.any():
+        raise ValueError('data contains missing values')
+    n = len(data)
+    names = []
+    rows = []
+    cols = []
+    for name, geneset in genesets.items():
+        idx = np.unique(data.index.get_indexer(list(geneset)))
+        idx = idx[idx >= 0]
+        if minsize <= len(idx) <= maxsize and len(idx) < n:
+            rows.extend([len(names)] * len(idx))
+            cols.extend(idx)
+            names.append(name)
+    if len(names) == 0:
+        raise ValueError('no gene set matches the genes in data')
+    member = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(names), n))
+    outsize = (n - np.asarray(member.sum(1)).ravel())[:, None]
+    values = data.values
+
+    def score(start):
+        # GSVA ranks with as.integer(rank(x))
+        ranks = pd.DataFrame(values[:, start:start + chunksize]).rank(axis=0).values.astype(int)
+        # decreasing order, ties keep the gene order as R's order() does
+        order = np.argsort(-ranks, axis=0, kind='stable')
+        pos = np.empty_like(order)
+        np.put_along_axis(pos, order, np.arange(n)[:, None], axis=0)
+        # a gene at position p adds to the running sum n - p times
+        times = (n - pos).astype(float)
+        weights = np.abs(ranks).astype(float)**alpha
+        ins = member.dot(weights * times) / member.dot(weights)
+        outs = (n * (n + 1) / 2 - member.dot(times)) / outsize
+        return ins - outs
+
+    starts = range(0, values.shape[1], chunksize)
+    if cores > 1:
+        with ThreadPoolExecutor(max_workers=cores) as pool:
+            es = list(pool.map(score, starts))
+    else:
+        es = [score(start) for start in starts]
+    es = np.hstack(es)
+    if normalize:
+        es = es / (es.max() - es.min())
+    return pd.DataFrame(data=es, index=names, columns=data.columns)
+
+
+def gsva(data, geneset_file, pathtoJKBio=None, method='ssgsea', cores=1):
+  """
+  scores each sample on a set of gene sets using GSVA's methods
+
+  'ssgsea' is computed in python (see ssGSEA), other methods call R's GSVA package
+
+  Args:
+  -----
+    data: pd.df rows: genes, columns: samples
+    geneset_file: str filepath to a .gmt file
+    pathtoJKBio: str path to the JKBio folder (defaults to this package's location), only used for R methods
+    method: str one of 'ssgsea', 'gsva', 'zscore', 'plage'
+    cores: int number of cores used by ssgsea
+
+  Returns:
+  --------
+    pd.df rows: gene sets, columns: samples the enrichment scores
+  """
+  if method == 'ssgsea':
+    return ssGSEA(data, geneset_file, cores=cores)
   print('you need to have R installed with GSVA and GSEABase library installed')
-  data.to_csv('/tmp/data_JKBIOhelper_gsva.csv')
-  cmd = "Rscript "+pathtoJKBio + \
-      "/rna/ssGSEA.R /tmp/data_JKBIOhelper_gsva.csv " + geneset_file + " " + method
-  res = subprocess.run(cmd, shell=True, capture_output=True)
-  if res.returncode != 0:
-    raise ValueError('issue with the command: ' + str(res))
-  print(res)
-  res = pd.read_csv("/tmp/res_JKBIO_ssGSEA.tsv", sep='\t')
+  script = os.path.join(pathtoJKBio, 'rna') if pathtoJKBio else os.path.dirname(os.path.abspath(__file__))
+  with tempfile.TemporaryDirectory() as folder:
+    data.to_csv(os.path.join(folder, 'data.csv'))
+    res = subprocess.run(['Rscript', os.path.join(script, 'ssGSEA.R'), os.path.join(folder, 'data.csv'),
+                          geneset_file, method, os.path.join(folder, 'res.tsv')], capture_output=True)
+    if res.returncode != 0:
+      raise ValueError('issue with the command: ' + str(res))
+    res = pd.read_csv(os.path.join(folder, 'res.tsv'), sep='\t')
   return res
 
 
-def filterRNAfromQC(rnaqc, folder='tempRNAQCplot/', plot=True, qant1=0.07, qant3=0.93, thresholds={}):
-    thresh = {'minmapping': 0.8,  # Mapping Rate
-              'minendmapping': 0.75,
-              'minefficiency': 0.6,  # Expression Profiling Efficiency
-              'maxendmismatch': 0.025,  # Base Mismatch end wise
-              'maxmismatch': 0.02,  # Base Mismatch
-              'minhighqual': 0.6,  # High Quality Rate
-              'minexon': 0.6,  # Exonic Rate
-              "maxambiguous": 0.2,  # Ambiguous Alignment Rate
-              "maxsplits": 0.1,  # Avg. Splits per Read
-              "maxalt": 0.65,  # Alternative Alignments rate
-              "maxchim": 0.3,  # Chimeric Alignment Rate
-              "minreads": 20000000,
-              "minlength": 80,  # Read Length
-              "maxgenes": 35000,
-              "mingenes": 10000,
-              }
+RNAQC_THRESHOLDS = {'minmapping': 0.8,  # Mapping Rate
+                    'minendmapping': 0.75,
+                    'minefficiency': 0.6,  # Expression Profiling Efficiency
+                    'maxendmismatch': 0.025,  # Base Mismatch end wise
+                    'maxmismatch': 0.02,  # Base Mismatch
+                    'minhighqual': 0.6,  # High Quality Rate
+                    'minexon': 0.6,  # Exonic Rate
+                    "maxambiguous": 0.2,  # Ambiguous Alignment Rate
+                    "maxsplits": 0.1,  # Avg. Splits per Read
+                    "maxalt": 0.65,  # Alternative Alignments rate
+                    "maxchim": 0.3,  # Chimeric Alignment Rate
+                    "minreads": 20000000,
+                    "minlength": 80,  # Read Length
+                    "maxgenes": 35000,
+                    "mingenes": 10000,
+                    }
+
+# (failed check name, RNAseQC metric, op, threshold key, metric it is divided by)
+# a sample fails a check when `metric op threshold` is true
+RNAQC_CHECKS = [("Mapping Rate", "Mapping Rate", '<', 'minmapping', None),
+                ("Base Mismatch", "Base Mismatch", '>', 'maxmismatch', None),
+                ("End 1 Mapping Rate", "End 1 Mapping Rate", '<', 'minendmapping', None),
+                ("End 2 Mapping Rate", "End 2 Mapping Rate", '<', 'minendmapping', None),
+                ("End 1 Mismatch Rate", "End 1 Mismatch Rate", '>', 'maxendmismatch', None),
+                ("End 2 Mismatch Rate", "End 2 Mismatch Rate", '>', 'maxendmismatch', None),
+                ("Expression Profiling Efficiency", "Expression Profiling Efficiency", '<', 'minefficiency', None),
+                ("High Quality Rate", "High Quality Rate", '<', 'minhighqual', None),
+                ("Exonic Rate", "Exonic Rate", '<', 'minexon', None),
+                ("Ambiguous Alignment Rate", "Ambiguous Alignment Rate", '>', 'maxambiguous', None),
+                ("Avg. Splits per Read", "Avg. Splits per Read", '<', 'maxsplits', None),
+                ("Alternative Alignments", "Alternative Alignments", '>', 'maxalt', "Total Reads"),
+                ("Chimeric Alignment Rate", "Chimeric Alignment Rate", '>', 'maxchim', None),
+                ("Total Reads", "Total Reads", '<', 'minreads', None),
+                ("Read Length", "Read Length", '<', 'minlength', None),
+                ("Max Genes Detected", "Genes Detected", '>', 'maxgenes', None),
+                ("Min Genes Detected", "Genes Detected", '<', 'mingenes', None),
+                ]
+
+
+def evaluateQC(qcs, checks=RNAQC_CHECKS, thresholds={}):
+    """
+    evaluates a set of QC checks on all samples at once
+
+    Args:
+    -----
+      qcs: pd.df rows: samples, columns: QC metrics
+      checks: list[tuple(name, metric, op, threshold key, divided by)] the checks to apply (see RNAQC_CHECKS)
+        op is one of '<', '>', '<=', '>='
+      thresholds: dict(threshold key: value) overrides the values in RNAQC_THRESHOLDS
+
+    Returns:
+    --------
+      pd.df(bool) samples x checks, true where the sample failed the check
+    """
+    thresh = dict(RNAQC_THRESHOLDS)
     thresh.update(thresholds)
+    ops = {'<': np.less, '>': np.greater, '<=': np.less_equal, '>=': np.greater_equal}
+    checks = pd.DataFrame(checks, columns=['name', 'metric', 'op', 'key', 'by'])
+    values = qcs[checks.metric].values.astype(float)
+    hasby = checks.by.notna().values
+    if hasby.any():
+        values[:, hasby] = values[:, hasby] / qcs[checks.by[hasby]].values.astype(float)
+    limits = checks.key.map(thresh).values.astype(float)
+    failed = np.zeros(values.shape, dtype=bool)
+    for op, func in ops.items():
+        cols = (checks.op == op).values
+        failed[:, cols] = func(values[:, cols], limits[cols])
+    return pd.DataFrame(data=failed, index=qcs.index, columns=checks.name.values)
+
+
+def _plotQCmetric(qc, filename, failed, qant1, qant3):
+    """
+    draws and saves the violin plot of one QC metric, highlighting the outliers (used by filterRNAfromQC)
+    """
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    sns.violinplot(y=qc, ax=ax)
+    q1 = qc.quantile(qant1)
+    q3 = qc.quantile(qant3)
+    outlier_top_lim = q3 + 1.5 * (q3 - q1)
+    outlier_bottom_lim = q1 - 1.5 * (q3 - q1)
+    for k, v in qc[(qc < outlier_bottom_lim) | (qc > outlier_top_lim)].items():
+        ax.text(0.05, v, k, ha='left', va='center',
+                color='red' if k in failed else 'black')
+    fig.savefig(filename)
+    return filename
+
+
+def filterRNAfromQC(rnaqc, folder='tempRNAQCplot/', plot=True, qant1=0.07, qant3=0.93, thresholds={},
+                    checks=RNAQC_CHECKS, cores=8):
+    """
+    finds the RNAseq samples failing QC from an RNAseQC metrics table
 
-    qcs = rnaqc.T
-    tot = []
-    a = qcs[(qcs["Mapping Rate"] < thresh['minmapping']) | (qcs["Base Mismatch"] > thresh['maxmismatch']) |
-            (qcs["End 1 Mapping Rate"] < thresh['minendmapping']) | (qcs["End 2 Mapping Rate"] < thresh['minendmapping']) |
-            (qcs["End 1 Mismatch Rate"] > thresh['maxendmismatch']) | (qcs["End 2 Mismatch Rate"] > thresh['maxendmismatch']) |
-            (qcs["Expression Profiling Efficiency"] < thresh['minefficiency']) | (qcs["High Quality Rate"] < thresh['minhighqual']) |
-            (qcs["Exonic Rate"] < thresh['minexon']) | (qcs["Ambiguous Alignment Rate"] > thresh['maxambiguous']) |
-            (qcs["Avg. Splits per Read"] < thresh['maxsplits']) | (qcs["Alternative Alignments"] > thresh['maxalt']*qcs["Total Reads"]) |
-            (qcs["Chimeric Alignment Rate"] > thresh['maxchim']) | (qcs["Total Reads"] < thresh['minreads']) |
-            (qcs["Read Length"] < thresh['minlength']) | (thresh['maxgenes'] < qcs["Genes Detected"]) |
-            (qcs["Genes Detected"] < thresh['mingenes'])].index.tolist()
-
-    tot.append([1 if i in qcs[(qcs["Mapping Rate"] <
-                               thresh['minmapping'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Base Mismatch"] >
-                               thresh['maxmismatch'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["End 1 Mapping Rate"] <
-                               thresh['minendmapping'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["End 2 Mapping Rate"] <
-                               thresh['minendmapping'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["End 1 Mismatch Rate"] >
-                               thresh['maxendmismatch'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["End 2 Mismatch Rate"] >
-                               thresh['maxendmismatch'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Expression Profiling Efficiency"]
-                               < thresh['minefficiency'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["High Quality Rate"] <
-                               thresh['minhighqual'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Exonic Rate"] < thresh['minexon'])
-                              ].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Ambiguous Alignment Rate"] >
-                               thresh['maxambiguous'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Avg. Splits per Read"] <
-                               thresh['maxsplits'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Alternative Alignments"] > thresh['maxalt']
-                               * qcs["Total Reads"])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Chimeric Alignment Rate"] >
-                               thresh['maxchim'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Total Reads"] < thresh['minreads'])
-                              ].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Read Length"] <
-                               thresh['minlength'])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(thresh['maxgenes'] <
-                               qcs["Genes Detected"])].index.tolist() else 0 for i in a])
-    tot.append([1 if i in qcs[(qcs["Genes Detected"] <
-                               thresh['mingenes'])].index.tolist() else 0 for i in a])
-
-    res = pd.DataFrame(index=a, columns=["Mapping Rate",
-                                         "Base Mismatch",
-                                         "End 1 Mapping Rate",
-                                         "End 2 Mapping Rate",
-                                         "End 1 Mismatch Rate",
-                                         "End 2 Mismatch Rate",
-                                         "Expression Profiling Efficiency",
-                                         "High Quality Rate",
-                                         "Exonic Rate",
-                                         "Ambiguous Alignment Efficiency",
-                                         "Avg. Splits per Read",
-                                         "Alternative Alignments",
-                                         "Chimeric Alignment Rate",
-                                         "Total Reads",
-                                         "Read Length",
-                                         "Min Genes Detected",
-                                         "Max Genes Detected"], data=np.array(tot).astype(bool).T)
+    Args:
+    -----
+      rnaqc: pd.df rows: QC metrics, columns: samples
+      folder: str where to save the results and the plots
+      plot: bool whether or not to plot the failed samples and each QC metric's distribution
+      qant1: float lower quantile used to flag outliers on the plots
+      qant3: float upper quantile used to flag outliers on the plots
+      thresholds: dict(threshold key: value) overrides the values in RNAQC_THRESHOLDS
+      checks: list[tuple(name, metric, op, threshold key, divided by)] the checks to apply (see RNAQC_CHECKS)
+      cores: int number of processes used to render the metrics' plots
 
+    Returns:
+    --------
+      pd.df(bool) failed samples x checks, true where the sample failed the check
+    """
+    res = evaluateQC(rnaqc.T, checks, thresholds)
+    res = res[res.any(axis=1)]
+    a = res.index.tolist()
     print(a)
     h.createFoldersFor(folder)
     res.to_csv(folder+'_qc_results.csv')
     if plot and len(res)>0:
-        h.createFoldersFor(folder)
         _, ax = plt.subplots(figsize=(10, 10))
         plot = sns.heatmap(res, ax=ax)
         plt.show()
         plot.get_figure().savefig(folder+'failed_qc.pdf')
-
-        for val in rnaqc.index:
-            qc = rnaqc.loc[val]
-            boxplot = sns.violinplot(y=qc)
-            q1 = qc.quantile(qant1)
-            q3 = qc.quantile(qant3)
-            outlier_top_lim = q3 + 1.5 * (q3 - q1)
-            outlier_bottom_lim = q1 - 1.5 * (q3 - q1)
-            for k, v in qc[(qc < outlier_bottom_lim) | (qc > outlier_top_lim)].iteritems():
-                plt.text(0.05, v, k, ha='left', va='center',
-                         color='red' if k in a else 'black')
-            plt.show()
-            plt.savefig(folder +
-                        val.replace(' ', '_').replace('/', '_')+'.pdf')
+        failed = set(a)
+        with ProcessPoolExecutor(max_workers=cores) as pool:
+            jobs = [pool.submit(_plotQCmetric, rnaqc.loc[val], folder + val.replace(' ', '_').replace('/', '_') + '.pdf',
+                                failed, qant1, qant3) for val in rnaqc.index]
+            for job in as_completed(jobs):
+                job.result()
     return res
 
 
@@ -691,21 +904,63 @@ def getDifferencesFromCorrelations(df1, df2, minsimi=0.99999999999999):
     return res
 
 
-def rnaseqcorrelation(cn, rna, ax=None, name=None):
+def rnaseqcorrelation(cn, rna, ax=None, name=None, method='pearson', axis=0, chunksize=None, plot=True):
   """
   correlates the copy number to the rnaseq in ccle and shows the plot
 
   Gene names should be thee same ones, sample names as welll
+  the correlations are computed for all genes at once, ignoring missing values pair-wise
+
+  Args:
+  -----
+    cn: pd.df samples x genes the copy number
+    rna: pd.df samples x genes the expression
+    ax: a matplotlib axis to plot on
+    name: str the name of the correlation column
+    method: str one of 'pearson', 'spearman'
+    axis: int 0 to correlate each column (gene) accross rows, 1 to correlate each row accross columns
+    chunksize: int if provided, the number of columns/rows processed at once (for very large matrices)
+    plot: bool whether or not to plot the distribution of the correlations
+
+  Returns:
+  --------
+    pd.df the correlation, its pvalue and the number of values used, for each gene
   """
-  a = set(cn.columns) & set(rna.columns)
-  ind = set(cn.index) & set(rna.index)
-  re = rna.loc[ind]
-  ce = cn.loc[ind]
-  print(len(ind), len(a))
-  corr = np.array([pearsonr(ce[j], re[j])[0] for j in a])
-  #corr = pd.DataFrame(data=corr, columns=[name if name is not None else "data"])
-  print(np.mean(corr), len(corr))
-  sns.kdeplot(corr, ax=ax) if ax is not None else sns.kdeplot(corr)
+  cols = cn.columns.intersection(rna.columns)
+  ind = cn.index.intersection(rna.index)
+  print(len(ind), len(cols))
+  x = cn.loc[ind, cols].values.astype(float)
+  y = rna.loc[ind, cols].values.astype(float)
+  names = cols
+  if axis == 1:
+    x, y, names = x.T, y.T, ind
+  step = x.shape[1] if chunksize is None else chunksize
+  corr = []
+  n = []
+  for i in range(0, x.shape[1], step):
+    cx, cy = x[:, i:i + step], y[:, i:i + step]
+    mask = ~(np.isnan(cx) | np.isnan(cy))
+    cx, cy = np.where(mask, cx, np.nan), np.where(mask, cy, np.nan)
+    if method == 'spearman':
+      cx, cy = pd.DataFrame(cx).rank().values, pd.DataFrame(cy).rank().values
+    elif method != 'pearson':
+      raise ValueError('method needs to be one of pearson, spearman')
+    count = mask.sum(0)
+    cx = np.where(mask, cx - np.nansum(cx, 0) / count, 0)
+    cy = np.where(mask, cy - np.nansum(cy, 0) / count, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      corr.append((cx * cy).sum(0) / np.sqrt((cx**2).sum(0) * (cy**2).sum(0)))
+    n.append(count)
+  corr = np.clip(np.concatenate(corr), -1, 1)
+  n = np.concatenate(n)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    tstat = corr * np.sqrt((n - 2) / (1 - corr**2))
+  pvalue = 2 * stats.t.sf(np.abs(tstat), n - 2)
+  res = pd.DataFrame(index=names, data={name if name is not None else "corr": corr, "pvalue": pvalue, "n": n})
+  print(np.nanmean(corr), len(corr))
+  if plot:
+    sns.kdeplot(corr[~np.isnan(corr)], ax=ax) if ax is not None else sns.kdeplot(corr[~np.isnan(corr)])
+  return res
 
 
 def findMissAnnotatedReplicates(repprofiles, goodprofile, names, exactMatch=True):
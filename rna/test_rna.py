@@ -0,0 +1,51 @@
+from JKBio import rna
+import numpy as np
+import pandas as pd
+import pysam
+
+
+def write_bam(path, flags):
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'ERCC-00002', 'LN': 1000}]}
+    with pysam.AlignmentFile(path, 'wb', header=header) as bam:
+        for i, flag in enumerate(flags):
+            read = pysam.AlignedSegment()
+            read.query_name = 'read%d' % i
+            read.query_sequence = 'ACGT' * 10
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = 10 * i
+            read.mapping_quality = 60
+            read.cigarstring = '40M'
+            if flag & 0x1:
+                read.next_reference_id = 0
+                read.next_reference_start = 10 * i + 100
+            bam.write(read)
+
+
+def test_spike_in_single_end_counts(tmp_path):
+    # mapped, mapped, duplicate, unmapped
+    write_bam(str(tmp_path / 'sample.sorted.bam'), [0, 16, 0x400, 0x4])
+    name, mapped = rna._spikeInSample('sample.sorted.bam', 'ref.fa', '', str(tmp_path) + '/', totrim=False,
+                                      tomap=False, tofilter=False)
+    assert name == 'sample'
+    assert mapped == 2
+
+
+def test_spike_in_paired_end_counts(tmp_path):
+    # properly paired, mate unmapped, unpaired
+    write_bam(str(tmp_path / 'sample_1.sorted.bam'), [0x1 | 0x2 | 0x40, 0x1 | 0x8 | 0x40, 0])
+    name, mapped = rna._spikeInSample('sample_1.sorted.bam', 'ref.fa', '', str(tmp_path) + '/', pairedEnd=True,
+                                      totrim=False, tomap=False, tofilter=False)
+    assert name == 'sample_1'
+    assert mapped == 1
+
+
+def test_merge_splicing_variants():
+    df = pd.DataFrame({'s1': [1., 2., 3., 4., 5., np.nan], 's2': [0., 1., 0., 1., 0., np.nan]},
+                      index=['B.1', 'A', 'A.1', 'A.2', 'C.x.2', 'D.1'])
+    res = rna.mergeSplicingVariants(df)
+    # variants are added to an existing gene row, a lone variant is renamed to its gene
+    expected = pd.DataFrame({'s1': [9., 1., 5., np.nan], 's2': [2., 0., 0., np.nan]}, index=['A', 'B', 'C', 'D'])
+    pd.testing.assert_frame_equal(res, expected)
+    assert list(rna.mergeSplicingVariants(df.rename(index={'C.x.2': 'C-x'}), defined='-').index) == \
+        ['A', 'A.1', 'A.2', 'B.1', 'C', 'D.1']
@@ -23,6 +23,7 @@ setup(
         "dalmatian",
         "firecloud_dalmatian",
         "google_api_python_client",
+        "google_cloud_storage",
         "gsheets",
         "gspread",
         "ipdb",
@@ -31,6 +32,7 @@ setup(
         "numpy",
         "pandas",
         "Pillow",
+        "pyarrow",
         "pybedtools",
         "pyBigWig",
         "pysam",
@@ -8,88 +8,351 @@ import pandas as pd
 import dalmatian as dm
 import numpy as np
 import os
+import random
 import re
 import signal
+import threading
 from JKBio.utils import helper as h
 from JKBio.google import gcp
 import pdb
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from gsheets import Sheets
 
 
-def createManySubmissions(workspace, workflow, references, entity=None, expression=None, use_callcache=True):
+class TerraSession:
+  '''
+  a dalmatian WorkspaceManager memoizing the entity tables of its workspace
+
+  tables are downloaded once and reused for ttl seconds. Any write through the session
+  (update_*, upload_*, delete_*, ...) drops the cached tables so they are fetched again.
+  Every other WorkspaceManager method is available as is on the session.
+
+  input:
+  workspace: str namespace/workspace from url typically (or an already created WorkspaceManager)
+  ttl: float seconds during which a downloaded table is reused
+  '''
+  WRITES = ('update_', 'upload_', 'delete_', 'import_', 'copy_', 'add_', 'remove_', 'patch_')
+
+  def __init__(self, workspace, ttl=300):
+    self.wm = dm.WorkspaceManager(workspace) if type(workspace) is str else workspace
+    self.workspace = workspace if type(workspace) is str else \
+        getattr(workspace, 'namespace', '') + '/' + getattr(workspace, 'workspace', '')
+    self.ttl = ttl
+    self._cache = {}
+    self._lock = threading.RLock()
+
+  def __str__(self):
+    return self.workspace
+
+  def _get(self, key, fetch):
+    with self._lock:
+      if key in self._cache and time.time() - self._cache[key][0] < self.ttl:
+        val = self._cache[key][1]
+      else:
+        val = fetch()
+        self._cache[key] = (time.time(), val)
+    # callers often modify the tables they get
+    return val.copy() if hasattr(val, 'copy') else val
+
+  def refresh(self, key=None):
+    """
+    drops the cached tables (or only the one named key, e.g. 'samples') so they are downloaded again
+    """
+    with self._lock:
+      if key is None:
+        self._cache = {k: v for k, v in self._cache.items() if k == 'bucket'}
+      else:
+        self._cache.pop(key, None)
+
+  def disable_hound(self):
+    self.wm.disable_hound()
+    return self
+
+  def get_bucket_id(self):
+    return self._get('bucket', self.wm.get_bucket_id)
+
+  def get_samples(self):
+    return self._get('samples', self.wm.get_samples)
+
+  def get_pairs(self):
+    return self._get('pairs', self.wm.get_pairs)
+
+  def get_sample_sets(self):
+    return self._get('sample_sets', self.wm.get_sample_sets)
+
+  def get_pair_sets(self):
+    return self._get('pair_sets', self.wm.get_pair_sets)
+
+  def get_participants(self):
+    return self._get('participants', self.wm.get_participants)
+
+  def get_entities(self, etype, **kwargs):
+    return self._get('entities_' + etype + (str(sorted(kwargs.items())) if kwargs else ''),
+                     lambda: self.wm.get_entities(etype, **kwargs))
+
+  def get_submission_status(self, **kwargs):
+    return self._get('submission_status' + str(sorted(kwargs.items())),
+                     lambda: self.wm.get_submission_status(**kwargs))
+
+  def __getattr__(self, name):
+    attr = getattr(self.wm, name)
+    if callable(attr) and name.startswith(self.WRITES):
+      def write(*args, **kwargs):
+        try:
+          return attr(*args, **kwargs)
+        finally:
+          self.refresh()
+      return write
+    return attr
+
+
+def getSession(workspace, ttl=300):
+  """
+  returns a TerraSession for this workspace (the same one if workspace already is a TerraSession)
+
+  Args:
+  ----
+    workspace: str namespace/workspace from url typically, a WorkspaceManager or a TerraSession
+    ttl: float seconds during which a downloaded table is reused
+
+  Returns:
+  -------
+    TerraSession
   """
-  wrapper to create many submissions for a workflow
+  return workspace if isinstance(workspace, TerraSession) else TerraSession(workspace, ttl)
+
+
+def _usedGsFiles(wm):
+  """
+  the set of gs paths listed in the samples, pairs and sample_sets tables of a TerraSession (memoized with them)
+  """
+  def used():
+    sam = pd.concat([wm.get_samples(), wm.get_pairs(), wm.get_sample_sets()])
+    return set([val for val in sam.values.ravel() if type(val) is str and val[:5] == 'gs://'])
+  return wm._get('gsfiles', used)
+
+
+ACTIVE_SUBMISSION_STATUS = {'Accepted', 'Evaluating', 'Submitting', 'Submitted', 'Aborting'}
+
+
+def _isTransient(error):
+  """
+  whether an error from the Terra API is worth retrying (rate limits, server errors, network errors)
+  """
+  for arg in getattr(error, 'args', []):
+    code = getattr(arg, 'status_code', None)
+    if code is not None:
+      return code in {429, 500, 502, 503, 504}
+  return isinstance(error, (ConnectionError, TimeoutError)) or \
+      type(error).__name__ in {'ConnectionError', 'Timeout', 'ReadTimeout', 'ConnectTimeout'}
+
+
+def createManySubmissions(workspace, workflow, references, entity=None, expression=None, use_callcache=True,
+                          cores=8, rate=5, retries=4, backoff=2, skip_active=True):
+  """
+  creates many submissions for a workflow from a thread pool
+
+  submissions are created concurrently, at most rate per second. Transient API errors are retried
+  with a jittered exponential backoff and a reference failing does not stop the other ones.
 
   Args:
   ----
-    workspace: str namespace/workspace from url typically
+    workspace: str namespace/workspace from url typically (or a TerraSession/WorkspaceManager)
+    workflow: str name of the workflow configuration
     references: list(str) a list of name of the row in this entity
     entity: str terra csv type (sample_id...)
     expresson: str to use if want to compute on the direct value of the entity or on values of values
                 e.g. this.samples
     use_callcache: Bool to false if want to recompute everything even if same input
+    cores: int max number of submissions being created at the same time
+    rate: float max number of submissions created per second (None for no limit)
+    retries: int number of retries on transient errors
+    backoff: float seconds to wait before the first retry (doubles at each retry)
+    skip_active: bool to not resubmit references which already have an active submission of this workflow
+      (their current submission id is returned instead)
 
   Returns:
   ------
-    submission_ids list(str) the submission ids
+    dict(reference: str submission id or the Exception raised when creating it)
+  """
+  wm = getSession(workspace)
+  if type(references) is str:
+    references = [references]
+  res = {}
+  if skip_active:
+    for sub in wm.list_submissions(config=workflow):
+      if sub['status'] in ACTIVE_SUBMISSION_STATUS and sub['submissionEntity']['entityName'] in references:
+        res[sub['submissionEntity']['entityName']] = sub['submissionId']
+    if len(res) > 0:
+      print("skipping " + str(len(res)) + " references with an active submission")
+  lock = threading.Lock()
+  nextslot = [time.time()]
+
+  def submit(ref):
+    for attempt in range(retries + 1):
+      if rate:
+        with lock:
+          # rate limiting: each call books the next free slot
+          wait = nextslot[0] - time.time()
+          nextslot[0] = max(nextslot[0], time.time()) + 1 / rate
+        if wait > 0:
+          time.sleep(wait)
+      try:
+        return wm.create_submission(workflow, ref, entity, expression, use_callcache)
+      except Exception as e:
+        if attempt == retries or not _isTransient(e):
+          return e
+        time.sleep(backoff * 2**attempt * random.uniform(0.5, 1.5))
+
+  todo = [ref for ref in dict.fromkeys(references) if ref not in res]
+  with ThreadPoolExecutor(max_workers=cores) as pool:
+    for ref, val in zip(todo, pool.map(submit, todo)):
+      res[ref] = val
+  failed = [ref for ref, val in res.items() if isinstance(val, Exception)]
+  if len(failed) > 0:
+    print(str(len(failed)) + " submissions could not be created: " + str(failed))
+  return res
+
+
+FINISHED_STATUS = {'Done', 'Aborted', 'Failed', 'Succeeded'}
+FAILED_STATUS = {'Failed', 'Aborted'}
+
+
+def _submissionStatus(wm, submission_id):
   """
-  wm = dm.WorkspaceManager(workspace)
-  submission_ids = []
-  for ref in references:
-    submission_ids += [wm.create_submission(workflow, ref, entity, expression, use_callcache)]
-  return submission_ids
+  polls one submission and summarizes the status of its workflows (used by monitorSubmissions)
+  """
+  workflows = wm.get_submission(submission_id)["workflows"]
+  status = {}
+  failed = []
+  for i in workflows:
+    status[i['status']] = status.get(i['status'], 0) + 1
+    if i['status'] in FAILED_STATUS:
+      failed.append(i["workflowEntity"]["entityName"])
+  return {'status': status, 'failed': failed,
+          'finished': all(i['status'] in FINISHED_STATUS for i in workflows)}
+
+
+def monitorSubmissions(workspace, submissions, cores=8, mininterval=10, maxinterval=300, callback=None, maxerrors=10):
+  """
+  polls many submissions concurrently until they are all finished, with an adaptive backoff
+
+  each submission is polled again after mininterval seconds when its workflows changed status since
+  the last poll, and the interval doubles (up to maxinterval) while nothing changes. A submission stops being
+  polled (and is reported with its error) when polling it fails with a non transient error, or fails maxerrors times.
 
+  Args:
+  -----
+    workspace: str namespace/workspace from url typically (or a TerraSession/WorkspaceManager)
+    submissions: list[str] of submission ids
+    cores: int number of submissions polled at the same time
+    mininterval: float seconds between polls of a submission whose status is changing
+    maxinterval: float max seconds between polls of a submission whose status is not changing
+    callback: function(submission_id, dict) called after each poll with the row of this submission
+      in the status table
+    maxerrors: int number of failed polls after which a submission is not polled anymore
 
-def waitForSubmission(workspace, submissions, raise_errors=True):
+  Returns:
+  -------
+    pd.dataframe: for each submission, the number of workflows in each status, the failed entities,
+      whether it is finished, the number of polls, the failed polls, the error that stopped the polling
+      (None if it did not) and the seconds elapsed
   """
-  wrapper to create many submissions for a workflow
+  wm = getSession(workspace).disable_hound()
+  if type(submissions) is str:
+    submissions = [submissions]
+  start = time.time()
+  table = {s: {'failed': [], 'finished': False, 'polls': 0, 'errors': 0, 'error': None, 'elapsed': 0.}
+           for s in submissions}
+  interval = {s: mininterval for s in submissions}
+  nextpoll = {s: start for s in submissions}
+  with ThreadPoolExecutor(max_workers=cores) as pool:
+    while len(nextpoll) > 0:
+      now = time.time()
+      due = [s for s, t in nextpoll.items() if t <= now]
+      if len(due) == 0:
+        time.sleep(max(0, min(nextpoll.values()) - now))
+        continue
+      futures = {pool.submit(_submissionStatus, wm, s): s for s in due}
+      for future in as_completed(futures):
+        s = futures[future]
+        row = table[s]
+        row['polls'] += 1
+        row['elapsed'] = time.time() - start
+        try:
+          res = future.result()
+        except Exception as e:
+          # transient API errors just delay the next poll
+          print("could not poll submission " + s + ": " + str(e))
+          row['errors'] += 1
+          changed = False
+          if not _isTransient(e) or row['errors'] >= maxerrors:
+            row['error'] = e
+        else:
+          changed = res['status'] != row.get('status')
+          row.update(res)
+        if row['finished'] or row['error'] is not None:
+          del nextpoll[s]
+        else:
+          interval[s] = mininterval if changed else min(interval[s] * 2, maxinterval)
+          nextpoll[s] = time.time() + interval[s]
+        if callback is not None:
+          callback(s, row)
+  rows = {}
+  for s, row in table.items():
+    rows[s] = dict(row.get('status', {}), **{k: v for k, v in row.items() if k != 'status'})
+  table = pd.DataFrame.from_dict(rows, orient='index')
+  status = [c for c in table.columns if c not in {'failed', 'finished', 'polls', 'errors', 'error', 'elapsed'}]
+  table[status] = table[status].fillna(0).astype(int)
+  return table
+
+
+def waitForSubmission(workspace, submissions, raise_errors=True, cores=8, mininterval=10, maxinterval=300,
+                      callback=None, maxerrors=10):
+  """
+  an await function on Terra jobs: polls all submissions concurrently until they are finished
 
   Args:
   -----
-    workspace: str namespace/workspace from url typically
+    workspace: str namespace/workspace from url typically (or a TerraSession/WorkspaceManager)
     submissions: list[str] of submission ids
     raise_errors: bool to true if errors should stop your code
+    cores: int number of submissions polled at the same time
+    mininterval: float seconds between polls of a submission whose status is changing
+    maxinterval: float max seconds between polls of a submission whose status is not changing
+    callback: function(submission_id, dict) called after each poll (defaults to printing the progress)
+    maxerrors: int number of failed polls of a submission after which we stop waiting for it and raise
 
   Returns:
   -------
     list of ids of failed submissions
   """
-  failed_submission = []
-  timing = 0
-  wm = dm.WorkspaceManager(workspace).disable_hound()
   assert submissions is not None
-  if type(submissions) is type(""):
+  if type(submissions) is str:
     submissions = [submissions]
-  for scount, submission_id in enumerate(submissions):
-    finished = False
-    while not finished:
-      done = 0
-      failed = 0
-      finished = True
-      submission = wm.get_submission(submission_id)["workflows"]
-      for _, i in enumerate(submission):
-        if i['status'] not in {'Done', 'Aborted', 'Failed', 'Succeeded'}:
-          finished = False
-        elif i["status"] in {'Failed', 'Aborted'}:
-          failed += 1
-          if i["workflowEntity"]["entityName"] not in failed_submission:
-            print(i["workflowEntity"]["entityName"])
-            failed_submission.append(i["workflowEntity"]["entityName"])
-        elif i["status"] in {'Done', 'Succeeded'}:
-          done += 1
-      if not finished:
-        time.sleep(40)
-        print("status is: Done for " + str(done) + " jobs in submission " + str(scount) + ". " + str(timing) + ",5 mn elapsed.", end="\r")
-        timing += 1
-        time.sleep(20)
-        print("status is: Failed for " + str(failed) + " jobs in submission " + str(scount) + ". " + str(timing) + " mn elapsed.", end="\r")
-      else:
-        print(str(done / (done + failed)) + " of jobs Succeeded in submission " + str(scount) + ".")
+  finished = set()
+
+  def progress(submission_id, row):
+    if row['finished'] and submission_id not in finished:
+      finished.add(submission_id)
+      total = sum(row.get('status', {}).values())
+      print(str((total - len(row['failed'])) / max(total, 1)) + " of jobs Succeeded in submission " +
+            submission_id + ".")
+    print(str(len(finished)) + "/" + str(len(submissions)) + " submissions finished. " +
+          str(int(row['elapsed'] / 60)) + " mn elapsed.", end="\r")
+
+  table = monitorSubmissions(workspace, submissions, cores, mininterval, maxinterval,
+                             progress if callback is None else callback, maxerrors)
+  errored = table['error'].dropna()
+  if len(errored) > 0:
+    raise RuntimeError("could not poll submissions " + ', '.join(errored.index), errored.tolist())
+  failed_submission = []
+  for failed in table['failed']:
+    failed_submission.extend([f for f in failed if f not in failed_submission])
   if len(failed_submission) > 0 and raise_errors:
     raise RuntimeError(str(len(failed_submission)) + " failed submission")
   return failed_submission
-  # print and return well formated data
 
 
 def removeSamples(workspace, samples):
@@ -98,10 +361,10 @@ def removeSamples(workspace, samples):
 
   Args:
   -----
-    workspace: str workspace name
+    workspace: str workspace name (or a TerraSession)
     samples: list of samples
   """
-  wm = dm.WorkspaceManager(workspace).disable_hound()
+  wm = getSession(workspace).disable_hound()
   try:
     wm.delete_sample(samples)
   except:
@@ -114,9 +377,17 @@ def removeSamples(workspace, samples):
     wm.delete_sample(samples)
 
 
+UPLOAD_FORMATS = {
+    # fformat: (regex matching the files of the format, whose group is the mate, {mate: column})
+    'bambai': (r'\.(bam|bai)$', {'bam': 'bam', 'bai': 'bai'}),
+    'fastq12': (r'([12])\.(?:fastq|fq)\.gz$', {'1': 'fastq1', '2': 'fastq2'}),
+    'fastqR1R2': (r'.*(R[12]).*\.(?:fastq|fq)\.gz$', {'R1': 'fastq1', 'R2': 'fastq2'}),
+}
+
+
 def uploadFromFolder(gcpfolder, prefix, workspace, sep='_', loc=0,
                      fformat="fastq12", newsamples=None, samplesetname=None, source='U',
-                     bamcol="bam", baicol="bai", test=True):
+                     bamcol="bam", baicol="bai", test=True, batchsize=1000):
   """
   upload samples (virtually: only creates tsv file) from a google bucket to a terra workspace
 
@@ -125,134 +396,94 @@ def uploadFromFolder(gcpfolder, prefix, workspace, sep='_', loc=0,
   it can create a sample set.
   for a set of files: gs://bucket/path/to/files
 
+  files are paired by sample in one pass, samples missing one of their files raise an error.
 
   Args:
   -----
     gcpfolder: a gs folder path
     prefix: str the folder path
-    workspace: str namespace/workspace from url typically
+    workspace: str namespace/workspace from url typically (or a TerraSession)
     sep: str the separator (only takes the first part of the name before the sep character)
     fformat bambai, fastq12, fastqR1R2 given the set of files in the folder (they need to be in this naming format)
             e.g. name.bam name.bai / name1.fastq name2.fastq / name_R1.fastq name_R2.fastq
     newsamples: DONT USE
     samplesetname: str all uploaded samples should be part of a sampleset with name..
+    test: bool dry run: only print and return the table that would be uploaded
+    batchsize: int number of samples uploaded (upserted) in each request
 
   Returns:
   --------
     the uploaded dataframe
   """
-  wm = dm.WorkspaceManager(workspace)
+  wm = getSession(workspace)
   print('please be sure you gave access to your terra email account access to this bucket')
   if samplesetname is None:
     samplesetname = 'from:' + gcpfolder + prefix
+  if fformat == "bambai" and newsamples is not None:
+    # TODO: check if each column exists and can be added, else don't add it
+    for i, val in enumerate(newsample["file_path"]):
+      if val.split('/')[-1].split('.')[1] != "WholeGenome" or val.split('/')[-2] != "bam":
+        newsample = newsample.drop(i)
+      elif val.split('/')[1] != 'gs:':
+        newsample["file_path"][i] = gcpfolder + newsample["file_path"][i].split('/')[-1]
+    newsample = newsample.reset_index(drop=True)
+    newsample = newsample.rename(index=str, columns={"sample_name": "sample_id", "subject_name": "participant_id", "file_path": "WGS_bam"})
+    currfile = ""
+    bai = [''] * int(newsample.shape[0])
+    # creating an array of bai and adding it to their coresponding bams
+    for i in newsample.index:
+      currfile = newsample["WGS_bam"][i]
+      if currfile.split('/')[-1].split('.')[-1] == "bai":
+        bai[int(newsample[newsample["WGS_bam"] == currfile[:-4]].index.values[0])] = currfile
+    newsample["WGS_bam_index"] = pd.Series(bai, index=newsample.index)
+    # removing original bai rows
+    for i in newsample.index:
+      currfile = newsample["WGS_bam"][i]
+      if currfile.split('/')[-1].split('.')[-1] == "bai":
+        newsample = newsample.drop(i)
+    newsample = newsample.reset_index(drop=True)
+    newsample["sample_set"] = pd.Series([samplesetname] * int(newsample.shape[0]), index=newsample.index)
+    newsample.set_index("sample_id", inplace=True, drop=True)
+    newsample = newsample[newsample.columns.tolist()[1:] + [newsample.columns.tolist()[0]]]
+    newsample = newsample.loc[~newsample.index.duplicated(keep='first')]
+    newsample.to_csv("temp/samples.bambai.tsv", sep="\t")
+    wm.upload_samples(newsample)
+    wm.update_sample_set(samplesetname, newsample.index)
+    return newsample
+  pattern, columns = UPLOAD_FORMATS[fformat]
+  pattern = re.compile(pattern)
+  if fformat == 'bambai':
+    columns = {'bam': bamcol, 'bai': baicol}
   files = gcp.list_blobs_with_prefix(gcpfolder, prefix, '/')
-  if fformat == "bambai":
-    if newsamples is None:
-      data = {'sample_id': [], bamcol: [], baicol: []}
-      for file in files:
-        if file.split('.')[-1] in ["bam", "bai"]:
-          name = file.split('/')[-1].split('.')[0].split(sep)[loc]
-          if name in data['sample_id']:
-            pos = data['sample_id'].index(name)
-            if file[-4:] == ".bam":
-              data[bamcol].insert(pos, 'gs://' + gcpfolder + '/' + file)
-            elif file[-4:] == ".bai":
-              data[baicol].insert(pos, 'gs://' + gcpfolder + '/' + file)
-          else:
-            data['sample_id'].append(name)
-            if file[-4:] == ".bam":
-              data[bamcol].append('gs://' + gcpfolder + '/' + file)
-            elif file[-4:] == ".bai":
-              data[baicol].append('gs://' + gcpfolder + '/' + file)
-            else:
-              raise Exception("No fastq R1/R2 error", file)
-        else:
-          print("unrecognized file type : " + file)
-      df = pd.DataFrame(data)
-      df = df.set_index("sample_id")
-      print(df)
-      df["participant"] = pd.Series(data['sample_id'], index=data['sample_id'])
-      wm.upload_samples(df)
-      wm.update_sample_set(samplesetname, df.index.values.tolist())
-    else:
-      # TODO: check if each column exists and can be added, else don't add it
-      for i, val in enumerate(newsample["file_path"]):
-        if val.split('/')[-1].split('.')[1] != "WholeGenome" or val.split('/')[-2] != "bam":
-          newsample = newsample.drop(i)
-        elif val.split('/')[1] != 'gs:':
-          newsample["file_path"][i] = gcpfolder + newsample["file_path"][i].split('/')[-1]
-      newsample = newsample.reset_index(drop=True)
-      newsample = newsample.rename(index=str, columns={"sample_name": "sample_id", "subject_name": "participant_id", "file_path": "WGS_bam"})
-      currfile = ""
-      bai = [''] * int(newsample.shape[0])
-      # creating an array of bai and adding it to their coresponding bams
-      for i in newsample.index:
-        currfile = newsample["WGS_bam"][i]
-        if currfile.split('/')[-1].split('.')[-1] == "bai":
-          bai[int(newsample[newsample["WGS_bam"] == currfile[:-4]].index.values[0])] = currfile
-      newsample["WGS_bam_index"] = pd.Series(bai, index=newsample.index)
-      # removing original bai rows
-      for i in newsample.index:
-        currfile = newsample["WGS_bam"][i]
-        if currfile.split('/')[-1].split('.')[-1] == "bai":
-          newsample = newsample.drop(i)
-      newsample = newsample.reset_index(drop=True)
-      newsample["sample_set"] = pd.Series([samplesetname] * int(newsample.shape[0]), index=newsample.index)
-      newsample.set_index("sample_id", inplace=True, drop=True)
-      newsample = newsample[newsample.columns.tolist()[1:] + [newsample.columns.tolist()[0]]]
-      newsample = newsample.loc[~newsample.index.duplicated(keep='first')]
-      newsample.to_csv("temp/samples.bambai.tsv", sep="\t")
-      wm.upload_samples(newsample)
-      wm.update_sample_set(samplesetname, newsample.index)
-  if fformat in {"fastq12", "fastqR1R2"}:
-    data = {'sample_id': [], 'fastq1': [], 'fastq2': []}
-    # print and return well formated data
-    print(files)
-    for file in files:
-      if file[-9:] == ".fastq.gz" or file[-6:] == ".fq.gz":
-        name = re.split(sep, file.split('/')[-1].split('.')[0])[loc]
-        if name in data['sample_id']:
-          pos = data['sample_id'].index(name)
-          if fformat == "fastqR1R2":
-            if "R1" in file:
-              data['fastq1'].insert(pos, 'gs://' + gcpfolder + '/' + file)
-            elif "R2" in file:
-              data['fastq2'].insert(pos, 'gs://' + gcpfolder + '/' + file)
-            else:
-              raise Exception("No fastq R1/R2 error", file)
-          else:
-            if file.split('.')[-3][-1] == '1':
-              data['fastq1'].insert(pos, 'gs://' + gcpfolder + '/' + file)
-            elif file.split('.')[-3][-1] == '2':
-              data['fastq2'].insert(pos, 'gs://' + gcpfolder + '/' + file)
-            else:
-              raise Exception("No fastq 1/2 error", file)
-        else:
-          data['sample_id'].append(name)
-          if fformat == "fastqR1R2":
-            if "R1" in file:
-              data['fastq1'].append('gs://' + gcpfolder + '/' + file)
-            elif "R2" in file:
-              data['fastq2'].append('gs://' + gcpfolder + '/' + file)
-            else:
-              raise Exception("No fastq R1/R2 error", file)
-          else:
-            if file.split('.')[-3][-1] == '1':
-              data['fastq1'].append('gs://' + gcpfolder + '/' + file)
-            elif file.split('.')[-3][-1] == '2':
-              data['fastq2'].append('gs://' + gcpfolder + '/' + file)
-            else:
-              raise Exception("No fastq R1/R2 error", file)
-      else:
-        print("unrecognized file type : " + file)
-    df = pd.DataFrame(data)
+  data = {}
+  for file in files:
+    match = pattern.search(file)
+    if match is None or match.group(1) not in columns:
+      print("unrecognized file type : " + file)
+      continue
+    name = re.split(sep, file.split('/')[-1].split('.')[0])[loc]
+    col = columns[match.group(1)]
+    sample = data.setdefault(name, {})
+    if col in sample:
+      raise ValueError("two " + col + " files for sample " + name, sample[col], file)
+    sample[col] = 'gs://' + gcpfolder + '/' + file
+  df = pd.DataFrame.from_dict(data, orient='index', columns=list(columns.values()))
+  df.index.name = 'sample_id'
+  incomplete = df.index[df.isna().any(axis=1)].tolist()
+  if len(incomplete) > 0:
+    raise ValueError("some samples are missing files", df.loc[incomplete])
+  if fformat != 'bambai':
     df["Source"] = source
-    df["participant"] = data['sample_id']
-    df = df.set_index("sample_id")
-    if not test:
-      wm.upload_samples(df)
-      wm.update_sample_set(samplesetname, df.index.values.tolist())
+  df["participant"] = df.index
+  print(df)
+  if test:
+    print("dry run: would upload " + str(len(df)) + " samples in " + str(-(-len(df) // batchsize)) +
+          " batches and set them as sample set " + samplesetname)
     return df
+  for i in range(0, len(df), batchsize):
+    wm.upload_samples(df.iloc[i:i + batchsize])
+  wm.update_sample_set(samplesetname, df.index.values.tolist())
+  return df
 
 
 def updateAllSampleSet(workspace, newsample_setname, Allsample_setname='All_samples'):
@@ -263,13 +494,14 @@ def updateAllSampleSet(workspace, newsample_setname, Allsample_setname='All_samp
 
   Args:
   ----
-    workspace: str namespace/workspace from url typically
+    workspace: str namespace/workspace from url typically (or a TerraSession)
     newsample_setname: str name of sampleset to add to All_samples
   """
-  prevsamples = list(dm.WorkspaceManager(workspace).get_sample_sets().loc[Allsample_setname]['samples'])
-  newsamples = list(dm.WorkspaceManager(workspace).get_sample_sets().loc[newsample_setname]['samples'])
-  prevsamples.extend(newsamples)
-  dm.WorkspaceManager(workspace).update_sample_set(Allsample_setname, list(set(prevsamples)))
+  wm = getSession(workspace)
+  samplesets = wm.get_sample_sets()
+  prevsamples = list(samplesets.loc[Allsample_setname]['samples'])
+  prevsamples.extend(list(samplesets.loc[newsample_setname]['samples']))
+  wm.update_sample_set(Allsample_setname, list(set(prevsamples)))
 
 
 def addToSampleSet(workspace, samplesetid, samples):
@@ -280,16 +512,17 @@ def addToSampleSet(workspace, samplesetid, samples):
 
   Args:
   ----
-    workspace: the workspace name
+    workspace: the workspace name (or a TerraSession)
     samplesetid: the sample set name
     samples: a list of samples
   """
+  wm = getSession(workspace)
   try:
-    prevsamples = dm.WorkspaceManager(workspace).get_sample_sets()['samples'][samplesetid]
+    prevsamples = wm.get_sample_sets()['samples'][samplesetid]
     samples.extend(prevsamples)
   except KeyError:
     print('The sample set ' + str(samplesetid) + ' did not exist in the workspace. Will be created now...')
-  dm.WorkspaceManager(workspace).update_sample_set(samplesetid, list(set(samples)))
+  wm.update_sample_set(samplesetid, list(set(samples)))
 
 
 def addToPairSet(workspace, pairsetid, pairs):
@@ -300,17 +533,17 @@ def addToPairSet(workspace, pairsetid, pairs):
 
   Args:
   ----
-    workspace: the workspace name
+    workspace: the workspace name (or a TerraSession)
     pairsetid: the pair set name
     pairs: a list of pairs
   """
-
+  wm = getSession(workspace)
   try:
-    prevpairs = dm.WorkspaceManager(workspace).get_pair_sets().loc[[pairsetid]].pairs[0]
+    prevpairs = wm.get_pair_sets().loc[[pairsetid]].pairs[0]
     pairs.extend(prevpairs)
   except KeyError:
     print('The pair set ' + str(pairsetid) + ' did not exist in the workspace. Will be created now...')
-  dm.WorkspaceManager(workspace).update_pair_set(pairsetid, list(set(pairs)))
+  wm.update_pair_set(pairsetid, list(set(pairs)))
 
 # Gwen's old version - caught some niche conditions made by get_pair_sets()
 # that I think may raise errors in the current version.
@@ -340,7 +573,7 @@ def saveOmicsOutput(workspace, pathto_cnvpng='segmented_copy_ratio_img',
 
   Args:
   -----
-    workspace: the workspace name
+    workspace: the workspace name (or a TerraSession)
     pathto_cnvpng: sample col of the CNV plot results
     pathto_stats: sample col of the bam QC results
     specific_cohorts: if provided, will only look for this specific
@@ -352,11 +585,12 @@ def saveOmicsOutput(workspace, pathto_cnvpng='segmented_copy_ratio_img',
     specific_samples: if provided will only look for these samples
 
   """
+  wm = getSession(workspace)
   if specific_cohorts:
-    samples = dm.WorkspaceManager(workspace).get_samples()
+    samples = wm.get_samples()
     samples = samples[samples.index.isin(specificlist)]
   if is_from_pairs:
-    pairs = dm.WorkspaceManager(workspace).get_pairs()
+    pairs = wm.get_pairs()
     pairs = pairs[pairs['case_sample'].isin(specificlist)]
   for i, val in samples.iterrows():
     os.system('gsutil cp ' + val[pathto_seg] + ' ' + datadir + i + '/')
@@ -372,18 +606,35 @@ def saveOmicsOutput(workspace, pathto_cnvpng='segmented_copy_ratio_img',
       os.system('gsutil cp ' + val[pathto_snv] + ' ' + datadir + i + '/')
 
 
+def _newGSPaths(paths, newgs, prevgslist=[], keeppath=True):
+  """
+  the new location of each gs path of a pd.Series in newgs (NaN for the paths that should not move, see changeGSlocation)
+  """
+  prefixes = sorted(prevgslist, key=len, reverse=True) if len(prevgslist) > 0 else []
+  prefix = re.compile('^(?:' + '|'.join(map(re.escape, prefixes)) + ')' if prefixes else r'^gs://[^/]+/')
+  paths = paths[paths.str.startswith('gs://') & ~paths.str.startswith(newgs)]
+  tomove = paths.str.contains(prefix)
+  if keeppath:
+    return paths[tomove].str.replace(prefix, newgs, n=1, regex=True).reindex(paths.index)
+  return (newgs + paths[tomove].str.split('/').str[-1]).reindex(paths.index)
+
+
 def changeGSlocation(workspacefrom, newgs, workspaceto=None, prevgslist=[], index_func=None,
-                     flag_non_matching=False, onlysamples=[], onlycol=[], entity='samples', droplists=True, keeppath=True, dry_run=True, par=20):
+                     flag_non_matching=False, onlysamples=[], onlycol=[], entity='samples', droplists=True, keeppath=True,
+                     dry_run=True, par=20, retries=3):
   """
   Function to move data around from one workspace to a bucket or to another workspace.
 
   can also work on dataframes containing lists of paths
 
+  files are moved in parallel and only the paths of the files actually moved are updated, so it can be run again
+  to resume an interrupted move
+
   Args:
   -----
-    workspacefrom: the workspace name where the data is
+    workspacefrom: the workspace name where the data is (or a TerraSession)
     newgs: the newgs bucket where to copy the data in
-    workspaceto: if we should have these new samples and columns added to another workspace instead \
+    workspaceto: (or a TerraSession) if we should have these new samples and columns added to another workspace instead \
     of just updating the same one (usefull to copy one workspace to another)
     prevgslist: if providded, will only move files that are in the set of google bucket listed here
     index_func: *WIP* unused
@@ -393,85 +644,68 @@ def changeGSlocation(workspacefrom, newgs, workspaceto=None, prevgslist=[], inde
     entity: the entity in the terra workspace on which to do this
     droplists: if set to true remove all columns containing list of paths (list of path are not uploaded well in terra)
     keeppath: if set to true, will keep the full object path and just change the bucket
+      (else raises if files with the same name would end up at the same location)
     dry_run: if set to true will not update anything on Terra but just return the result
-    par: on how many processor do the gs copy commands.
+    par: on how many threads do the gs moves.
+    retries: int times to retry moving a file on errors
 
   Returns:
   -------
     torename: the pandas.df containing the new paths
     flaglist: the samples that were non matching (if flag_non_matching is set to true)
   """
-  flaglist = []
-  wmfrom = dm.WorkspaceManager(workspacefrom)
+  newgs = newgs if newgs.endswith('/') else newgs + '/'
+  wmfrom = getSession(workspacefrom)
   a = wmfrom.get_entities(entity)
   if len(onlysamples) > 0:
     a = a[a.index.isin(onlysamples)]
-  print("using the data from " + workspacefrom + " " + entity + " list")
+  print("using the data from " + str(wmfrom) + " " + entity + " list")
   if len(a) == 0:
     raise ValueError('no ' + entity)
   if onlycol:
     a = a[onlycol]
-  todrop = set()
-  torename = {}
+  a = a[[i != 'nan' for i in a.index]]
   print('this should only contains gs:// paths otherwise precise columns using \"onlycol\"')
-  for col in a.columns.tolist():
-    val = []
-    for k, prev in a[col].iteritems():
-      if type(prev) is str:
-        new = prev
-        if newgs not in new:
-          if len(prevgslist) > 0:
-            for prevgs in prevgslist:
-              new = new.replace(prevgs, newgs)
-            if flag_non_matching:
-              if new == prev:
-                flaglist.append(prev)
-          if not keeppath:
-            new = newgs + new.split('/')[-1]
-          else:
-            new = newgs + '/'.join(new.split('/')[3:])
-        else:
-          print("sample " + str(k) + " was already in the new gs")
-        val.append(new)
-    # IN CASE WE HAVE A LIST
-      if type(prev) is list:
-        if droplists:
-          todrop.add(k)
-          continue
-        ind = []
-        for prevname in prev:
-          newname = prevname
-          if newgs not in newname:
-            if len(prevgslist) > 0:
-              for prevgs in prevgslist:
-                new = new.replace(prevgs, newgs)
-              if flag_non_matching:
-                if new == prev:
-                  flaglist.append(prev)
-            if not keeppath:
-              new = newgs + new.split('/')[-1]
-            else:
-              new = newgs + '/'.join(new.split('/')[3:])
-          else:
-            print("sample " + str(k) + " was already in the new gs")
-          ind.append(newname)
-        val.append(ind)
-    torename.update({col: val})
-    if not dry_run:
-      if keeppath:
-        h.parrun(['gsutil mv ' + a.iloc[i][col] + ' ' + v for i, v in enumerate(val)], cores=20)
-      else:
-        gcp.mvFiles(a[col].tolist(), newgs)
-    else:
-      if keeppath:
-        print(['gsutil mv ' + a.iloc[i][col] + ' ' + v for i, v in enumerate(val)])
-      else:
-        print("mv "+str(a[col].tolist()) +" "+newgs)
+  cells = a.stack()
+  islist = cells.map(lambda v: type(v) is list)
+  if droplists:
+    a = a.drop(columns=cells[islist].index.get_level_values(1).unique())
+    cells = cells[~islist]
+  # one row per path (list elements included)
+  paths = cells.explode()
+  paths = paths[paths.map(lambda v: type(v) is str)].reset_index(drop=True)
+  new = _newGSPaths(paths, newgs, prevgslist, keeppath)
+  flaglist = []
+  if len(prevgslist) > 0 and flag_non_matching:
+    flaglist = paths[new.index][new.isna()].tolist()
+  already = paths[paths.str.startswith(newgs)]
+  if len(already) > 0:
+    print(str(len(already)) + " files were already in the new gs")
+  new = new.dropna()
+  plan = pd.Series(new.values, index=paths[new.index].values)
+  plan = plan[~plan.index.duplicated()]
+  # different files moved to the same place would overwrite each other (e.g. same basenames with keeppath=False)
+  clashes = plan[plan.duplicated(keep=False)]
+  if len(clashes) > 0:
+    raise ValueError("some files would be moved to the same location", clashes.sort_values())
+  print('moving ' + str(len(plan)) + ' files to ' + newgs)
+  if not dry_run:
+    errors = gcp.mvFiles(plan.index.tolist(), plan.tolist(), group=par, retries=retries)
+    if len(errors) > 0:
+      # files moved by a previous run are already at their new location
+      failed = plan[[src for src, _ in errors]]
+      _, notthere = gcp.exists(failed.tolist())
+      plan = plan.drop(failed[failed.isin(notthere)].index)
+      print(str(len(notthere)) + ' files could not be moved, their paths are left unchanged')
+  else:
+    print(plan)
+  rename = plan.to_dict()
+  torename = a.apply(lambda col: col.map(lambda v: [rename.get(p, p) for p in v] if type(v) is list else
+                                         rename.get(v, v) if type(v) is str else v))
   if workspaceto is None:
     wmto = wmfrom
   else:
-    wmto = dm.WorkspaceManager(workspaceto)
-  torename = pd.DataFrame(data=torename, index=[i for i in a.index.tolist() if i != 'nan'])
+    wmto = getSession(workspaceto)
   if not dry_run:
     wmto.disable_hound().update_entity_attributes(entity, torename)
   return torename, flaglist
@@ -483,7 +717,7 @@ def renametsvs(workspace, wmto=None, index_func=None):
   only works for one use case
   """
   data = {}
-  wmfrom = dm.WorkspaceManager(workspace)
+  wmfrom = getSession(workspace)
   try:
     a = wmfrom.get_participants()
     data.update({'participants': a})
@@ -556,62 +790,99 @@ def renametsvs(workspace, wmto=None, index_func=None):
         wmto.update_sample_set(i, val.samples)
 
 
-def findBackErasedDuplicaBamteFromTerraBucket(workspace, gsfolder, bamcol="WES_bam", baicol="WES_bai"):
+def findBackErasedDuplicaBamteFromTerraBucket(workspace, gsfolder, bamcol="WES_bam", baicol="WES_bai", maxage=3600,
+                                              dryrun=False):
   """
   If you have erased bam files in gcp with bai files still present and the bam files are stored elsewhere
   and their location is in a terra workspace.
 
-  Will find them back by matching bai sizes and copy them back to their original locations
+  Will find them back by matching bai contents (crc32c) and move them back to their original locations
 
   Args:
   ----
-    workspace: str namespace/workspace from url typically
+    workspace: str namespace/workspace from url typically (or a TerraSession)
     gsfolder: str the gsfolder where the bam files are
     bamcol: str colname of the bam
     baicol: str colname of the bai
-  """
-  # get ls of all files folder
-  samples = os.popen('gsutil -m ls -al ' + gsfolder + '**.bai').read().split('\n')
-  # compute size filepath
+    maxage: float reuse the local inventory of gsfolder if it was listed less than maxage seconds ago
+    dryrun: only print the moves
 
-  sizes = {'gs://' + val.split('gs://')[1].split('#')[0]: int(val.split("2019-")[0]) for val in samples[:-2]}
-  names = {}
-  for k, val in sizes.items():
-    if val in names:
-      names[val].append(k)
-    else:
-      names[val] = [k]
-  # get all bai in tsv
-  samp = dm.WorkspaceManager(workspace).get_samples()
+  Returns:
+  -------
+    dict(found bam: original bam location) the moves
+  """
+  samp = getSession(workspace).get_samples()
+  for k in samp.index[(samp[bamcol] == 'NA') | (samp[baicol] == 'NA')]:
+    print("no data for " + str(k))
+  samp = samp[(samp[bamcol] != 'NA') & (samp[baicol] != 'NA')]
+  for k in samp.index[samp[bamcol].isna()]:
+    print('we dont have bam value for ' + str(k))
+  samp = samp[samp[bamcol].notna()]
+  # one batched existence check for all the bams, and one for the hashes of the bais of the missing ones
+  _, missing = gcp.exists(samp[bamcol].tolist())
+  samp = samp[samp[bamcol].isin(missing)]
+  hashes = gcp.getHashes(samp[baicol].tolist())
+  # bai and bam files of the folder, from the local inventory
+  gcp.updateInventory([gsfolder], maxage=maxage)
+  bais = gcp.queryInventory(gsfolder, 'bai')
+  bais = bais.groupby('crc32c')['path'].apply(list).to_dict()
+  bams = set(gcp.queryInventory(gsfolder, 'bam')['path'])
+  moves = {}
   for k, val in samp.iterrows():
-    if val[bamcol] != 'NA' and val[baicol] != 'NA':
-      # if bai has duplicate size
-      code = os.system('gsutil ls ' + val[bamcol])
-      if code == 256:
-        if val[bamcol] is None:
-          print('we dont have bam value for ' + str(k))
-          continue
-        else:
-          print('no match values for ' + str(val[bamcol]))
-
-        for va in names[sizes[val[baicol]]]:
-          # for all duplicate size
-          # if ls bam of bai duplicate size work
-          # mv bam to bampath in gsfolder
-          if '.bam' in va:
-            if os.system('gsutil ls ' + va.split('.bam.bai')[0] + ".bam") == 0:
-              print('gsutil mv ' + va.split('.bam.bai')[0] + ".bam " + val[bamcol])
-              os.system('gsutil mv ' + va.split('.bam.bai')[0] + ".bam " + val[bamcol])
-              break
-          elif os.system('gsutil ls ' + va.split('.bai')[0] + ".bam") == 0:
-            print('gsutil mv ' + va.split('.bai')[0] + ".bam " + val[bamcol])
-            os.system('gsutil mv ' + va.split('.bai')[0] + ".bam " + val[bamcol])
-            break
-      elif code == signal.SIGINT:
-        print('Awakened')
+    print('no match values for ' + str(val[bamcol]))
+    for va in bais.get(hashes.get(val[baicol]), []):
+      # for all the bais of same content, take the first one with a bam next to it
+      bam = va[:-4] if va.endswith('.bam.bai') else va[:-4] + '.bam'
+      if bam in bams and bam not in moves:
+        print('moving ' + bam + ' to ' + val[bamcol])
+        moves[bam] = val[bamcol]
         break
-    else:
-      print("no data for " + str(k))
+  if not dryrun and len(moves) > 0:
+    gcp.mvFiles(list(moves.keys()), list(moves.values()))
+  return moves
+
+
+def findDuplicatesInWorkspaces(workspaces=None, suffix='bam', minsize=1, maxage=3600, prefer=[]):
+  """
+  finds the files having the same content across the buckets of terra workspaces and plans their deduplication
+
+  files used in a workspace data table are always kept, see gcp.planDedup. apply the plan with gcp.applyDedupPlan
+
+  Args:
+  ----
+    workspaces: list[str] namespace/workspace (or TerraSessions) to look into (default: all your workspaces)
+    suffix: str only files ending with it (e.g. bam)
+    minsize: int only files of at least this many bytes
+    maxage: float reuse the local inventory of a bucket if it was listed less than maxage seconds ago
+    prefer: list[str] gs folders where to keep copies in priority, by decreasing priority
+
+  Returns:
+  -------
+    pd.df of duplicated files with path, size, crc32c, md5, cluster, action (keep|delete), kept and workspace columns
+  """
+  if workspaces is None:
+    workspaces = [val['workspace']['namespace'] + '/' + val['workspace']['name'] for val in dm.list_workspaces()]
+  buckets = {}
+  used = set()
+  for workspace in workspaces:
+    wm = getSession(workspace)
+    print(wm.workspace)
+    # the tables of every workspace are read, even when its bucket cannot be listed, as they can point to
+    # files in the other buckets. if they cannot be read, we stop rather than delete files they might use
+    used |= _usedGsFiles(wm)
+    buck = wm.get_bucket_id()
+    try:
+      gcp.updateInventory(['gs://' + buck + '/'], maxage=maxage)
+    except Exception:
+      print("cannot access this bucket")
+      continue
+    buckets[buck] = wm.workspace
+  dups = gcp.hashDuplicates(['gs://' + buck + '/' for buck in buckets], suffix, minsize)
+  plan = gcp.planDedup(dups, protect=used, prefer=prefer)
+  plan['workspace'] = plan['path'].str.split('/').str[2].map(buckets)
+  print('found ' + str(plan['cluster'].nunique()) + ' duplicated files, we can remove ' +
+        str(plan.loc[plan['action'] == 'delete', 'size'].sum() / 1000000000) + 'GB')
+  return plan
 
 
 def shareTerraBams(users, workspace, samples, bamcols=["internal_bam_filepath", "internal_bai_filepath"]):
@@ -624,7 +895,7 @@ def shareTerraBams(users, workspace, samples, bamcols=["internal_bam_filepath",
   Args:
   ----
     users: list[str] of users' google accounts
-    workspace: str namespace/workspace from url typically
+    workspace: str namespace/workspace from url typically (or a TerraSession)
     samples list[str] of samples_id for which you want to share data
     bamcols: list[str] list of column names of gsfiles to share
 
@@ -634,7 +905,7 @@ def shareTerraBams(users, workspace, samples, bamcols=["internal_bam_filepath",
   """
   if type(users) is str:
     users = [users]
-  wm = dm.WorkspaceManager(workspace)
+  wm = getSession(workspace)
   togiveaccess = np.ravel(wm.get_samples()[bamcols].loc[samples].values)
   for user in users:
     files = ''
@@ -724,12 +995,12 @@ def saveConfigs(workspace, filepath):
 
   Args:
   -----
-    workspace: str namespace/workspace from url typically
+    workspace: str namespace/workspace from url typically (or a TerraSession)
       namespace (str): project to which workspace belongs
       workspace (str): Workspace name
     filepath to save files
   """
-  wm = dm.WorkspaceManager(workspace)
+  wm = getSession(workspace)
   h.createFoldersFor(filepath)
 
   conf = wm.get_configs()
@@ -747,12 +1018,12 @@ def cleanWorkspace(workspaceid, only=[], toleave=[], defaulttoleave=['workspace'
   removes all processing folder in a terra workspace easily
 
   args:
-    workspaceid: str, the workspace
+    workspaceid: str, the workspace (or a TerraSession)
     toleave: a list of first order folder in the bucket that you don't want to be deleted
     defaulttoleave: it should contain non processing folders that contain metadata and files for the workspace
   """
   toleave.extend(defaulttoleave)
-  bucket = dm.WorkspaceManager(workspaceid).get_bucket_id()
+  bucket = getSession(workspaceid).get_bucket_id()
   res = subprocess.run('gsutil -m ls gs://' + bucket, shell=True, capture_output=True)
   if res.returncode != 0:
     raise ValueError(str(res.stderr))
@@ -821,13 +1092,13 @@ def delete_job(workspaceid, subid, taskid, DeleteCurrent=False, dryrun=True):
 
     Args:
     -----
-      workspaceid: str wokspace name
+      workspaceid: str wokspace name (or a TerraSession, to not download the data tables at each call)
       subid: str the name of the job
       taskid: str the name of the task in this job
       DeleteCurrent: bool whether or not to delete files if they appear in one of the sample/samplesets/pairs data tables
       dryrun: bool just plot the commands but don't execute them
     """
-    wm = dm.WorkspaceManager(workspaceid)
+    wm = getSession(workspaceid)
     bucket = wm.get_bucket_id()
     data= []
     if DeleteCurrent:
@@ -844,9 +1115,7 @@ def delete_job(workspaceid, subid, taskid, DeleteCurrent=False, dryrun=True):
       data += str(res.stdout)[2:-1].split('\\n')[:-1]
       if "TOTAL:" in data[-1]:
           data = data[:-1]
-      sam = pd.concat([wm.get_samples(), wm.get_pairs(), wm.get_sample_sets()])
-      tokeep = set([val for val in sam.values.ravel() if type(val) is str and val[:5]=='gs://'])
-      torm = set(data) - tokeep
+      torm = set(data) - _usedGsFiles(wm)
       if dryrun:
         print(torm)
       else:
@@ -862,14 +1131,15 @@ def removeFromFailedWorkflows(workspaceid, maxtime = '2020-06-10', everythingFor
 
     Args:
     -----
-      workspaceid: str the workspace name
+      workspaceid: str the workspace name (or a TerraSession)
       maxtime: str date format (eg. 2020-06-10) does not delete files generated past this date
       everythingFor: list[str] removes from these workflows even if not failed
       dryrun: bool whether or not to execute or just print commands
     """
-    wm = dm.WorkspaceManager(workspaceid)
+    # one session for all the jobs, so the data tables are only downloaded once
+    wm = getSession(workspaceid)
     for k, val in wm.get_submission_status(filter_active=False).iterrows():
-        if (val.Failed > 0 or val.configuration in everythingFor) and val.date.date() > pd.to_datetime(maxtime):
+        if (val.Failed > 0 or val.configuration in everythingFor) and val.date > pd.to_datetime(maxtime):
             for w in wm.get_submission(val.submission_id)['workflows']:
                 if w['status']=='Failed' or val.configuration in everythingFor:
                     try:
@@ -877,41 +1147,33 @@ def removeFromFailedWorkflows(workspaceid, maxtime = '2020-06-10', everythingFor
                     #else it was not even run
                     except:
                         continue
-                    delete_job(workspaceid,val.submission_id,a,dryrun=dryrun)
+                    delete_job(wm,val.submission_id,a,dryrun=dryrun)
 
 
-def deleteHeavyFiles(workspaceid, unusedOnly=True):
+def deleteHeavyFiles(workspaceid, unusedOnly=True, maxage=3600):
     """
     deletes all files above a certain size in a workspace (that are used or unused)
 
     Args:
     ----
-      workspaceid: str the name off the workspace
+      workspaceid: str the name off the workspace (or a TerraSession)
       unusedOnly: bool whether to delete used files as well (files that appear in one of the sample/samplesets/pairs data tables)
+      maxage: float reuse the local inventory of the bucket if it was listed less than maxage seconds ago
     """
-    wm = dm.WorkspaceManager(workspaceid)
+    wm = getSession(workspaceid)
     bucket = wm.get_bucket_id()
-    sizes = gcp.get_all_sizes('gs://'+bucket+'/')
-    print('we got '+str(len(sizes))+' files')
-    a  = list(sizes.keys())
-    a.sort()
+    print('we got '+str(gcp.updateInventory(['gs://'+bucket+'/'], maxage=maxage))+' files')
     ma = 100
-    torm = []
-    tot = 0
-    for i in a[::-1]:
-      if i>1000000*ma:
-        tot += i
-        for val in sizes[i]:
-          torm.append(val)
+    heavy = gcp.queryInventory('gs://'+bucket+'/', minsize=1000000*ma+1)
+    torm = heavy['path'].tolist()
+    tot = heavy['size'].sum()
     print('we might remove more than '+str(tot/1000000000)+'GB')
     if unusedOnly:
-      sam = pd.concat([wm.get_samples(),wm.get_pairs(),wm.get_sample_sets()])
-      tokeep = set([val for val in sam.values.ravel() if type(val) is str and val[:5]=='gs://'])
-      torm = set(torm) - tokeep
+      torm = set(torm) - _usedGsFiles(wm)
     return torm
 
 
-def findFilesInWorkspaces(names=[], lookup=['**', '*.', '.*']):
+def findFilesInWorkspaces(names=[], lookup=['**', '*.', '.*'], maxage=3600):
     """
     given All your terra workspaces, find a given gs filename
 
@@ -921,6 +1183,7 @@ def findFilesInWorkspaces(names=[], lookup=['**', '*.', '.*']):
       lookup: list[str] a set of flags giving how to look
         [** through all folders, *. can be preprended with anything,
         .* can be appended with anything]
+      maxage: float reuse the local inventory of a bucket if it was listed less than maxage seconds ago
     """
     ws = dm.list_workspaces()
     print('listing workspacs')
@@ -930,30 +1193,14 @@ def findFilesInWorkspaces(names=[], lookup=['**', '*.', '.*']):
         val = val['workspace']
         print(val['namespace']+"/"+val['name'])
         buck = 'gs://'+val['bucketName']+"/"
-        if subprocess.run('gsutil ls '+buck, capture_output=True, shell=True).returncode != 0:
+        try:
+            gcp.updateInventory([buck], maxage=maxage)
+        except Exception:
             print("cannot access this bucket")
             continue
         if len(names) == 0:
             file.append(buck)
-        if '**' in lookup:
-            buck += '**'
-        if not '*.' in lookup:
-            buck += '/'
-        for name in names:
-            val = buck+name
-            if '.*' in lookup:
-                val += '*'
-            data = subprocess.run("gsutil -m ls " + val,
-                                  capture_output=True, shell=True)
-            if data.returncode != 0:
-                if "One or more URLs matched no objects" not in str(data.stderr):
-                    raise ValueError(
-                        'issue with the command: ' + str(data.stderr))
-            if len(str(data.stdout)) < 4:
-                continue
-            res += str(data.stdout)[2:-1].split('\\n')[:-1]
-            if "TOTAL:" in res[-1]:
-                res = res[:-1]
+        res += gcp.searchInventory(names, lookup, folder=buck)
     return res
 
 def updateWorkflows(workflowIDs, path):
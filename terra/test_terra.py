@@ -0,0 +1,96 @@
+from JKBio import terra
+import threading
+
+
+class Response:
+  def __init__(self, status_code):
+    self.status_code = status_code
+
+
+class APIError(Exception):
+  """
+  raised like the firecloud errors, with the http response as argument
+  """
+  def __init__(self, status_code):
+    super().__init__(Response(status_code))
+
+
+class FakeWorkspaceManager:
+  """
+  returns the next answer of a list for each call, raising it if it is an Exception
+  """
+  def __init__(self, submissions=None, active=[]):
+    self.namespace, self.workspace = 'ns', 'ws'
+    self.submissions = submissions or {}
+    self.active = active
+    self.calls = {}
+    self.lock = threading.Lock()
+
+  def disable_hound(self):
+    pass
+
+  def answer(self, key, answers):
+    with self.lock:
+      self.calls[key] = self.calls.get(key, 0) + 1
+      val = answers[min(self.calls[key], len(answers)) - 1]
+    if isinstance(val, Exception):
+      raise val
+    return val
+
+  def list_submissions(self, config=None):
+    return self.active
+
+  def create_submission(self, workflow, ref, entity=None, expression=None, use_callcache=True):
+    return self.answer(ref, self.submissions.get(ref, ['sub_' + ref]))
+
+  def get_submission(self, submission_id):
+    return self.answer(submission_id, self.submissions[submission_id])
+
+
+def workflows(*status):
+  return {'workflows': [{'status': s, 'workflowEntity': {'entityName': 'e%d' % i}} for i, s in enumerate(status)]}
+
+
+def test_create_many_submissions():
+  wm = FakeWorkspaceManager(submissions={'c': [APIError(503), APIError(429), 'sub_c'], 'd': [APIError(400)]},
+                            active=[{'status': 'Running', 'submissionEntity': {'entityName': 'b'}, 'submissionId': 'old'},
+                                    {'status': 'Submitted', 'submissionEntity': {'entityName': 'b'},
+                                     'submissionId': 'sub_b'},
+                                    {'status': 'Done', 'submissionEntity': {'entityName': 'a'}, 'submissionId': 'done'}])
+  res = terra.createManySubmissions(wm, 'workflow', ['a', 'b', 'c', 'd', 'a'], rate=None, backoff=0)
+  assert {k: v for k, v in res.items() if k != 'd'} == {'a': 'sub_a', 'b': 'sub_b', 'c': 'sub_c'}
+  assert isinstance(res['d'], APIError)
+  # duplicated and active references are not submitted, only transient errors are retried
+  assert wm.calls == {'a': 1, 'c': 3, 'd': 1}
+
+
+def test_create_many_submissions_retries():
+  wm = FakeWorkspaceManager(submissions={'a': [APIError(503)] * 3})
+  res = terra.createManySubmissions(wm, 'workflow', ['a', 'b'], rate=None, retries=1, backoff=0, skip_active=False)
+  assert res['b'] == 'sub_b' and isinstance(res['a'], APIError)
+  assert wm.calls == {'a': 2, 'b': 1}
+
+
+def test_monitor_submissions():
+  wm = FakeWorkspaceManager(submissions={
+      'running': [workflows('Queued', 'Queued'), workflows('Running', 'Succeeded'), workflows('Succeeded', 'Failed')],
+      'flaky': [APIError(503), workflows('Succeeded')],
+      'missing': [APIError(404)],
+  })
+  polled = []
+  res = terra.monitorSubmissions(wm, ['running', 'flaky', 'missing'], mininterval=0, maxinterval=0,
+                                 callback=lambda s, row: polled.append(s))
+  assert res.loc['running', 'finished'] and res.loc['running', 'polls'] == 3
+  assert res.loc['running', 'Succeeded'] == 1 and res.loc['running', 'Failed'] == 1
+  assert res.loc['running', 'failed'] == ['e1']
+  # transient errors are retried, the others stop the polling of this submission
+  assert res.loc['flaky', 'finished'] and res.loc['flaky', 'errors'] == 1 and res.loc['flaky', 'error'] is None
+  assert not res.loc['missing', 'finished'] and isinstance(res.loc['missing', 'error'], APIError)
+  assert wm.calls == {'running': 3, 'flaky': 2, 'missing': 1}
+  assert sorted(polled) == ['flaky'] * 2 + ['missing'] + ['running'] * 3
+
+
+def test_monitor_submissions_maxerrors():
+  wm = FakeWorkspaceManager(submissions={'down': [APIError(503)]})
+  res = terra.monitorSubmissions(wm, 'down', mininterval=0, maxinterval=0, maxerrors=3)
+  assert res.loc['down', 'errors'] == 3 and isinstance(res.loc['down', 'error'], APIError)